@@ -36,9 +36,8 @@ class UserLoginHandler(venom.RequestHandler):
         "No user exists matching the given credentials"
       )
     
-    user.last_login = datetime.datetime.now()
-    auth = SessionToken(user=user)
-    venom.Model.save_multi([user, auth])
+    User.last_login.buffer(user, datetime.datetime.now())
+    auth = SessionToken(user=user).save()
     
     return dict(user.__json__().items() + [('session_token', auth.token)])
 
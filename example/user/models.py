@@ -12,7 +12,7 @@ class User(venom.Model):
   
   created      = venom.Properties.DateTime(set_on_creation=True)
   last_updated = venom.Properties.DateTime(set_on_update=True)
-  last_login   = venom.Properties.DateTime()
+  last_login   = venom.Properties.DateTime(write_back=60)
   
   by_username = venom.Query(username == venom.QP)
   by_email = venom.Query(email == venom.QP)
@@ -21,29 +21,28 @@ class User(venom.Model):
   login_by_email = venom.Query(by_email, password == venom.QP)
 
 class SessionToken(venom.Model):
-  expiration_hours = 48
-  
-  def __init__(self, *args, **kwargs):
-    now = datetime.datetime.now()
-    timedelta = datetime.timedelta(hours=self.expiration_hours)
-    expiration = now + timedelta
-    kwargs['expiration'] = expiration
-    super(SessionToken, self).__init__(*args, **kwargs)
+  # expired tokens are hidden from reads and deleted by the cron sweep
+  ttl = datetime.timedelta(hours=48)
+  expires_at = 'expiration'
   
   token      = venom.Properties.UUID(required=True)
   user       = venom.Properties.Model(User, required=True)
   expiration = venom.Properties.DateTime(required=True)
   
-  find_auth = venom.Query(token == venom.QP, expiration > venom.QP)
+  find_auth = venom.Query(token == venom.QP)
 
 
 class UserAuthParameter(venom.Parameters.Model):
   def __init__(self, required=True):
     super(UserAuthParameter, self).__init__(SessionToken, required=required)
   
+  def prefetch(self, value):
+    # tokens are looked up by query, they are not document ids
+    pass
+  
   def cast(self, key, value):
     value = super(venom.Parameters.Model, self).cast(key, value)
-    results = SessionToken.find_auth(value, datetime.datetime.now())
+    results = SessionToken.find_auth(value)
     if not results:
       return None
     result = results[0]
@@ -1,6 +1,9 @@
-__all__ = ['test_Properties', 'test_model', 'test_query']
+__all__ = ['test_Properties', 'test_model', 'test_query', 'test_aggregate', 'test_mapper', 'test_reindex']
 
 
 import test_Properties
 import test_model
-import test_query
\ No newline at end of file
+import test_query
+import test_aggregate
+import test_mapper
+import test_reindex
\ No newline at end of file
@@ -28,6 +28,210 @@ class BasePropertyTest(BasicTestCase):
     assert isinstance(test.inner, InnerModel)
     assert test._values['inner'] != inner.key
   
+  def test_model_property_embed(self):
+    import datetime
+    
+    class Author(venom.Model):
+      username = venom.Properties.String()
+      email = venom.Properties.String()
+      bio = venom.Properties.String()
+      joined = venom.Properties.DateTime()
+    
+    class Post(venom.Model):
+      author = venom.Properties.Model(Author, embed=['username', 'email', 'joined'], refresh=True)
+    
+    with smart_assert.raises() as context:
+      class Broken(venom.Model):
+        author = venom.Properties.Model(Author, embed=['missing'])
+    
+    self.testbed.init_taskqueue_stub()
+    taskqueue = self.testbed.get_stub('taskqueue')
+    joined = datetime.datetime(2020, 1, 2, 3, 4, 5)
+    author = Author(username='alice', email='alice@example.com', bio='hi', joined=joined).save()
+    post = Post(author=author).save()
+    
+    # embedded fields are served from the snapshot without a get
+    post = Post.get(post.key)
+    assert isinstance(post.author, venom.Properties.ModelSnapshot)
+    assert post.author.key == author.key
+    assert post.author.username == 'alice'
+    # embedded values read back like the referenced entity's, not as stored
+    smart_assert(post.author.joined, Author.get(author.key).joined, joined).equals()
+    assert post.author.__json__() == {
+      'key': author.key,
+      'username': 'alice',
+      'email': 'alice@example.com',
+      'joined': joined
+    }
+    
+    # anything else dereferences the referenced entity
+    assert post.author.bio == 'hi'
+    
+    # snapshots are refreshed once the referenced entity changes
+    author.username = 'bob'
+    author.save()
+    smart_assert(len(taskqueue.get_filtered_tasks()), 1).equals()
+    assert Post.get(post.key).author.username == 'alice'
+    # saves that leave the embedded fields alone enqueue no refresh
+    author.bio = 'hello'
+    author.save()
+    Author.save_multi([author])
+    smart_assert(len(taskqueue.get_filtered_tasks()), 1).equals()
+    venom.Properties.refresh_snapshots(Post.kind, 'author', [author.key])
+    assert Post.get(post.key).author.username == 'bob'
+  
+  def test_counter_property(self):
+    class Post(venom.Model):
+      title = venom.Properties.String()
+      views = venom.Properties.Counter(shards=4)
+    
+    assert Post._schema['views'].datastore == False
+    assert Post._schema['views'].search == False
+    assert not 'views' in Post._to_route_parameters()
+    
+    post = Post(title='hello')
+    assert post.views == 0
+    with smart_assert.raises(venom.Properties.PropertyValidationFailed) as context:
+      Post.views.increment(post)
+    
+    post.save()
+    entity = post.hybrid_entity.datastore_entity.get_entity()
+    assert not 'views' in entity._properties
+    
+    for _ in range(10):
+      Post.views.increment(post)
+    Post.views.increment_async(post, delta=5).get_result()
+    assert post.views == 15
+    
+    Post.views.increment(post, delta=-3)
+    assert Post.get(post.key).views == 12
+    
+    # a total summed while an increment commits is not cached
+    class RacingCounter(venom.internal.sharded_counter.ShardedCounter):
+      def _sum_shards(self):
+        total = super(RacingCounter, self)._sum_shards()
+        if total == 1:
+          self.increment()
+        return total
+    
+    counter = RacingCounter('race', 2)
+    counter.increment()
+    assert counter.get() == 1
+    assert counter.get() == 2
+    assert counter.get() == 2
+    
+    with smart_assert.raises(venom.Properties.PropertyValidationFailed) as context:
+      post.views = 3
+  
+  def test_list_property(self):
+    class Post(venom.Model):
+      tags = venom.Properties.List(venom.Properties.String(max=20), max=3)
+      labels = venom.Properties.List(venom.Properties.String(max=None))
+      scores = venom.Properties.List(venom.Properties.Integer())
+      
+      tagged = venom.Query(tags.contains(venom.QP))
+      labeled = venom.Query(labels.contains(venom.QP))
+    
+    assert Post.tagged.explain('a').backend == venom.QueryPlan.DATASTORE
+    assert Post.labeled.explain('a').backend == venom.QueryPlan.SEARCH
+    assert Post.labeled.explain('a').query == '(labels = "a")'
+    assert Post._schema['labels'].search_field == search.TextField
+    assert isinstance(Post._to_route_parameters()['tags'], venom.Parameters.List)
+    
+    post = Post(tags=['a', 'b'], labels=['x', 'y'])
+    assert post.scores == []
+    post.scores.append(3)
+    post.save()
+    Post(tags=['b'], labels=['y']).save()
+    
+    entity = post.hybrid_entity.datastore_entity.get_entity()
+    smart_assert(entity.tags, ['a', 'b']).equals()
+    smart_assert(entity.scores, [3]).equals()
+    
+    smart_assert(len(Post.tagged('a')), len(Post.labeled('x')), 1).equals()
+    smart_assert(len(Post.tagged('b')), len(Post.labeled('y')), 2).equals()
+    smart_assert(Post.get(post.key).labels, ['x', 'y']).equals()
+    
+    # only changed items rewrite the search document
+    post = Post.get(post.key)
+    Post._set_hybrid_entity_values(post)
+    assert not post.hybrid_entity.document_has_diff()
+    post.labels = ['x']
+    post.save()
+    assert len(Post.labeled('y')) == 1
+    
+    with smart_assert.raises(venom.Properties.PropertyValidationFailed) as context:
+      post.tags = ['a', 'b', 'c', 'd']
+    with smart_assert.raises(venom.Properties.PropertyValidationFailed) as context:
+      post.tags = ['a' * 21]
+    with smart_assert.raises(venom.Properties.InvalidPropertyComparison) as context:
+      Post.tags == 'a'
+  
+  def test_embedded_property(self):
+    class Address(venom.Model):
+      street = venom.Properties.String(required=True)
+      zip = venom.Properties.Integer()
+      lines = venom.Properties.List(venom.Properties.String())
+    
+    class Customer(venom.Model):
+      name = venom.Properties.String()
+      address = venom.Properties.Embedded(Address, required=True)
+    
+    assert Customer._schema['address'].datastore
+    assert not Customer._schema['address'].packed
+    parameter = Customer._to_route_parameters()['address']
+    assert isinstance(parameter, venom.Parameters.Dict)
+    smart_assert(sorted(parameter.template.keys()), ['lines', 'street', 'zip']).equals()
+    
+    customer = Customer(name='ann', address={'street': 'main', 'zip': 10001})
+    assert isinstance(customer.address, Address)
+    customer.address.lines.append('apt 2')
+    customer.save()
+    
+    # one entity, no separate Address kind is written
+    assert Address.hybrid_model.model.query().count() == 0
+    customer = Customer.get(customer.key)
+    smart_assert(customer.address.street, 'main').equals()
+    smart_assert(customer.address.zip, 10001).equals()
+    smart_assert(customer.address.lines, ['apt 2']).equals()
+    smart_assert(
+      customer.__json__()['address'].__json__(),
+      {'street': 'main', 'zip': 10001, 'lines': ['apt 2']}
+    ).equals()
+    
+    customer.address.street = None
+    with smart_assert.raises(venom.Properties.PropertyValidationFailed) as context:
+      customer.save()
+    with smart_assert.raises(venom.Properties.PropertyValidationFailed) as context:
+      Customer(name='bob').save()
+    with smart_assert.raises(venom.Properties.PropertyValidationFailed) as context:
+      customer.address = 'main'
+  
+  def test_list_of_embedded(self):
+    class Address(venom.Model):
+      street = venom.Properties.String(required=True)
+      zip = venom.Properties.Integer()
+    
+    class Customer(venom.Model):
+      name = venom.Properties.String()
+      addresses = venom.Properties.List(venom.Properties.Embedded(Address))
+    
+    assert not Customer._schema['addresses'].packed
+    customer = Customer(name='ann', addresses=[{'street': 'main', 'zip': 10001}])
+    assert isinstance(customer.addresses[0], Address)
+    customer.addresses.append({'street': 'side'})
+    customer.save()
+    
+    customer = Customer.get(customer.key)
+    smart_assert([address.street for address in customer.addresses], ['main', 'side']).equals()
+    smart_assert(customer.addresses[0].zip, 10001).equals()
+    
+    customer.addresses.append(Address(zip=2))
+    with smart_assert.raises(venom.Properties.PropertyValidationFailed) as context:
+      customer.save()
+    with smart_assert.raises(Exception) as context:
+      venom.Properties.List(venom.Properties.Embedded(Address), search_only=True)
+  
   def test_password_property(self):
     self.__test_string_property(venom.Properties.Password)
     
@@ -71,6 +275,105 @@ class BasePropertyTest(BasicTestCase):
       
     assert isinstance(prop._from_storage(unicode('bar')), str)
   
+  def test_string_lookup_indexes(self):
+    class User(venom.Model):
+      username = venom.Properties.String(prefix_index=True, case_insensitive=True)
+      email = venom.Properties.String(case_insensitive=True)
+      
+      by_email = venom.Query(email == venom.QP)
+      typeahead = venom.Query(username.startswith(venom.QP))
+    
+    User(username='Alice', email='Alice@Example.com').save()
+    User(username='albert', email='albert@example.com').save()
+    User(username='Bob', email='bob@example.com').save()
+    
+    plan = User.typeahead.explain('al')
+    assert plan.backend == venom.QueryPlan.DATASTORE
+    assert 'username__prefixes' in str(plan.query)
+    smart_assert(sorted(user.username for user in User.typeahead('AL')), ['Alice', 'albert']).equals()
+    smart_assert([user.username for user in User.typeahead('bo')], ['Bob']).equals()
+    smart_assert(User.typeahead('x'), []).equals()
+    
+    # case insensitive equality runs against the lowered shadow
+    smart_assert([user.username for user in User.by_email('alice@example.COM')], ['Alice']).equals()
+    assert User.by_email('ALICE@EXAMPLE.COM').get().email == 'Alice@Example.com'
+    
+    # index.yaml lists the shadows the queries filter on
+    from venom.internal.index_yaml import IndexGenerator
+    indexes = IndexGenerator('', [User._schema]).generate()
+    assert 'username__prefixes' in indexes
+    assert 'email__lower' in indexes
+    
+    with smart_assert.raises(venom.Properties.InvalidPropertyComparison) as context:
+      User.typeahead('a' * 21)
+    with smart_assert.raises(venom.Properties.InvalidPropertyComparison) as context:
+      User.email.startswith('a')
+  
+  def test_unbounded_case_insensitive_lookup(self):
+    class Member(venom.Model):
+      handle = venom.Properties.String(case_insensitive=True)
+      
+      bio = venom.Properties.Text()
+      
+      by_handle = venom.Query(handle == venom.QP)
+      by_handle_and_bio = venom.Query(handle == venom.QP, bio.contains(venom.QP))
+    
+    Member(handle='Alice', bio='likes tea').save()
+    assert Member._schema['handle'].search == True
+    
+    # equality stays on the datastore shadow even though the field is full text
+    plan = Member.by_handle.explain('alice')
+    assert plan.backend == venom.QueryPlan.DATASTORE
+    assert 'handle__lower' in str(plan.query)
+    smart_assert([member.handle for member in Member.by_handle('ALICE')], ['Alice']).equals()
+    
+    # search queries filter the lowered search field
+    plan = Member.by_handle_and_bio.explain('ALICE', 'tea')
+    assert plan.backend == venom.QueryPlan.SEARCH
+    assert 'handle__lower' in str(plan.query)
+    smart_assert([member.handle for member in Member.by_handle_and_bio('ALICE', 'tea')], ['Alice']).equals()
+  
+  def test_text_property(self):
+    class Article(venom.Model):
+      title = venom.Properties.String()
+      body = venom.Properties.Text()
+    
+    body = u'lorem ipsum dolor sit amet \u2713 ' * 200
+    article = Article(title='hello', body=body).save()
+    
+    assert Article._schema['body'].search == False
+    assert Article._schema['body'].indexed_datastore == False
+    stored = article.hybrid_entity.datastore_entity.get_entity().body
+    assert len(stored) < len(body) / 10
+    
+    article = Article.get(article.key)
+    # stays compressed until it is read
+    assert isinstance(article._values['body'], venom.Properties.CompressedText)
+    article.title = 'updated'
+    article.save()
+    assert article.hybrid_entity.datastore_entity.get_entity().body == stored
+    assert article.body == body
+    assert article.__json__()['body'] == body
+    
+    with smart_assert.raises(venom.Properties.InvalidPropertyComparison) as context:
+      Article.body == 'lorem'
+    
+    class SearchableArticle(venom.Model):
+      body = venom.Properties.Text(searchable=True)
+      
+      matching = venom.Query(body == venom.QP)
+    
+    SearchableArticle(body='the quick brown fox').save()
+    assert SearchableArticle._schema['body'].search == True
+    smart_assert(len(SearchableArticle.matching('fox')), 1).equals()
+    
+    # request values are unicode, several words are matched as a phrase
+    SearchableArticle(body=u'le renard br\xfbl\xe9 saute').save()
+    smart_assert(SearchableArticle.matching.explain(u'quick fox').query, u'(body = "quick fox")').equals()
+    smart_assert(len(SearchableArticle.matching(u'quick fox')), 0).equals()
+    smart_assert(len(SearchableArticle.matching(u'brown fox')), 1).equals()
+    smart_assert(len(SearchableArticle.matching(u'renard br\xfbl\xe9')), 1).equals()
+  
   def test_float_property(self):
     prop = venom.Properties.Float(min=2, max=8, choices=[1, 3.5, 4, 9], required=True)
     
@@ -0,0 +1,46 @@
+from helper import smart_assert, BasicTestCase
+import venom
+
+
+class MapperTest(BasicTestCase):
+  def test_key_ranges_cover_kind(self):
+    class Mapped(venom.Model):
+      n = venom.Properties.Integer()
+    
+    Mapped.save_multi([Mapped(n=i) for i in range(50)])
+    ranges = Mapped.hybrid_model.split_key_ranges(4)
+    assert 1 <= len(ranges) <= 4
+    assert ranges[0][0] == None
+    assert ranges[-1][1] == None
+    for (_, end), (start, _) in zip(ranges[:-1], ranges[1:]):
+      assert end == start
+    
+    keys = []
+    for start, end in ranges:
+      hybrids, _, _ = Mapped.hybrid_model.query_key_range(start, end, batch_size=100)
+      keys += [hybrid.entity_key for hybrid in hybrids]
+    smart_assert(len(keys), len(set(keys)), 50).equals()
+  
+  def test_mapper_writes_results(self):
+    class Mapped(venom.Model):
+      n = venom.Properties.Integer()
+    
+    Mapped.save_multi([Mapped(n=i) for i in range(30)])
+    
+    def double_even(entity):
+      if entity.n % 2 == 0:
+        entity.n *= 2
+        return entity
+    
+    progress = venom.Mapper(Mapped, double_even, shards=4, batch_size=7).run()
+    smart_assert(progress['processed'], 30).equals()
+    smart_assert(progress['written'], 15).equals()
+    assert progress['done']
+    assert progress['finished_shards'] == progress['shards']
+    
+    values = sorted(entity.n for entity in Mapped.all())
+    smart_assert(values, sorted(i * 2 if i % 2 == 0 else i for i in range(30))).equals()
+  
+  def test_mapper_requires_model(self):
+    with smart_assert.raises(Exception) as context:
+      venom.Mapper(object, lambda entity: None)
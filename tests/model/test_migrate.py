@@ -31,4 +31,84 @@ class MigrationTests(BasicTestCase):
     
     assert len(Test.matches()) == 1
     
-  
\ No newline at end of file
+    
+  def test_migration_resumes(self):
+    class Resumable(venom.Model):
+      auto_migrate_in_dev = False
+      
+      foo = venom.Properties.String()
+      bar = venom.Properties.String()
+    
+    Resumable(foo='foo', bar='bar').save()
+    Resumable(foo='foo', bar='bar').save()
+    Resumable(bar='bar').save()
+    
+    class Resumable(venom.Model):
+      auto_migrate_in_dev = False
+      
+      foo = venom.Properties.String(max=None)
+      bar = venom.Properties.String()
+      
+      matches = venom.Query(foo == 'foo')
+    
+    assert len(Resumable.matches()) == 0
+    
+    migration = venom.migrate.Migration()
+    record_key = migration._current_migration.key
+    
+    # simulate a migration that died after its first batch
+    assert venom.migrate.migrate_kind_batch(record_key, 'Resumable', batch_size=1) == False
+    assert record_key.get().finished == None
+    
+    with smart_assert.raises(Exception) as context:
+      venom.migrate.Migration(resume=False)
+    
+    migration = venom.migrate.Migration()
+    assert migration._current_migration.key == record_key
+    migration.run(batch_size=1)
+    
+    progress = migration.get_progress()['Resumable']
+    assert progress['done'] == True
+    assert progress['count'] == 3
+    assert progress['rewritten'] == 2
+    assert record_key.get().finished != None
+    assert len(Resumable.matches()) == 2
+  
+  def test_migration_tasks_split_key_ranges(self):
+    from google.appengine.ext import deferred
+    self.testbed.init_taskqueue_stub()
+    taskqueue = self.testbed.get_stub('taskqueue')
+    
+    class Ranged(venom.Model):
+      auto_migrate_in_dev = False
+      
+      foo = venom.Properties.String()
+    
+    Ranged.save_multi([Ranged(foo='foo') for i in range(40)])
+    
+    class Ranged(venom.Model):
+      auto_migrate_in_dev = False
+      
+      foo = venom.Properties.String(max=None)
+      
+      matches = venom.Query(foo == 'foo')
+    
+    migration = venom.migrate.Migration()
+    migration.run(batch_size=5, use_tasks=True, shards=4)
+    assert 1 <= migration.get_progress()['Ranged']['ranges'] <= 4
+    
+    # every key range is its own chain of tasks, run them until they drain
+    ran = set()
+    while True:
+      tasks = [task for task in taskqueue.get_filtered_tasks() if not task.name in ran]
+      if not tasks:
+        break
+      for task in tasks:
+        ran.add(task.name)
+        deferred.run(task.payload)
+    
+    progress = migration.get_progress()['Ranged']
+    assert progress['done'] == True
+    smart_assert(progress['count'], progress['rewritten'], 40).equals()
+    assert migration._current_migration.key.get().finished != None
+    assert len(Ranged.matches()) == 40
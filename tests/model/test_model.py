@@ -2,6 +2,7 @@ from helper import smart_assert, BasicTestCase
 import venom
 
 from google.appengine.ext import ndb
+from google.appengine.api import search
 
 
 class ModelTest(BasicTestCase):
@@ -177,6 +178,101 @@ class ModelTest(BasicTestCase):
     assert_schema(User, 'password', True, True , False)
     assert_schema(User, 'bio'     , True, False, False)
   
+  def test_search_field_types(self):
+    class User(venom.Model):
+      email = venom.Properties.String(max=254, search_only=True)
+      role = venom.Properties.String(max=None, choices=['admin', 'user'])
+      bio = venom.Properties.String(max=None)
+      age = venom.Properties.Integer()
+      
+      by_email = venom.Query(email == venom.QP)
+      not_role = venom.Query(role != venom.QP)
+      by_bio = venom.Query(bio == venom.QP)
+      older = venom.Query(age > venom.QP, bio == venom.QP)
+    
+    assert User._schema['email'].search_field == search.AtomField
+    assert User._schema['role'].search_field == search.AtomField
+    # unbounded strings may exceed the 500 character atom limit
+    assert User._schema['bio'].search_field == search.TextField
+    assert User._schema['age'].search_field == search.NumberField
+    
+    user = User(email='foo@bar.com', role='admin', bio='foo bar', age=20).save()
+    document = user.hybrid_entity.search_document.get_document()
+    fields = { field.name: field for field in document.fields }
+    assert isinstance(fields['email'], search.AtomField)
+    assert isinstance(fields['bio'], search.TextField)
+    
+    assert len(User.by_email('foo@bar.com')) == 1
+    assert len(User.by_email('foo')) == 0
+    
+    User(email='bar@foo.com', role='user', bio='foo ' * 200, age=30).save()
+    assert len(User.by_bio('foo')) == 2
+  
+  def test_search_only_properties(self):
+    class Post(venom.Model):
+      title = venom.Properties.String()
+      body = venom.Properties.String(max=None, search_only=True)
+      
+      by_title = venom.Query(title == venom.QP)
+      body_contains = venom.Query(body == venom.QP)
+    
+    assert Post._schema['body'].datastore == False
+    assert Post._schema['body'].search == True
+    
+    # search only bodies are usually long, past the 500 character atom limit
+    text = 'lorem ipsum ' * 100
+    assert Post._schema['body'].search_field == search.TextField
+    post = Post(title='hello', body=text).save()
+    
+    entity = post.hybrid_entity.datastore_entity.get_entity()
+    assert not 'body' in entity._properties
+    document = post.hybrid_entity.search_document.get_document()
+    assert 'body' in [field.name for field in document.fields]
+    
+    post = Post.get(post.key)
+    assert 'body' in post._deferred_loaders
+    assert post.body == text
+    assert post._deferred_loaders == {}
+    
+    post = Post.by_title('hello').get()
+    post.title = 'world'
+    post.save()
+    assert Post.get(post.key).body == text
+    
+    post = Post.body_contains('lorem ipsum').get()
+    assert post.title == 'world'
+    assert post.body == text
+  
+  def test_packed_properties(self):
+    class Profile(venom.Model):
+      packed = True
+      
+      username = venom.Properties.String()
+      bio = venom.Properties.String()
+      age = venom.Properties.Integer()
+      
+      by_username = venom.Query(username == venom.QP)
+    
+    assert Profile._schema['username'].packed == False
+    assert Profile._schema['bio'].packed == True
+    assert Profile._schema['age'].packed == True
+    
+    profile = Profile(username='foo', bio='bar', age=20).save()
+    entity = profile.hybrid_entity.datastore_entity.get_entity()
+    assert set(entity._properties.keys()) == {'username', Profile.packed_property}
+    
+    profile = Profile.by_username('foo').get()
+    assert 'bio' in profile._deferred_loaders
+    assert profile.bio == 'bar'
+    assert profile.age == 20
+    assert profile._deferred_loaders == {}
+    
+    profile.age = None
+    profile.save()
+    profile = Profile.get(profile.key)
+    assert profile.bio == 'bar'
+    assert profile.age == None
+  
   def test_json(self):
     class User(venom.Model):
       username = venom.Properties.String()
@@ -236,3 +332,336 @@ class ModelTest(BasicTestCase):
     users = User.get_multi([key1, key2])
     assert users[0].username == 'username1'
     assert users[1].username == 'username2'
+  
+  def test_delete_multi(self):
+    class Session(venom.Model):
+      token = venom.Properties.String(max=None)
+      hits = venom.Properties.Counter(shards=2)
+      
+      by_token = venom.Query(token == venom.QP)
+    
+    class Device(venom.Model):
+      name = venom.Properties.String()
+    
+    sessions = [Session(token='t{}'.format(i)).save() for i in range(5)]
+    device = Device(name='phone').save()
+    Session.hits.increment(sessions[0])
+    assert sessions[0].hits == 1
+    
+    Session.delete_multi([sessions[0], sessions[1].key, device, sessions[2].key])
+    remaining = Session.get_multi([session.key for session in sessions])
+    smart_assert([session != None for session in remaining], [False, False, False, True, True]).equals()
+    assert Device.get(device.key) == None
+    assert Session.get(sessions[3].key).token == 't3'
+    assert len(Session.by_token('t0')) == 0
+    assert len(Session.by_token('t2')) == 0
+    assert len(Session.by_token('t4')) == 1
+    
+    # counter shards and the cached total go with the entity
+    assert venom.internal.sharded_counter.VenomCounterShard.query().count() == 0
+    assert sessions[0].hits == 0
+    
+    sessions[3].delete()
+    assert Session.get(sessions[3].key) == None
+    assert len(Session.by_token('t3')) == 0
+  
+  def test_expiring_entities(self):
+    import datetime
+    
+    class Token(venom.Model):
+      expires_at = 'expiration'
+      
+      name = venom.Properties.String()
+      expiration = venom.Properties.DateTime()
+      
+      by_name = venom.Query(name == venom.QP)
+    
+    assert Token._schema['expiration'].indexed_datastore
+    now = datetime.datetime.now()
+    expired = Token(name='a', expiration=now - datetime.timedelta(hours=1)).save()
+    alive = Token(name='a', expiration=now + datetime.timedelta(hours=1)).save()
+    forever = Token(name='a').save()
+    
+    assert Token.get(expired.key) == None
+    smart_assert(len(Token.by_name('a')), len(Token.all()), 2).equals()
+    smart_assert([token != None for token in Token.get_multi([expired.key, alive.key])], [False, True]).equals()
+    
+    # queries never hand expired entities to the loader
+    with venom.Loader():
+      smart_assert(len(Token.by_name('a')), 2).equals()
+      assert Token.get(expired.key) == None
+    
+    smart_assert(venom.sweep_expired(models=[Token], batch_size=1), {'Token': 1}).equals()
+    assert Token.hybrid_model.get(expired.key) == None
+    assert Token.hybrid_model.get(alive.key) != None
+    
+    smart_assert(venom.sweep_expired(models=[Token], now=now + datetime.timedelta(hours=2)), {'Token': 1}).equals()
+    assert Token.get(forever.key).name == 'a'
+  
+  def test_ttl(self):
+    import datetime
+    
+    class Token(venom.Model):
+      ttl = 60
+      
+      name = venom.Properties.String()
+    
+    assert Token.expires_at == 'expires'
+    token = Token(name='a').save()
+    assert token.expires != None
+    assert not token.is_expired()
+    assert token.is_expired(now=datetime.datetime.now() + datetime.timedelta(seconds=120))
+    assert not 'expires' in token.__json__()
+    
+    with smart_assert.raises(Exception) as context:
+      class Broken(venom.Model):
+        expires_at = 'name'
+        
+        name = venom.Properties.String()
+  
+  def test_belongs_to_ancestor(self):
+    class Board(venom.Model):
+      name = venom.Properties.String()
+    
+    class Card(venom.Model):
+      belongs_to = Board
+      belongs_to_ancestor = True
+      
+      title = venom.Properties.String()
+    
+    board = Board(name='todo').save()
+    other = Board(name='done').save()
+    card = Card(title='a', board=board).save()
+    Card(title='b', board=other).save()
+    
+    # the owner's document id prefixes the child's
+    assert card.key.startswith('{}.'.format(board.key))
+    assert card.hybrid_entity.entity_key.parent() == board.hybrid_entity.entity_key
+    assert Card.get(card.key).title == 'a'
+    
+    assert Card.is_owned_by(card.key, board)
+    assert Card.is_owned_by(card.key, board.key)
+    assert not Card.is_owned_by(card.key, other)
+    
+    smart_assert([entity.title for entity in board.cards], ['a']).equals()
+    smart_assert([entity.title for entity in Card._owners['board'](other.key)], ['b']).equals()
+    
+    card.board = other
+    with smart_assert.raises(Exception) as context:
+      card.save()
+    
+    # cards saved before belongs_to_ancestor was set keep their plain ids
+    legacy = Card(title='old', board=board).save()
+    ndb_entity = legacy.hybrid_entity.datastore_entity.get_entity()
+    ndb_entity.key.delete()
+    ndb_entity.key = ndb.Key(Card.kind, 4242)
+    ndb_entity.put()
+    assert Card.get('4242').title == 'old'
+    assert Card.is_owned_by('4242', board)
+    assert not Card.is_owned_by('4242', other)
+    legacy = Card.get('4242')
+    legacy.title = 'renamed'
+    legacy.save()
+    smart_assert(Card.get('4242').title, 'renamed').equals()
+    
+    with smart_assert.raises(Exception) as context:
+      class Broken(venom.Model):
+        belongs_to = [Board, Card]
+        belongs_to_ancestor = True
+  
+  def test_search_shards(self):
+    class Message(venom.Model):
+      search_shards = 4
+      
+      body = venom.Properties.String(max=None)
+      
+      matching = venom.Query(body == venom.QP)
+    
+    assert isinstance(Message.hybrid_model.index, venom.internal.sharded_index.ShardedIndex)
+    Message.save_multi([ Message(body='hello {}'.format(i)) for i in range(20) ])
+    
+    # documents are spread over the shards by id
+    counts = [
+      len(list(index.get_range(ids_only=True)))
+      for index in Message.hybrid_model.index.indexes
+    ]
+    assert sum(counts) == 20
+    assert len([count for count in counts if count]) > 1
+    
+    smart_assert(len(Message.matching('hello')), 20).equals()
+    message = Message.matching('hello 7').get()
+    assert Message.get(message.key).body == 'hello 7'
+    
+    Message.delete_multi([message.key])
+    smart_assert(len(Message.matching('hello')), 19).equals()
+    
+    class Message(venom.Model):
+      search_shards = 8
+      
+      body = venom.Properties.String(max=None)
+      
+      matching = venom.Query(body == venom.QP)
+    
+    # a new shard count starts from new indexes, reindexing leaves no duplicates
+    smart_assert(Message.hybrid_model.index.indexes[0].name, 'Message-8-0').equals()
+    venom.rebuild_search_index(Message, resume=False)
+    results = Message.matching('hello')
+    smart_assert(len(results), len(set(entity.key for entity in results)), 19).equals()
+    assert Message.matching('hello 7') == []
+  
+  def test_write_back(self):
+    import time
+    
+    class Member(venom.Model):
+      name = venom.Properties.String()
+      logins = venom.Properties.Integer(write_back=10)
+    
+    member = Member(name='a', logins=0).save()
+    with smart_assert.raises(venom.Properties.PropertyValidationFailed) as context:
+      Member.name.buffer(member, 'b')
+    
+    Member.logins.buffer(member, 5)
+    # buffered values are merged into reads but not saved yet
+    assert member.hybrid_entity.datastore_entity.get_entity().logins == 0
+    assert Member.get(member.key).logins == 5
+    assert Member.get_multi([member.key])[0].logins == 5
+    
+    # buckets are flushed once they have been closed for a whole interval
+    smart_assert(venom.flush_write_back(models=[Member]), {'Member': 0}).equals()
+    smart_assert(venom.flush_write_back(models=[Member], now=time.time() + 10), {'Member': 0}).equals()
+    later = time.time() + 20
+    smart_assert(venom.flush_write_back(models=[Member], now=later), {'Member': 1}).equals()
+    assert Member.hybrid_model.get(member.key).datastore_entity.get_entity().logins == 5
+    # saved values leave the buffer
+    smart_assert(Member._write_back.load([member.key]), {}).equals()
+    
+    # a direct assignment wins over older buffered values
+    member = Member.get(member.key)
+    member.logins = 7
+    member.save()
+    assert Member.get(member.key).logins == 7
+    
+    with smart_assert.raises(Exception) as context:
+      class Broken(venom.Model):
+        name = venom.Properties.String(unique=True, write_back=10)
+  
+  def test_loader(self):
+    class Writer(venom.Model):
+      name = venom.Properties.String()
+    
+    class Article(venom.Model):
+      title = venom.Properties.String()
+      writer = venom.Properties.Model(Writer)
+    
+    writers = [Writer(name=name).save() for name in ['a', 'b']]
+    articles = [
+      Article(title=str(i), writer=writers[i % 2]).save()
+      for i in range(4)
+    ]
+    
+    batches = []
+    get_multi = ndb.get_multi
+    def counting_get_multi(keys, **options):
+      batches.append(len(keys))
+      return get_multi(keys, **options)
+    ndb.get_multi = counting_get_multi
+    try:
+      with venom.Loader() as loader:
+        # futures of both kinds resolve in a single batch
+        article = loader.load(Article, articles[0].key)
+        writer = loader.load(Writer, writers[1].key)
+        assert loader.load(Article, articles[0].key) is article
+        smart_assert(article.get_result().title, '0').equals()
+        assert writer.done()
+        smart_assert(batches, [2]).equals()
+        
+        # references of loaded entities are queued and ride along with the next batch
+        del batches[:]
+        loaded = Article.get_multi([entity.key for entity in articles[1:]])
+        smart_assert(batches, [4]).equals()
+        smart_assert([entity.writer.name for entity in loaded], ['b', 'a', 'b']).equals()
+        smart_assert(batches, [4]).equals()
+        
+        # saves are visible to later gets of the same scope without an rpc
+        del batches[:]
+        writers[0].name = 'c'
+        writers[0].save()
+        smart_assert(Writer.get(writers[0].key).name, 'c').equals()
+        smart_assert(batches, []).equals()
+        
+        writers[0].delete()
+        assert Writer.get(writers[0].key) == None
+    finally:
+      ndb.get_multi = get_multi
+    
+    # outside of a scope gets go straight to the datastore
+    assert venom.current_loader() == None
+    smart_assert(Writer.get(writers[1].key).name, 'b').equals()
+    
+    # a failed batch raises from its futures and later loads retry
+    failures = [Exception('deadline')]
+    def failing_get_multi(keys, **options):
+      if failures:
+        raise failures.pop()
+      return get_multi(keys, **options)
+    ndb.get_multi = failing_get_multi
+    try:
+      with venom.Loader() as loader:
+        future = loader.load(Writer, writers[1].key)
+        with smart_assert.raises(Exception) as context:
+          future.get_result()
+        with smart_assert.raises(Exception) as context:
+          future.get_result()
+        smart_assert(Writer.get(writers[1].key).name, 'b').equals()
+    finally:
+      ndb.get_multi = get_multi
+    
+    # request values are unicode, ids that can't name an entity are not found
+    with venom.Loader() as loader:
+      assert Writer.get(u'\xe9') == None
+      venom.Parameters.Model(Writer).prefetch(u'\xe9')
+  
+  def test_negative_cache(self):
+    class Token(venom.Model):
+      negative_cache_ttl = 30
+      name = venom.Properties.String()
+    
+    token = Token(name='a').save()
+    missing_id = str(int(token.key) + 1)
+    
+    batches = []
+    get_multi = ndb.get_multi
+    def counting_get_multi(keys, **options):
+      batches.append(len(keys))
+      return get_multi(keys, **options)
+    ndb.get_multi = counting_get_multi
+    try:
+      assert Token.get(missing_id) == None
+      smart_assert(batches, [1]).equals()
+      
+      # known missing ids are answered without an rpc
+      assert Token.get(missing_id) == None
+      smart_assert([entity and entity.name for entity in Token.get_multi([token.key, missing_id])], ['a', None]).equals()
+      smart_assert(batches, [1, 1]).equals()
+      
+      # the memcache copy serves processes that never saw the miss
+      Token._negative_cache.entries = {}
+      assert Token.get(missing_id) == None
+      smart_assert(batches, [1, 1]).equals()
+      with venom.Loader():
+        assert Token.get(missing_id) == None
+      smart_assert(batches, [1, 1]).equals()
+    finally:
+      ndb.get_multi = get_multi
+    
+    assert Token._negative_cache.missing([missing_id])
+    Token._negative_cache.forget([missing_id])
+    assert not Token._negative_cache.missing([missing_id])
+    
+    # ids from requests are unicode and not always ascii
+    assert Token.get(u'caf\xe9') == None
+    smart_assert(Token._negative_cache.missing([u'caf\xe9']), {u'caf\xe9'}).equals()
+    with venom.Loader():
+      assert Token.get(u'caf\xe9') == None
+    Token._negative_cache.forget([u'caf\xe9'])
+    assert not Token._negative_cache.missing([u'caf\xe9'])
@@ -169,4 +169,205 @@ class QueryTest(BasicTestCase):
     query = venom.Query(foo < venom.QP, bar != venom.QP)
     query._connect(name='query', entity=TestModel())
     assert query(123, bar=456) == []
-    
\ No newline at end of file
+    
+
+class QueryExplainTest(BasicTestCase):
+  def test_explain_datastore(self):
+    class TestModel(venom.Model):
+      foo = venom.Properties.String()
+      bar = venom.Properties.Integer()
+      
+      by_foo = venom.Query(foo == venom.QP)
+      by_both = venom.Query(foo == venom.QP, bar > venom.QP)
+      by_range_first = venom.Query(bar > venom.QP, foo == venom.QP)
+    
+    plan = TestModel.by_foo.explain('abc')
+    assert plan.backend == venom.QueryPlan.DATASTORE
+    assert plan.kind == 'TestModel'
+    assert plan.reasons == []
+    assert plan.indexes == []
+    assert str(plan.query) == "FilterNode('foo', '=', 'abc')"
+    
+    plan = TestModel.by_both.explain('abc', 5)
+    assert plan.backend == venom.QueryPlan.DATASTORE
+    assert plan.indexes == [{
+      'kind': 'TestModel',
+      'properties': [{ 'name': 'foo' }, { 'name': 'bar' }]
+    }]
+    # the datastore sorts on the inequality property, so it comes last
+    smart_assert(TestModel.by_range_first.explain(5, 'abc').indexes, plan.indexes).equals()
+  
+  def test_explain_search(self):
+    class TestModel(venom.Model):
+      foo = venom.Properties.Integer()
+      bar = venom.Properties.Integer()
+      bio = venom.Properties.String(max=None)
+      
+      unbounded = venom.Query(bio == venom.QP)
+      inequalities = venom.Query(foo > venom.QP, bar < venom.QP)
+    
+    plan = TestModel.unbounded.explain('abc')
+    assert plan.backend == venom.QueryPlan.SEARCH
+    assert plan.query == '(bio = "abc")'
+    assert plan.reasons == ['TestModel.bio has no String max']
+    
+    plan = TestModel.inequalities.explain(1, 2)
+    assert plan.backend == venom.QueryPlan.SEARCH
+    assert plan.reasons == ['two inequality properties (foo, bar)']
+    # search documents need no composite indexes
+    assert plan.indexes == []
+  
+  def test_slow_query_log(self):
+    class TestModel(venom.Model):
+      foo = venom.Properties.String()
+      by_foo = venom.Query(foo == venom.QP)
+    
+    TestModel(foo='abc').save()
+    
+    log = venom.SlowQueryLog(threshold=0)
+    TestModel.by_foo.slow_query_log = log
+    
+    assert len(TestModel.by_foo('abc')) == 1
+    assert len(log.records) == 1
+    assert log.records[0].count == 1
+    assert log.records[0].plan.backend == venom.QueryPlan.DATASTORE
+    assert log.records[0].plan.reasons == []
+    
+    log.threshold = None
+    TestModel.by_foo('abc')
+    assert len(log.records) == 1
+  
+  def test_rpc_options(self):
+    class TestModel(venom.Model):
+      rpc_options = { 'deadline': 5, 'use_memcache': False }
+      
+      foo = venom.Properties.String()
+      by_foo = venom.Query(foo == venom.QP, read_policy=venom.EVENTUAL, batch_size=50)
+    
+    assert TestModel.by_foo.rpc_options == { 'read_policy': venom.EVENTUAL, 'batch_size': 50 }
+    strong = TestModel.by_foo.with_options(read_policy=venom.STRONG, deadline=1)
+    assert strong.rpc_options == { 'read_policy': venom.STRONG, 'batch_size': 50, 'deadline': 1 }
+    # the original query keeps its options
+    assert TestModel.by_foo.rpc_options['read_policy'] == venom.EVENTUAL
+    
+    # call options override the model's
+    smart_assert(TestModel._get_rpc_options({ 'deadline': 1 }), { 'deadline': 1, 'use_memcache': False }).equals()
+    
+    entity = TestModel(foo='abc').save(deadline=10)
+    assert TestModel.get(entity.key, use_cache=False).foo == 'abc'
+    assert TestModel.get_multi([entity.key], read_policy=venom.EVENTUAL)[0].foo == 'abc'
+    assert len(strong('abc')) == 1
+    
+    with smart_assert.raises(Exception) as context:
+      venom.Query(TestModel.foo == venom.QP, timeout=5)
+    with smart_assert.raises(Exception) as context:
+      TestModel.get(entity.key, consistency=1)
+
+
+class CacheAllTest(BasicTestCase):
+  def test_queries_run_in_memory(self):
+    class Country(venom.Model):
+      cache_all = True
+      
+      code = venom.Properties.String()
+      name = venom.Properties.String(max=100)
+      population = venom.Properties.Integer()
+      anthem = venom.Properties.Text(searchable=True)
+      
+      by_code = venom.Query(code == venom.QP)
+      by_name = venom.Query(name == venom.QP)
+      larger = venom.Query(population > venom.QP)
+      either = venom.Query(venom.OR(code == venom.QP, population < venom.QP), name != venom.QP)
+      by_anthem = venom.Query(anthem == venom.QP)
+    
+    Country.save_multi([
+      Country(code='us', name='United States', population=320),
+      Country(code='fr', name='France', population=66, anthem='allons enfants de la patrie'),
+      Country(code='is', name='Iceland', population=0),
+      Country(code='xx', population=None)
+    ])
+    
+    plan = Country.by_name.explain('France')
+    smart_assert(plan.backend, venom.QueryPlan.MEMORY).equals()
+    smart_assert(plan.estimated_rpcs, 0).equals()
+    
+    # the cache holds Text compressed, full text queries use the search api
+    smart_assert(Country.by_anthem.explain('patrie').backend, venom.QueryPlan.SEARCH).equals()
+    smart_assert([country.code for country in Country.by_anthem('patrie')], ['fr']).equals()
+    
+    smart_assert(Country.by_code('fr').get().name, Country.by_name('France').get().name, 'France').equals()
+    smart_assert(sorted(country.code for country in Country.larger(10)), ['fr', 'us']).equals()
+    smart_assert(sorted(country.code for country in Country.either('us', 10, 'United States')), ['is']).equals()
+    smart_assert(len(Country.all()), 4).equals()
+    
+    # reads its own writes and sees deletes
+    iceland = Country.by_code('is').get()
+    iceland.population = 400
+    iceland.save()
+    smart_assert(sorted(country.code for country in Country.larger(10)), ['fr', 'is', 'us']).equals()
+    Country.by_code('us').get().delete()
+    smart_assert(sorted(country.code for country in Country.larger(10)), ['fr', 'is']).equals()
+  
+  def test_version_stamp(self):
+    class Country(venom.Model):
+      cache_all = True
+      cache_check_interval = 3600
+      
+      code = venom.Properties.String()
+      by_code = venom.Query(code == venom.QP)
+    
+    Country(code='fr').save()
+    assert len(Country.by_code('fr')) == 1
+    
+    # another process' write only bumps the stamp in memcache, this
+    # process notices once its check interval passes
+    cache = Country._kind_cache
+    checked = cache.checked
+    Country(code='de').save()
+    cache.checked = checked
+    assert len(Country.by_code('de')) == 0
+    cache.checked = 0
+    assert len(Country.by_code('de')) == 1
+  
+  def test_result_columns(self):
+    import datetime
+    
+    class Sale(venom.Model):
+      region = venom.Properties.String()
+      amount = venom.Properties.Integer()
+      price = venom.Properties.Float()
+      sold = venom.Properties.DateTime()
+      note = venom.Properties.String()
+    
+    sold = datetime.datetime(2020, 1, 1)
+    for region, amount, price in [('eu', 1, 2.5), ('eu', 3, None), ('us', 5, 1.0)]:
+      Sale(region=region, amount=amount, price=price, sold=sold).save()
+    
+    results = Sale.all()
+    columns = results.to_columns(['amount', 'price', 'sold'], use_numpy=False)
+    smart_assert(columns.keys(), ['amount', 'price', 'sold']).equals()
+    smart_assert(sorted(columns['amount']), [1, 3, 5]).equals()
+    smart_assert(columns['amount'].values.typecode, 'l').equals()
+    smart_assert(columns['price'].nulls, 1).equals()
+    smart_assert(columns['price'].sum(), 3.5).equals()
+    smart_assert(columns['sold'].max(), Sale.sold._to_storage(sold)).equals()
+    
+    smart_assert(results.sum('amount'), 9).equals()
+    smart_assert(results.mean('amount'), 3.0).equals()
+    smart_assert(results.min('price'), 1.0).equals()
+    smart_assert(results.max('amount'), 5).equals()
+    smart_assert(results.histogram('amount', bins=2), ([1, 2], [1.0, 3.0, 5.0])).equals()
+    smart_assert(results.group_by('region', 'amount'), {'eu': 4, 'us': 5}).equals()
+    smart_assert(results.group_by('region', 'price', aggregate='count'), {'eu': 1, 'us': 1}).equals()
+    
+    # raw results read the same columns without creating models
+    raw = Sale.all.raw()
+    assert not isinstance(raw[0], venom.Model)
+    smart_assert(raw.sum('amount'), 9).equals()
+    smart_assert(raw.column('price', use_numpy=False).nulls, 1).equals()
+    smart_assert(raw.group_by('region', 'amount', aggregate='max'), {'eu': 3, 'us': 5}).equals()
+    
+    with smart_assert.raises(Exception) as context:
+      results.to_columns(['note'])
+    with smart_assert.raises(Exception) as context:
+      results.group_by('region', 'amount', aggregate='median')
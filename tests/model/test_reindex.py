@@ -0,0 +1,113 @@
+from helper import smart_assert, BasicTestCase
+import venom
+
+
+class RebuildSearchIndexTest(BasicTestCase):
+  def test_rebuild_restores_documents(self):
+    class Reindexed(venom.Model):
+      name = venom.Properties.String(max=None)
+      n = venom.Properties.Integer()
+      
+      by_name = venom.Query(name == venom.QP)
+    
+    Reindexed.save_multi([Reindexed(name='a' if i % 2 else 'b', n=i) for i in range(20)])
+    index = Reindexed.hybrid_model.index
+    index.delete([document.doc_id for document in index.get_range(ids_only=True)])
+    assert len(Reindexed.by_name('a')) == 0
+    
+    count = venom.rebuild_search_index(Reindexed, shards=3, batch_size=6)
+    smart_assert(count, 20).equals()
+    smart_assert(len(Reindexed.by_name('a')), len(Reindexed.by_name('b')), 10).equals()
+    
+    record = venom.VenomSearchRebuildRecord.get_by_id('Reindexed')
+    assert record.finished != None
+    assert all(key_range['done'] for key_range in record.ranges)
+  
+  def test_rebuild_resumes(self):
+    class Reindexed(venom.Model):
+      name = venom.Properties.String(max=None)
+      
+      by_name = venom.Query(name == venom.QP)
+    
+    Reindexed.save_multi([Reindexed(name='a') for i in range(5)])
+    index = Reindexed.hybrid_model.index
+    index.delete([document.doc_id for document in index.get_range(ids_only=True)])
+    
+    record = venom.VenomSearchRebuildRecord(id='Reindexed', count=0, ranges=[
+      { 'start': None, 'end': None, 'cursor': None, 'done': True }
+    ])
+    record.put()
+    smart_assert(venom.rebuild_search_index(Reindexed), 0).equals()
+    assert len(Reindexed.by_name('a')) == 0
+    
+    smart_assert(venom.rebuild_search_index(Reindexed), 5).equals()
+    assert len(Reindexed.by_name('a')) == 5
+  
+  def test_search_only_cannot_rebuild(self):
+    class Reindexed(venom.Model):
+      name = venom.Properties.String(search_only=True)
+    
+    with smart_assert.raises(Exception) as context:
+      venom.rebuild_search_index(Reindexed)
+
+
+class DeferredSearchIndexingTest(BasicTestCase):
+  def setUp(self):
+    super(DeferredSearchIndexingTest, self).setUp()
+    self.testbed.init_taskqueue_stub()
+    self.taskqueue = self.testbed.get_stub('taskqueue')
+  
+  def test_deferred_indexing(self):
+    class Deferred(venom.Model):
+      search_indexing = 'deferred'
+      
+      name = venom.Properties.String(max=None)
+      
+      by_name = venom.Query(name == venom.QP)
+    
+    first = Deferred(name='a').save()
+    Deferred.save_multi([Deferred(name='a'), Deferred(name='b')])
+    first.name = 'b'
+    first.save()
+    assert len(Deferred.by_name('a')) == 0
+    assert len(Deferred.by_name('b')) == 0
+    
+    # every save in the same bucket shares one named task
+    tasks = self.taskqueue.get_filtered_tasks(queue_names=['default'])
+    assert 1 <= len(tasks) <= 2
+    smart_assert(venom.VenomPendingSearchIndex.query().count(), 3).equals()
+    # markers are written with their entities, keyed by the allocated ids
+    assert venom.VenomPendingSearchIndex.get_by_id('Deferred:{}'.format(first.key)) != None
+    
+    smart_assert(venom.index_pending_search('Deferred'), 3).equals()
+    smart_assert(len(Deferred.by_name('a')), 1).equals()
+    smart_assert(len(Deferred.by_name('b')), 2).equals()
+    smart_assert(venom.VenomPendingSearchIndex.query().count(), 0).equals()
+    # the worker runs again for markers its query could not see yet
+    smart_assert(len(self.taskqueue.get_filtered_tasks(queue_names=['default'])), len(tasks) + 1).equals()
+    smart_assert(venom.index_pending_search('Deferred'), 0).equals()
+    smart_assert(len(self.taskqueue.get_filtered_tasks(queue_names=['default'])), len(tasks) + 1).equals()
+  
+  def test_deferred_indexing_removes_documents(self):
+    class Deferred(venom.Model):
+      search_indexing = 'deferred'
+      
+      name = venom.Properties.String(max=None)
+      
+      by_name = venom.Query(name == venom.QP)
+    
+    entity = Deferred(name='a').save()
+    venom.index_pending_search('Deferred')
+    assert len(Deferred.by_name('a')) == 1
+    
+    entity.name = None
+    entity.save()
+    venom.index_pending_search('Deferred')
+    assert len(Deferred.by_name('a')) == 0
+  
+  def test_deferred_indexing_rejects_search_only(self):
+    with smart_assert.raises(Exception) as context:
+      class Deferred(venom.Model):
+        search_indexing = 'deferred'
+        
+        name = venom.Properties.String(search_only=True)
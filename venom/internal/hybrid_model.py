@@ -4,10 +4,50 @@ from collections import namedtuple
 # app engine imports
 from google.appengine.ext import ndb
 from google.appengine.api import search
+from google.appengine.datastore.datastore_rpc import Configuration
 from google.net.proto.ProtocolBuffer import ProtocolBufferDecodeError
 
+# package imports
+from sharded_index import ShardedIndex
+
 
 __all__ = ['DynamicModel', 'HybridModel', 'MetaHybridModel', 'HybridSearchDocument', 'HybridDatastoreEntity', 'HybridPutManager']
+__all__ += ['EVENTUAL', 'STRONG', 'RPC_OPTIONS', 'validate_rpc_options', 'rpc_options', 'document_id_string']
+
+
+EVENTUAL = Configuration.EVENTUAL_CONSISTENCY
+STRONG = Configuration.STRONG_CONSISTENCY
+
+RPC_OPTIONS = frozenset(('deadline', 'read_policy', 'batch_size', 'prefetch_size', 'use_cache', 'use_memcache'))
+GET_OPTIONS = frozenset(('deadline', 'read_policy', 'use_cache', 'use_memcache'))
+PUT_OPTIONS = frozenset(('deadline', 'use_cache', 'use_memcache'))
+QUERY_OPTIONS = frozenset(('deadline', 'read_policy', 'batch_size', 'prefetch_size'))
+SEARCH_OPTIONS = frozenset(('deadline',))
+
+
+def validate_rpc_options(options):
+  unknown = set(options or {}) - RPC_OPTIONS
+  if unknown:
+    raise Exception(
+      'Unknown rpc options {}, expected any of {}'
+      .format(', '.join(sorted(unknown)), ', '.join(sorted(RPC_OPTIONS)))
+    )
+  return dict(options or {})
+
+
+def rpc_options(options, allowed):
+  """ the options an rpc accepts, unset ones are left to the ndb and search defaults """
+  return {
+    name: value for name, value in (options or {}).items()
+    if name in allowed and value != None
+  }
+
+
+def document_id_string(document_id):
+  """ a document id as a byte string, request values are unicode and may not be ascii """
+  if isinstance(document_id, unicode):
+    return document_id.encode('utf-8')
+  return str(document_id)
 
 
 # TODO try this when the key of it yields nothing from the db
@@ -54,16 +94,17 @@ class HybridSearchDocument(object):
     self._set_document(document)
     if document_id: self.document_id = document_id
   
+  def _field_signature(self, fields):
+    # names repeat for multi-valued fields so compare sorted (name, type, value)
+    return sorted(
+      (field.name, type(field).__name__, field.value)
+      for field in fields
+    )
+  
   def has_diff(self, fields):
     document = self.get_document()
     if not document: return len(fields) != 0
-    provided_fields = { field.name: field for field in fields }
-    document_fields = { field.name: field for field in document.fields }
-    if provided_fields.keys() != document_fields.keys(): return True
-    for key, provided_field in provided_fields.items():
-      document_field = document_fields[key]
-      if not document_field.value == provided_field.value: return True
-    return False
+    return self._field_signature(fields) != self._field_signature(document.fields)
   
   def get_update_document(self, fields):
     if not self.document_id:
@@ -112,8 +153,8 @@ class HybridDatastoreEntity(object):
       if not provided_value == entity_value: return True
     return False
   
-  def get_update_entity(self, properties):
-    entity = self.dynamic_model()
+  def get_update_entity(self, properties, parent=None):
+    entity = self.dynamic_model(parent=parent)
     for ndb_prop, name, value in properties:
       entity.set(name, value, ndb_prop)
     if self.entity_key:
@@ -143,8 +184,12 @@ class HybridDatastoreEntity(object):
 class HybridPutManager(object):
   maximum_search_put = 200
   
-  def __init__(self, hybrid_entities):
+  def __init__(self, hybrid_entities, index_search=True, options=None, datastore_writer=None):
     self.hybrids = []
+    self.index_search = index_search
+    self.options = options
+    # called with the ndb entities and put options in place of ndb.put_multi
+    self.datastore_writer = datastore_writer
     
     if not isinstance(hybrid_entities, list):
       hybrid_entities = [hybrid_entities]
@@ -174,7 +219,7 @@ class HybridPutManager(object):
       hybrids = search_info['hybrids']
       results = []
       for i in range(0, len(documents), self.maximum_search_put):
-        results += index.put(documents[i: i + self.maximum_search_put])
+        results += index.put(documents[i: i + self.maximum_search_put], **rpc_options(self.options, SEARCH_OPTIONS))
       
       for hybrid, document, result in zip(hybrids, documents, results):
         hybrid.register_document(document, result)
@@ -187,14 +232,18 @@ class HybridPutManager(object):
         entities.append(hybrid.get_update_entity())
         saved_hybrids.append(hybrid)
     
-    ndb.put_multi(entities)
+    if self.datastore_writer:
+      self.datastore_writer(entities, rpc_options(self.options, PUT_OPTIONS))
+    else:
+      ndb.put_multi(entities, **rpc_options(self.options, PUT_OPTIONS))
     
     for entity, hybrid in zip(entities, saved_hybrids):
       hybrid.register_entity(entity)
   
   def get_results(self):
     self._put_datastore_entities()
-    self._put_search_documents()
+    if self.index_search:
+      self._put_search_documents()
 
 
 class MetaHybridModel(type):
@@ -211,19 +260,30 @@ class HybridModel(object):
   model = None
   index = None
   
+  # the owner's HybridModel when entities are stored under their owner's key
+  parent = None
+  # documents are hashed across this many indexes when greater than 1
+  search_shards = 1
+  
   # constants
   default_indexed = False
+  scatter_oversampling = 32
   
   @classmethod
   def _init_class(cls):
     cls.kind = cls.__name__
     cls.model = type(cls.kind, (DynamicModel,), {})
-    cls.index = search.Index(name=cls.kind)
+    if cls.search_shards > 1:
+      cls.index = ShardedIndex(cls.kind, cls.search_shards)
+    else:
+      cls.index = search.Index(name=cls.kind)
   
   def __init__(self, entity=None, document=None):
     super(HybridModel, self).__init__()
     self._search_properties = {}
     self._datastore_properties = {}
+    # ancestor of the entity's first put, ignored once the entity has a key
+    self.parent_key = None
     
     document_id = None
     if entity and entity.key:
@@ -253,7 +313,11 @@ class HybridModel(object):
     return None
 
   def _get_document_fields(self):
-    return self._search_properties.values()
+    fields = []
+    for field in self._search_properties.values():
+      if isinstance(field, list): fields.extend(field)
+      else: fields.append(field)
+    return fields
 
   def document_has_diff(self):
     fields = self._get_document_fields()
@@ -272,6 +336,20 @@ class HybridModel(object):
   def register_document(self, document, result):
     return self.search_document.register_update(document, result)
   
+  def get_document_values(self):
+    document = self.search_document.get_document()
+    if not document:
+      return {}
+    values = {}
+    for field in document.fields:
+      if not field.name in values:
+        values[field.name] = field.value
+      elif isinstance(values[field.name], list):
+        values[field.name].append(field.value)
+      else:
+        values[field.name] = [values[field.name], field.value]
+    return values
+  
   def _get_datastore_properties(self):
     return [
       DatastorePropertyContainer(property, name, value)
@@ -284,7 +362,7 @@ class HybridModel(object):
   
   def get_update_entity(self):
     properties = self._get_datastore_properties()
-    return self.datastore_entity.get_update_entity(properties)
+    return self.datastore_entity.get_update_entity(properties, parent=self.parent_key)
   
   def register_entity(self, entity):
     return self.datastore_entity.register_update(entity)
@@ -303,32 +381,62 @@ class HybridModel(object):
     self._datastore_properties[name] = (value, property_instance)
   
   def _set_search_property(self, name, value, field_class):
+    if isinstance(value, list):
+      # multi-valued fields repeat the name once per value
+      self._search_properties[name] = [ field_class(name=name, value=item) for item in value ]
+      return
     field = field_class(name=name, value=value)
     self._search_properties[name] = field
   
   def delete(self):
-    self.index.delete(self.document_id)
-    self.entity_key.delete()
+    self.delete_multi([self.document_id])
   
-  def put(self):
-    self.put_multi([self])
+  @classmethod
+  def delete_multi(cls, document_ids, keys=None):
+    for future in cls.delete_multi_async(document_ids, keys=keys):
+      future.get_result()
   
   @classmethod
-  def put_multi(cls, hybrid_entities):
-    HybridPutManager(hybrid_entities).get_results()
+  def delete_multi_async(cls, document_ids, keys=None, delete_entities=True):
+    """
+    ' Issues the datastore delete and the chunked search deletes together.
+    ' `keys` are extra datastore keys removed in the same batch. Without
+    ' delete_entities the caller already deleted the datastore entities.
+    """
+    document_ids = [ str(document_id) for document_id in document_ids ]
+    entity_keys = [ cls._document_id_to_key(document_id) for document_id in document_ids ] if delete_entities else []
+    futures = ndb.delete_multi_async(entity_keys + (keys or []))
+    maximum_delete = HybridPutManager.maximum_search_put
+    futures += [
+      cls.index.delete_async(document_ids[i: i + maximum_delete])
+      for i in range(0, len(document_ids), maximum_delete)
+    ]
+    return futures
+  
+  def put(self, index_search=True, options=None, datastore_writer=None):
+    self.put_multi([self], index_search=index_search, options=options, datastore_writer=datastore_writer)
+  
+  @classmethod
+  def put_multi(cls, hybrid_entities, index_search=True, options=None, datastore_writer=None):
+    HybridPutManager(
+      hybrid_entities,
+      index_search=index_search,
+      options=options,
+      datastore_writer=datastore_writer
+    ).get_results()
   
   @classmethod
-  def get(cls, entity_key_or_document_id):
-    return cls.get_multi([entity_key_or_document_id])[0]
+  def get(cls, entity_key_or_document_id, options=None):
+    return cls.get_multi([entity_key_or_document_id], options=options)[0]
   
   @classmethod
-  def get_multi(cls, entity_keys_or_document_ids):
+  def get_multi(cls, entity_keys_or_document_ids, options=None):
     to_grab = [
       entity_key_or_document_id if isinstance(entity_key_or_document_id, ndb.Key)
       else cls._document_id_to_key(entity_key_or_document_id)
       for entity_key_or_document_id in entity_keys_or_document_ids
     ]
-    grabbed = ndb.get_multi(to_grab)
+    grabbed = ndb.get_multi(to_grab, **rpc_options(options, GET_OPTIONS))
     return [
       cls(entity=entity) if entity
       else None
@@ -336,26 +444,97 @@ class HybridModel(object):
     ]
 
   @classmethod
-  def query_by_search(cls, query_string):
-    options = search.QueryOptions(ids_only=True)
-    query = search.Query(query_string, options=options)
-    documents = cls.index.search(query)
+  def query_by_search(cls, query_string, ids_only=True, options=None, raw=False):
+    """ hybrids of the matching documents, or with raw their datastore entities only """
+    query_options = search.QueryOptions(ids_only=ids_only or raw)
+    query = search.Query(query_string, options=query_options)
+    documents = list(cls.index.search(query, **rpc_options(options, SEARCH_OPTIONS)))
     keys = [cls._document_id_to_key(document.doc_id) for document in documents]
-    entities = ndb.get_multi(keys)
-    return [ cls(entity=datastore_entity) for datastore_entity in entities ]
+    entities = ndb.get_multi(keys, **rpc_options(options, GET_OPTIONS))
+    if raw:
+      return [ datastore_entity for datastore_entity in entities if datastore_entity ]
+    if ids_only:
+      return [ cls(entity=datastore_entity) for datastore_entity in entities ]
+    return [
+      cls(entity=datastore_entity, document=document)
+      for datastore_entity, document in zip(entities, documents)
+    ]
   
   @classmethod
-  def query_by_datastore(cls, query_component=None):
+  def query_by_datastore(cls, query_component=None, options=None, raw=False):
     query = cls.model.query(query_component) if query_component else cls.model.query()
-    return [ cls(entity=datastore_entity) for datastore_entity in query ]
+    entities = query.iter(**rpc_options(options, QUERY_OPTIONS))
+    if raw:
+      return list(entities)
+    return [ cls(entity=datastore_entity) for datastore_entity in entities ]
+  
+  @classmethod
+  def query_by_ancestor(cls, ancestor, options=None):
+    query = cls.model.query(ancestor=ancestor)
+    return [ cls(entity=datastore_entity) for datastore_entity in query.iter(**rpc_options(options, QUERY_OPTIONS)) ]
+  
+  @classmethod
+  def allocate_keys(cls, ndb_entities):
+    """ completes the keys of entities that were never put, so their document ids are known before the put """
+    by_parent = {}
+    for entity in ndb_entities:
+      if not entity.key or not entity.key.id():
+        parent = entity.key.parent() if entity.key else None
+        by_parent.setdefault(parent, []).append(entity)
+    for parent, entities in by_parent.items():
+      first, _ = cls.model.allocate_ids(size=len(entities), parent=parent)
+      for offset, entity in enumerate(entities):
+        entity.key = ndb.Key(cls.kind, first + offset, parent=parent)
+  
+  @classmethod
+  def split_key_ranges(cls, shards):
+    """
+    ' Splits the kind into at most `shards` contiguous (start, end) key
+    ' ranges using the datastore's __scatter__ samples. None marks an open
+    ' bound, so a kind too small to sample is a single (None, None) range.
+    """
+    if shards <= 1:
+      return [(None, None)]
+    query = cls.model.query().order(ndb.GenericProperty('__scatter__'))
+    sample = sorted(query.fetch(shards * cls.scatter_oversampling, keys_only=True))
+    if not sample:
+      return [(None, None)]
+    step = len(sample) / float(shards)
+    splits = sorted(set(sample[int(step * i)] for i in range(1, shards)))
+    bounds = [None] + splits + [None]
+    return zip(bounds[:-1], bounds[1:])
+  
+  @classmethod
+  def query_key_range(cls, start=None, end=None, batch_size=100, cursor=None):
+    """ one page of the key range [start, end) in key order """
+    query = cls.model.query()
+    if start: query = query.filter(cls.model.key >= start)
+    if end: query = query.filter(cls.model.key < end)
+    query = query.order(cls.model.key)
+    datastore_entities, next_cursor, more = query.fetch_page(batch_size, start_cursor=cursor)
+    hybrids = [ cls(entity=datastore_entity) for datastore_entity in datastore_entities ]
+    return hybrids, next_cursor, more
   
   @classmethod
   def _key_to_document_id(cls, key):
+    if cls.parent and key.parent():
+      # the owner's document id prefixes the child's, '{owner}.{child}'
+      return '{}.{}'.format(cls.parent._key_to_document_id(key.parent()), key.id())
     return str(key.id())
   
+  @classmethod
+  def is_document_id(cls, document_id):
+    """ whether `document_id` can name an entity of this kind """
+    return cls._document_id_to_key(document_id).id() != 'no_entity'
+  
   @classmethod
   def _document_id_to_key(cls, document_id):
     try:
+      if cls.parent:
+        parent_id, _, entity_id = str(document_id).rpartition('.')
+        if parent_id:
+          return ndb.Key(cls.kind, int(entity_id), parent=cls.parent._document_id_to_key(parent_id))
+        # a plain id was stored before the model keyed entities under their owner
       return ndb.Key(cls.kind, int(document_id))
     except ValueError:
       return ndb.Key(cls.kind, 'no_entity')
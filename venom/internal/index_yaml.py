@@ -199,10 +199,12 @@ class IndexGenerator(object):
     self._insert_schema(schema)
 
   def _get_properties_from_schema(self, schema):
+    # queries may filter on shadows (eg. username__prefixes) instead of the property
     return [
-      { 'name': name }
+      { 'name': stored_name }
       for name, prop_schema in schema.items()
       if prop_schema.datastore and prop_schema.indexed_datastore
+      for stored_name in sorted(prop_schema.datastore_names or [name])
     ]
 
   def _update_schema(self, schema):
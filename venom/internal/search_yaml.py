@@ -1,6 +1,9 @@
 # system imports
 import os
 
+# app engine imports
+from google.appengine.api import search
+
 # package imports
 from builtin_file import bfile
 from index_yaml import IndexYaml, IndexYamlFromFile, IndexGenerator
@@ -8,6 +11,23 @@ from index_yaml import IndexYaml, IndexYamlFromFile, IndexGenerator
 
 __all__  = ['VenomIndexGenerator', 'VenomYamlFromFile']
 __all__ += ['update_search_yaml', 'load_search_schema', 'read_search_yaml']
+__all__ += ['search_field_type']
+
+
+search_field_types = {
+  search.TextField: 'text',
+  search.HtmlField: 'html',
+  search.AtomField: 'atom',
+  search.NumberField: 'number',
+  search.DateField: 'date',
+  search.GeoField: 'geo'
+}
+
+
+def search_field_type(field_class):
+  if not field_class in search_field_types:
+    raise Exception('Unknown search field {}'.format(field_class))
+  return search_field_types[field_class]
 
 
 def read_search_yaml():
@@ -49,6 +69,20 @@ class VenomYamlFromFile(IndexYamlFromFile):
 # If you want to manage some indexes manually, move them above the marker line.
 # The search.yaml file is automatically uploaded to the admin console when
 # you next deploy your application using appcfg.py.\n"""
+  
+  def _validate_model(self, model):
+    super(VenomYamlFromFile, self)._validate_model(model)
+    if 'shards' in model:
+      if not isinstance(model['shards'], int) or model['shards'] < 2:
+        raise Exception('Invalid Search YAML: "shards" variable must be an integer greater than 1')
+  
+  def _validate_property(self, prop):
+    super(VenomYamlFromFile, self)._validate_property(prop)
+    if 'type' in prop:
+      if not isinstance(prop['type'], str):
+        raise Exception('Invalid Search YAML: "type" variable must be a string')
+      if not prop['type'] in search_field_types.values():
+        raise Exception('Invalid Search YAML: unknown "type" variable {!r}'.format(prop['type']))
 
 
 class VenomIndexGenerator(IndexGenerator):
@@ -56,7 +90,23 @@ class VenomIndexGenerator(IndexGenerator):
   
   def _get_properties_from_schema(self, schema):
     return [
-      { 'name': name }
+      { 'name': name, 'type': search_field_type(prop_schema.search_field) }
       for name, prop_schema in schema.items()
       if prop_schema.search
     ]
+  
+  def _set_shards(self, schema):
+    model = self.index[schema._model.kind]
+    shards = schema._model.search_shards
+    if shards > 1:
+      model['shards'] = shards
+    elif 'shards' in model:
+      del model['shards']
+  
+  def _update_schema(self, schema):
+    super(VenomIndexGenerator, self)._update_schema(schema)
+    self._set_shards(schema)
+  
+  def _insert_schema(self, schema):
+    super(VenomIndexGenerator, self)._insert_schema(schema)
+    self._set_shards(schema)
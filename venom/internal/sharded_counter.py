@@ -0,0 +1,82 @@
+# system imports
+import random
+
+# app engine imports
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+
+__all__ = ['VenomCounterShard', 'ShardedCounter']
+
+
+class VenomCounterShard(ndb.Model):
+  count = ndb.IntegerProperty(default=0, indexed=False)
+
+
+class ShardedCounter(object):
+  """
+  ' A counter whose increments are spread across a fixed number of
+  ' shard entities so concurrent writers rarely contend on the same
+  ' entity group. The total is the sum of all shards and is cached in
+  ' memcache for a short time.
+  '
+  ' A reader recomputing the total first caches a placeholder and only
+  ' replaces it by compare and set. Increments delete the cached value
+  ' once their shard committed, so a total read before that commit is
+  ' never cached past it.
+  """
+  
+  cache_time = 60
+  # cached while a reader sums the shards
+  computing = 'computing'
+  
+  def __init__(self, name, shards):
+    self.name = name
+    self.shards = shards
+  
+  @property
+  def cache_key(self):
+    return 'venom-counter:{}'.format(self.name)
+  
+  def _shard_key(self, index):
+    return ndb.Key(VenomCounterShard, '{}:{}'.format(self.name, index))
+  
+  def shard_keys(self):
+    return [ self._shard_key(index) for index in range(self.shards) ]
+  
+  def get(self):
+    client = memcache.Client()
+    cached = client.gets(self.cache_key)
+    if cached == None:
+      client.add(self.cache_key, self.computing, time=self.cache_time)
+      cached = client.gets(self.cache_key)
+    if cached != None and cached != self.computing:
+      return cached
+    total = self._sum_shards()
+    if cached == self.computing:
+      # fails when an increment deleted the placeholder meanwhile
+      client.cas(self.cache_key, total, time=self.cache_time)
+    return total
+  
+  def _sum_shards(self):
+    shards = ndb.get_multi(self.shard_keys())
+    return sum(shard.count for shard in shards if shard)
+  
+  def increment(self, delta=1):
+    return self.increment_async(delta=delta).get_result()
+  
+  @ndb.tasklet
+  def increment_async(self, delta=1):
+    key = self._shard_key(random.randint(0, self.shards - 1))
+    yield self._increment_shard_async(key, delta)
+    # an incr could count the delta twice if the total was summed after
+    # the commit, and would fail on the placeholder of a pending sum
+    memcache.delete(self.cache_key)
+  
+  @ndb.transactional_tasklet
+  def _increment_shard_async(self, key, delta):
+    shard = yield key.get_async()
+    if not shard:
+      shard = VenomCounterShard(key=key)
+    shard.count += delta
+    yield shard.put_async()
@@ -0,0 +1,128 @@
+# system imports
+import zlib
+
+# app engine imports
+from google.appengine.api import search
+
+
+__all__ = ['ShardedIndex', 'ShardedFuture']
+
+
+class ShardedFuture(object):
+  """ combines the per shard futures of one call back into the caller's order """
+  
+  def __init__(self, futures, combine):
+    self.futures = futures
+    self.combine = combine
+  
+  def get_result(self):
+    return self.combine([ future.get_result() for future in self.futures ])
+
+
+class ShardedIndex(object):
+  """
+  ' Spreads the documents of a kind over `shards` search indexes named
+  ' '{name}-{shards}-{shard}' so puts are not limited by the throughput of
+  ' a single index. The shard count is part of the name, so changing it
+  ' starts from empty indexes instead of leaving documents in the shards
+  ' they were routed to before, and the kind has to be reindexed. Documents are routed by a hash of their id, which they must
+  ' have. Searches run on every shard concurrently and the results are
+  ' merged by their sort scores, in the direction of the query's sort
+  ' expressions.
+  """
+  
+  def __init__(self, name, shards):
+    if shards < 2:
+      raise Exception('ShardedIndex {} requires at least 2 shards, got {}'.format(name, shards))
+    self.name = name
+    self.shards = shards
+    self.indexes = [
+      search.Index(name='{}-{}-{}'.format(name, shards, shard))
+      for shard in range(shards)
+    ]
+  
+  def _shard(self, document_id):
+    if not document_id:
+      raise Exception('Documents in the sharded index {} require a doc_id'.format(self.name))
+    return (zlib.crc32(str(document_id)) & 0xffffffff) % self.shards
+  
+  def _group(self, items, document_id):
+    """ { shard: [(position, item)] } """
+    groups = {}
+    for position, item in enumerate(items):
+      groups.setdefault(self._shard(document_id(item)), []).append((position, item))
+    return groups
+  
+  def _ordered(self, groups, results):
+    ordered = [None] * sum(len(group) for group in groups)
+    for group, group_results in zip(groups, results):
+      for (position, _), result in zip(group, group_results):
+        ordered[position] = result
+    return ordered
+  
+  def get(self, document_id, deadline=None):
+    return self.indexes[self._shard(document_id)].get(document_id, deadline=deadline)
+  
+  def put_async(self, documents, deadline=None):
+    if not isinstance(documents, list):
+      documents = [documents]
+    groups = self._group(documents, lambda document: document.doc_id).items()
+    futures = [
+      self.indexes[shard].put_async([ document for _, document in group ], deadline=deadline)
+      for shard, group in groups
+    ]
+    return ShardedFuture(futures, lambda results: self._ordered([ group for _, group in groups ], results))
+  
+  def put(self, documents, deadline=None):
+    return self.put_async(documents, deadline=deadline).get_result()
+  
+  def delete_async(self, document_ids, deadline=None):
+    if not isinstance(document_ids, list):
+      document_ids = [document_ids]
+    groups = self._group(document_ids, lambda document_id: document_id).items()
+    futures = [
+      self.indexes[shard].delete_async([ document_id for _, document_id in group ], deadline=deadline)
+      for shard, group in groups
+    ]
+    return ShardedFuture(futures, lambda results: self._ordered([ group for _, group in groups ], results))
+  
+  def delete(self, document_ids, deadline=None):
+    return self.delete_async(document_ids, deadline=deadline).get_result()
+  
+  def _compare(self, expressions):
+    def compare(a, b):
+      a_scores = list(a.sort_scores or [])
+      b_scores = list(b.sort_scores or [])
+      for i in range(max(len(a_scores), len(b_scores))):
+        result = cmp(a_scores[i: i + 1], b_scores[i: i + 1])
+        expression = expressions[i] if i < len(expressions) else None
+        # scores without an expression come from a scorer, best first
+        if not expression or expression.direction == search.SortExpression.DESCENDING:
+          result = -result
+        if result:
+          return result
+      return -cmp(a.rank, b.rank)
+    return compare
+  
+  def search_async(self, query, deadline=None):
+    if isinstance(query, basestring):
+      query = search.Query(query)
+    futures = [ index.search_async(query, deadline=deadline) for index in self.indexes ]
+    options = query.options
+    sort_options = options.sort_options if options else None
+    expressions = list(sort_options.expressions or []) if sort_options else []
+    limit = options.limit if options and options.limit else 20
+    
+    def merge(results):
+      documents = []
+      for result in results:
+        documents.extend(result.results)
+      documents.sort(cmp=self._compare(expressions))
+      return search.SearchResults(
+        number_found=sum(result.number_found for result in results),
+        results=documents[:limit]
+      )
+    return ShardedFuture(futures, merge)
+  
+  def search(self, query, deadline=None):
+    return self.search_async(query, deadline=deadline).get_result()
@@ -1,12 +1,15 @@
 # system imports
 import datetime
+import inspect
 import time
+import zlib
 
 # app engine imports
 from google.appengine.ext import ndb
 from google.appengine.api import search
 
 # package imports
+from ..internal.sharded_counter import ShardedCounter
 from attribute import ModelAttribute
 from query import PropertyComparison, Query, QueryParameter
 from ..routing import Parameters
@@ -14,7 +17,8 @@ from ..routing import Parameters
 
 __all__  = [
   'Property', 'ChoicesProperty', 'Integer', 'Float', 'String',
-  'Password', 'UUID', 'Model',
+  'Password', 'Text', 'UUID', 'Model', 'Counter', 'List', 'Embedded',
+  'ModelSnapshot', 'refresh_snapshots',
   'InvalidPropertyComparison', 'PropertyValidationFailed'
 ]
 
@@ -30,12 +34,22 @@ class Property(ModelAttribute):
   allowed_operators = frozenset()
   allowed_types = frozenset()
   
-  def __init__(self, required=False, hidden=False, unique=False):
+  # whether stored values are json serializable and can live in a packed blob
+  packable = True
+  # whether values are written to the entity at all
+  stored = True
+  
+  def __init__(self, required=False, hidden=False, unique=False, search_only=False, write_back=None):
     super(Property, self).__init__()
     self.required = required
     self.hidden = hidden
     self.unique = unique
+    self.search_only = search_only
+    # seconds values written through buffer() may wait in memcache before being saved
+    self.write_back = write_back
     self._code_name = 'Property'
+    if write_back and (unique or search_only):
+      raise Exception('write_back properties are saved late, they cannot be unique or search_only')
   
   def __equals__(self, value):
     cls = self.__class__
@@ -97,7 +111,8 @@ class Property(ModelAttribute):
           .format(self._code_name, value)
         )
   
-  def to_search_field(self):
+  def to_search_field(self, operators=None):
+    """ operators holds every comparison the model's search queries make on this property """
     raise NotImplementedError()
   
   def to_datastore_property(self):
@@ -106,6 +121,17 @@ class Property(ModelAttribute):
   def to_route_parameter(self):
     raise NotImplementedError()
   
+  def _get_delete_keys(self, kind, document_id):
+    """ datastore keys and memcache keys this property owns outside the entity """
+    return [], []
+  
+  def _get_shadow_values(self, entity):
+    """ extra (name, value, ndb property) written next to this property """
+    return []
+  
+  def _load_shadow_values(self, entity, values):
+    pass
+  
   def __get__(self, instance, cls):
     if instance == None:
       # called on a class
@@ -117,17 +143,43 @@ class Property(ModelAttribute):
   
   def _set_value(self, entity, value):
     self.validate(entity, value)
+    self._discard_deferred(entity)
     entity._values[self._name] = value
+    if self.write_back and hasattr(entity, '_write_back_assigned'):
+      entity._write_back_assigned.add(self._name)
+  
+  def buffer(self, entity, value):
+    """
+    ' Sets a write_back property without saving the entity. The value is
+    ' kept in memcache, merged into reads and saved by flush_write_back.
+    ' If memcache refuses the value the entity is saved right away.
+    """
+    if not self.write_back:
+      raise PropertyValidationFailed('{} is not a write_back property'.format(self._code_name))
+    if not entity.key:
+      raise PropertyValidationFailed(
+        '{} can only be buffered once the entity has been saved'
+        .format(self._code_name)
+      )
+    self.validate(entity, value)
+    self._discard_deferred(entity)
+    entity._values[self._name] = value
+    if not entity._write_back.record(entity.key, { self._name: self._to_storage(value) }):
+      entity.save()
+    return entity
   
   def _get_value(self, entity):
+    self._load_deferred(entity)
     if not self._name in entity._values:
       return None
     return entity._values[self._name]
   
   def _set_stored_value(self, entity, value):
+    self._discard_deferred(entity)
     entity._values[self._name] = self._from_storage(value)
   
   def _get_stored_value(self, entity):
+    self._load_deferred(entity)
     if not self._name in entity._values:
       value = None
     else:
@@ -140,9 +192,43 @@ class Property(ModelAttribute):
   def _from_storage(self, value):
     return value
   
+  def _load_deferred(self, entity):
+    """ values such as search only properties are loaded on first access """
+    loaders = getattr(entity, '_deferred_loaders', None)
+    if loaders and self._name in loaders:
+      entity._load_deferred_values(self._name)
+  
+  def _discard_deferred(self, entity):
+    loaders = getattr(entity, '_deferred_loaders', None)
+    if loaders:
+      loaders.pop(self._name, None)
+  
   def query_uses_datastore(self, operator, value):
     raise NotImplementedError()
   
+  def query_search_reason(self, operator, value):
+    return "{} does not support '{}' comparisons on the datastore".format(self._code_name, operator)
+  
+  def _query_operator(self, operator):
+    return operator
+  
+  def _query_name(self, operator):
+    return self._name
+  
+  def _to_search(self, value):
+    """ the search field value of a stored value """
+    return value
+  
+  def _get_search_shadow_values(self, value):
+    """ extra (name, search value) fields written next to this property's search field """
+    return []
+  
+  def _to_query_value(self, operator, value):
+    """ the stored form of a value compared against in a query """
+    if operator == PropertyComparison.IN:
+      return [ self._to_storage(item) for item in value ]
+    return self._to_storage(value)
+  
   def _handle_comparison(self, operator, value):
     if not operator in self.allowed_operators:
       raise InvalidPropertyComparison('Property does not support {} comparisons'.format(operator))
@@ -171,8 +257,8 @@ class Property(ModelAttribute):
 
 
 class ChoicesProperty(Property):
-  def __init__(self, required=False, choices=None, hidden=False, unique=False):
-    super(ChoicesProperty, self).__init__(required=required, hidden=hidden, unique=unique)
+  def __init__(self, required=False, choices=None, hidden=False, unique=False, search_only=False, write_back=None):
+    super(ChoicesProperty, self).__init__(required=required, hidden=hidden, unique=unique, search_only=search_only, write_back=write_back)
     self.choices = choices
   
   def validate(self, entity, value):
@@ -192,8 +278,8 @@ class Integer(ChoicesProperty):
   allowed_operators = PropertyComparison.allowed_operators
   allowed_types = frozenset({int})
   
-  def __init__(self, required=False, choices=None, min=None, max=None, hidden=False, unique=False):
-    super(Integer, self).__init__(required=required, choices=choices, hidden=hidden, unique=unique)
+  def __init__(self, required=False, choices=None, min=None, max=None, hidden=False, unique=False, search_only=False, write_back=None):
+    super(Integer, self).__init__(required=required, choices=choices, hidden=hidden, unique=unique, search_only=search_only, write_back=write_back)
     self.min = min
     self.max = max
     
@@ -227,7 +313,7 @@ class Integer(ChoicesProperty):
   def query_uses_datastore(self, operator, value):
     return True
         
-  def to_search_field(self):
+  def to_search_field(self, operators=None):
     return search.NumberField
   
   def to_datastore_property(self):
@@ -271,11 +357,89 @@ class String(ChoicesProperty):
   allowed_operators = PropertyComparison.allowed_operators
   allowed_types = [str, unicode]
   
-  def __init__(self, required=False, choices=None, min=None, max=500, characters=None, hidden=False, unique=False):
-    super(String, self).__init__(required=required, choices=choices, hidden=hidden, unique=unique)
+  # comparisons that only need exact matches and can use search.AtomField
+  atom_operators = frozenset((PropertyComparison.EQ, PropertyComparison.NE))
+  
+  # longest prefix a prefix_index=True property can be queried with
+  prefix_length = 20
+  
+  def __init__(self, required=False, choices=None, min=None, max=500, characters=None, hidden=False, unique=False, search_only=False, prefix_index=False, case_insensitive=False, write_back=None):
+    super(String, self).__init__(required=required, choices=choices, hidden=hidden, unique=unique, search_only=search_only, write_back=write_back)
     self.min = min
     self.max = max
     self.characters = characters
+    self.prefix_index = prefix_index
+    self.case_insensitive = case_insensitive
+    if (prefix_index or case_insensitive) and search_only:
+      raise Exception('String prefix_index and case_insensitive lookups are datastore indexes, they cannot be search_only')
+  
+  @property
+  def _lower_name(self):
+    return '{}__lower'.format(self._name)
+  
+  @property
+  def _prefixes_name(self):
+    return '{}__prefixes'.format(self._name)
+  
+  def _normalize(self, value):
+    if value == None or not self.case_insensitive:
+      return value
+    return value.lower()
+  
+  def _get_shadow_values(self, entity):
+    shadows = []
+    value = self._get_stored_value(entity)
+    if self.case_insensitive:
+      lower = self._normalize(value)
+      if lower != None and len(lower.encode('utf-8') if isinstance(lower, unicode) else lower) > 1500:
+        raise PropertyValidationFailed(
+          '{} is case_insensitive, its lowered value is an indexed datastore string limited to 1500 bytes'
+          .format(self._code_name)
+        )
+      shadows.append((self._lower_name, lower, ndb.StringProperty(indexed=True)))
+    if self.prefix_index:
+      normalized = self._normalize(value) or ''
+      prefixes = [ normalized[:length] for length in range(1, min(len(normalized), self.prefix_length) + 1) ]
+      shadows.append((self._prefixes_name, prefixes, ndb.StringProperty(indexed=True, repeated=True)))
+    return shadows
+  
+  def _get_search_shadow_values(self, value):
+    if not self.case_insensitive:
+      return []
+    return [(self._lower_name, self._normalize(value))]
+  
+  def startswith(self, value):
+    if not self.prefix_index:
+      raise InvalidPropertyComparison('{} requires prefix_index=True for startswith comparisons'.format(self._code_name))
+    return self._handle_comparison(PropertyComparison.PREFIX, value)
+  
+  def _query_operator(self, operator):
+    # a prefix is an equality filter on the repeated prefixes shadow
+    if operator == PropertyComparison.PREFIX:
+      return PropertyComparison.EQ
+    return operator
+  
+  def _query_name(self, operator):
+    if operator == PropertyComparison.PREFIX:
+      return self._prefixes_name
+    if self.case_insensitive and operator in self.atom_operators | {PropertyComparison.IN}:
+      return self._lower_name
+    return self._name
+  
+  def _to_query_value(self, operator, value):
+    value = super(String, self)._to_query_value(operator, value)
+    if operator == PropertyComparison.PREFIX:
+      if value and len(value) > self.prefix_length:
+        raise InvalidPropertyComparison(
+          '{}.startswith() supports prefixes of at most {} characters, got {!r}'
+          .format(self._code_name, self.prefix_length, value)
+        )
+      return self._normalize(value)
+    if self.case_insensitive and operator == PropertyComparison.IN:
+      return [ self._normalize(item) for item in value ]
+    if self.case_insensitive and operator in self.atom_operators:
+      return self._normalize(value)
+    return value
   
   def _to_storage(self, value):
     if value == None:
@@ -320,9 +484,26 @@ class String(ChoicesProperty):
       )
 
   def query_uses_datastore(self, operator, value):
+    if operator == PropertyComparison.PREFIX:
+      return True
+    # the lowered shadow is indexed whatever the max
+    if self.case_insensitive and operator in self.atom_operators | {PropertyComparison.IN}:
+      return True
     return self.max != None and self.max <= 500
   
-  def to_search_field(self):
+  def query_search_reason(self, operator, value):
+    if self.max == None:
+      return '{} has no String max'.format(self._code_name)
+    return '{} has String max > 500'.format(self._code_name)
+  
+  def to_search_field(self, operators=None):
+    if self.choices != None:
+      return search.AtomField
+    # the search api rejects atom values longer than 500 characters
+    if self.max == None or self.max > 500:
+      return search.TextField
+    if operators and operators <= self.atom_operators:
+      return search.AtomField
     return search.TextField
   
   def to_datastore_property(self):
@@ -369,6 +550,7 @@ class Password(String):
   
   def _set_value(self, entity, value):
     self.validate(entity, value)
+    self._discard_deferred(entity)
     entity._values[self._name] = self._hash(value)
 
   def _get_stored_value(self, entity):
@@ -378,31 +560,234 @@ class Password(String):
     return self._hash(value)
 
 
+class CompressedText(object):
+  """ a Text value as loaded from the datastore, decompressed on first access """
+  
+  def __init__(self, blob):
+    self.blob = blob
+  
+  def decompress(self):
+    return zlib.decompress(self.blob).decode('utf-8')
+
+
+class Text(Property):
+  """
+  ' Large text stored as a zlib compressed, unindexed blob. It is never
+  ' written to the search api unless searchable is set, and loaded values
+  ' are only decompressed when the property is read. Saving an entity
+  ' whose text was not read writes the loaded blob back unchanged.
+  """
+  
+  allowed_types = [str, unicode]
+  # compressed bytes are not json serializable
+  packable = False
+  
+  def __init__(self, required=False, hidden=False, searchable=False, level=6):
+    super(Text, self).__init__(required=required, hidden=hidden)
+    self.searchable = searchable
+    self.level = level
+    self.allowed_operators = frozenset({ PropertyComparison.EQ }) if searchable else frozenset()
+  
+  def _get_value(self, entity):
+    value = super(Text, self)._get_value(entity)
+    if isinstance(value, CompressedText):
+      value = value.decompress()
+      entity._values[self._name] = value
+    return value
+  
+  def _to_storage(self, value):
+    if value == None:
+      return None
+    if isinstance(value, CompressedText):
+      return value.blob
+    if isinstance(value, unicode):
+      value = value.encode('utf-8')
+    return zlib.compress(value, self.level)
+  
+  def _from_storage(self, value):
+    if value == None or isinstance(value, CompressedText):
+      return value
+    return CompressedText(value)
+  
+  def _to_search(self, value):
+    if value == None:
+      return None
+    return zlib.decompress(value).decode('utf-8')
+  
+  def _to_query_value(self, operator, value):
+    # only the search api compares text, against the uncompressed value
+    return value
+  
+  def query_uses_datastore(self, operator, value):
+    return False
+  
+  def query_search_reason(self, operator, value):
+    return '{} is Text, which is not indexed in the datastore'.format(self._code_name)
+  
+  def to_search_field(self, operators=None):
+    return search.TextField
+  
+  def to_datastore_property(self):
+    return ndb.BlobProperty
+  
+  def to_route_parameter(self):
+    return Parameters.String(required=self.required)
+
+
+class ModelSnapshot(object):
+  """
+  ' Copies of a few fields of a referenced entity, stored on the entity
+  ' that references it. Embedded fields and key are served without an
+  ' RPC, any other attribute fetches the referenced entity once.
+  """
+  
+  def __init__(self, model, key, values):
+    self._model = model
+    self._entity = None
+    self.key = key
+    self.values = values
+  
+  def get(self):
+    if self._entity == None:
+      self._entity = self._model.get(self.key)
+    return self._entity
+  
+  def __getattr__(self, name):
+    if name.startswith('_'):
+      raise AttributeError(name)
+    values = self.__dict__.get('values', {})
+    if name in values:
+      return self._from_storage(name, values[name])
+    return getattr(self.get(), name)
+  
+  def _from_storage(self, name, value):
+    # snapshots hold stored values, reads match the referenced entity's
+    return self._model._properties[name]._from_storage(value)
+  
+  def __json__(self):
+    json = {
+      name: self._from_storage(name, value)
+      for name, value in self.values.items()
+    }
+    json['key'] = self.key
+    return json
+  
+  def __repr__(self):
+    return 'ModelSnapshot({}, key={!r}, values={!r})'.format(self._model.__name__, self.key, self.values)
+
+
+def refresh_snapshots(kind, name, document_ids, batch_size=200):
+  """
+  ' Task entry point for Properties.Model(refresh=True). Rewrites the
+  ' snapshots of every `kind` entity whose `name` references one of
+  ' `document_ids`, skipping entities whose snapshot is already current.
+  """
+  from model import Model as VenomModel
+  model = VenomModel.kinds[kind]
+  prop = model._properties[name]
+  referenced = [entity for entity in prop.model.get_multi(document_ids) if entity]
+  for entity in referenced:
+    snapshot = prop._snapshot_values(entity)
+    query = model.hybrid_model.model.query(ndb.GenericProperty(name) == entity.key)
+    cursor = None
+    while True:
+      ndb_entities, cursor, more = query.fetch_page(batch_size, start_cursor=cursor)
+      changed = []
+      for ndb_entity in ndb_entities:
+        child = model._entity_to_model(model.hybrid_model(entity=ndb_entity))
+        current = child._values.get(prop._shadow_name)
+        if not current or current.get('values') != snapshot:
+          child._values[name] = entity
+          changed.append(child)
+      if changed:
+        model.save_multi(changed)
+      if not more or not cursor:
+        break
+
+
 class Model(Property):
   allowed_operators = frozenset({
     PropertyComparison.EQ
   })
   
-  def __init__(self, model, required=False, hidden=False, unique=False):
-    super(Model, self).__init__(required=required, hidden=hidden, unique=unique)
+  def __init__(self, model, required=False, hidden=False, unique=False, search_only=False, embed=None, refresh=False):
+    super(Model, self).__init__(required=required, hidden=hidden, unique=unique, search_only=search_only)
     self.model = model
+    self.embed = list(embed) if embed else []
+    self.refresh = refresh
+    for field in self.embed:
+      prop = model._properties.get(field)
+      if not prop or not prop.stored or not prop.packable or prop.search_only:
+        raise Exception(
+          '{}.{} cannot be embedded in a reference, it must be a stored datastore property'
+          .format(model.__name__, field)
+        )
+  
+  @property
+  def _shadow_name(self):
+    return '{}__embed'.format(self._name)
+  
+  def _connect(self, entity=None, name=None, model=None):
+    super(Model, self)._connect(entity=entity, name=name, model=model)
+    if model and self.embed and self.refresh:
+      # the reference must be indexed for the refresh job to find it
+      setattr(model, '_snapshot_{}'.format(name), Query(self == QueryParameter))
+      self.model._snapshot_references.append((model, name))
+
+  def _needs_get(self, entity):
+    """ whether reading the reference of entity requires a get of the referenced entity """
+    value = entity._values.get(self._name)
+    if not value or isinstance(value, (self.model, ModelSnapshot)):
+      return False
+    snapshot = entity._values.get(self._shadow_name) if self.embed else None
+    return not (snapshot and snapshot.get('key') == value)
 
   def _get_value(self, entity):
     value = super(Model, self)._get_value(entity)
-    if value and not isinstance(value, self.model):
-      value = self.model.get(value)
+    if value and not isinstance(value, (self.model, ModelSnapshot)):
+      if self._needs_get(entity):
+        value = self.model.get(value)
+      else:
+        value = ModelSnapshot(self.model, value, entity._values[self._shadow_name]['values'])
     entity._values[self._name] = value
     return value
 
   def _to_storage(self, value):
     if value == None:
       return None
-    if isinstance(value, self.model):
+    if isinstance(value, (self.model, ModelSnapshot)):
       return value.key
     return value
   
-  def to_search_field(self):
-    return search.TextField
+  def _snapshot_values(self, referenced):
+    return {
+      field: referenced._properties[field]._get_stored_value(referenced)
+      for field in self.embed
+    }
+  
+  def _get_shadow_values(self, entity):
+    if not self.embed:
+      return []
+    value = entity._values.get(self._name)
+    key = self._to_storage(value)
+    if key == None:
+      return [(self._shadow_name, None, ndb.JsonProperty(indexed=False))]
+    snapshot = entity._values.get(self._shadow_name)
+    if isinstance(value, self.model):
+      snapshot = { 'key': key, 'values': self._snapshot_values(value) }
+    elif not snapshot or snapshot.get('key') != key:
+      # set by key, the referenced entity is read once to copy its fields
+      referenced = self.model.get(key)
+      snapshot = { 'key': key, 'values': self._snapshot_values(referenced) } if referenced else None
+    entity._values[self._shadow_name] = snapshot
+    return [(self._shadow_name, snapshot, ndb.JsonProperty(indexed=False))]
+  
+  def _load_shadow_values(self, entity, values):
+    if self.embed and values.get(self._shadow_name):
+      entity._values[self._shadow_name] = values[self._shadow_name]
+  
+  def to_search_field(self, operators=None):
+    return search.AtomField
   
   def to_datastore_property(self):
     return ndb.StringProperty
@@ -417,8 +802,8 @@ class Model(Property):
 class DateTime(Float):
   allowed_types = frozenset({datetime.datetime})
   
-  def __init__(self, required=False, choices=None, min=None, max=None, hidden=False, unique=False, set_on_creation=False, set_on_update=False):
-    super(Float, self).__init__(required=required, choices=choices, hidden=hidden, unique=unique, min=min, max=max)
+  def __init__(self, required=False, choices=None, min=None, max=None, hidden=False, unique=False, search_only=False, set_on_creation=False, set_on_update=False, write_back=None):
+    super(Float, self).__init__(required=required, choices=choices, hidden=hidden, unique=unique, search_only=search_only, min=min, max=max, write_back=write_back)
     self.set_on_creation = set_on_creation
     self.set_on_update = set_on_update
   
@@ -440,3 +825,284 @@ class DateTime(Float):
     
     if self.set_on_update:
       self._set_value(entity, datetime.datetime.now())
+
+
+class Counter(Property):
+  """
+  ' An integer total whose increments are spread across `shards`
+  ' separate entities. Counters are not written with the entity and
+  ' can only be changed through increment/increment_async.
+  """
+  
+  stored = False
+  
+  def __init__(self, shards=20, hidden=False):
+    super(Counter, self).__init__(hidden=hidden)
+    self.shards = shards
+  
+  def _counter(self, entity):
+    if not entity.key:
+      raise PropertyValidationFailed(
+        '{} can only be incremented once the entity has been saved'
+        .format(self._code_name)
+      )
+    return self._counter_for(entity.kind, entity.key)
+  
+  def _counter_for(self, kind, document_id):
+    name = '{}:{}:{}'.format(kind, document_id, self._name)
+    return ShardedCounter(name, self.shards)
+  
+  def _get_delete_keys(self, kind, document_id):
+    counter = self._counter_for(kind, document_id)
+    return counter.shard_keys(), [counter.cache_key]
+  
+  def increment(self, entity, delta=1):
+    return self._counter(entity).increment(delta=delta)
+  
+  def increment_async(self, entity, delta=1):
+    return self._counter(entity).increment_async(delta=delta)
+  
+  def _set_value(self, entity, value):
+    if value != None:
+      raise PropertyValidationFailed(
+        '{} can only be changed with increment or increment_async'
+        .format(self._code_name)
+      )
+  
+  def _get_value(self, entity):
+    if not entity.key:
+      return 0
+    return self._counter(entity).get()
+  
+  def _get_stored_value(self, entity):
+    return None
+  
+  def to_route_parameter(self):
+    return None
+
+
+class List(Property):
+  """
+  ' A list of values of the `template` property, stored as a repeated
+  ' datastore property and as one search field per item. Queries use
+  ' contains, which is an equality filter on the datastore.
+  """
+  
+  allowed_operators = frozenset({
+    PropertyComparison.IN
+  })
+  allowed_types = frozenset((list, tuple))
+  
+  def __init__(self, template, required=False, min=None, max=None, hidden=False, search_only=False):
+    super(List, self).__init__(required=required, hidden=hidden, search_only=search_only)
+    if not isinstance(template, Property) or not template.stored:
+      raise Exception('List requires a stored Property template, got {!r}'.format(template))
+    if search_only and isinstance(template, Embedded):
+      raise Exception('List of Embedded cannot be search only, embedded models are not searchable')
+    self.template = template
+    self.min = min
+    self.max = max
+  
+  def _connect(self, entity=None, name=None, model=None):
+    super(List, self)._connect(entity=entity, name=name, model=model)
+    if name:
+      self.template._code_name = '{}[]'.format(self._code_name)
+  
+  def _validate_required(self, value):
+    if self.required and not value:
+      raise PropertyValidationFailed(
+        "'{}' property was set to an empty list, but is required"
+        .format(self._code_name)
+      )
+  
+  def validate(self, entity, value):
+    super(List, self).validate(entity, value)
+    if value == None: return
+    self._validate_min(value)
+    self._validate_max(value)
+    for item in value:
+      self.template.validate(entity, item)
+  
+  def _validate_min(self, value):
+    if self.min == None: return
+    if len(value) < self.min:
+      raise PropertyValidationFailed(
+        "{} property requires at least {} items but was provided {}"
+        .format(self._code_name, self.min, len(value))
+      )
+  
+  def _validate_max(self, value):
+    if self.max == None: return
+    if len(value) > self.max:
+      raise PropertyValidationFailed(
+        "{} property requires at most {} items but was provided {}"
+        .format(self._code_name, self.max, len(value))
+      )
+  
+  @property
+  def packable(self):
+    return self.template.packable
+  
+  def _validate_before_save(self, entity, value):
+    super(List, self)._validate_before_save(entity, value)
+    if isinstance(self.template, Embedded):
+      for item in self._get_value(entity):
+        self.template._validate_embedded(self.template._to_embedded(item))
+  
+  def _set_value(self, entity, value):
+    if value != None and isinstance(self.template, Embedded):
+      value = map(self.template._to_embedded, value)
+    super(List, self)._set_value(entity, list(value) if value != None else [])
+  
+  def _get_value(self, entity):
+    self._load_deferred(entity)
+    if not self._name in entity._values:
+      # stored on the entity so in place changes such as append are saved
+      entity._values[self._name] = []
+    return entity._values[self._name]
+  
+  def _to_storage(self, value):
+    if value == None:
+      return []
+    return [ self.template._to_storage(item) for item in value ]
+  
+  def _from_storage(self, value):
+    if value == None:
+      return []
+    if not isinstance(value, (list, tuple)):
+      # a single item read back from a search document
+      value = [value]
+    return [ self.template._from_storage(item) for item in value ]
+  
+  def _query_operator(self, operator):
+    # a repeated property matches when any item is equal
+    if operator == PropertyComparison.IN:
+      return PropertyComparison.EQ
+    return operator
+  
+  def _to_query_value(self, operator, value):
+    return self.template._to_storage(value)
+  
+  def query_uses_datastore(self, operator, value):
+    return self.template.query_uses_datastore(PropertyComparison.EQ, value)
+  
+  def query_search_reason(self, operator, value):
+    return self.template.query_search_reason(PropertyComparison.EQ, value)
+  
+  def to_search_field(self, operators=None):
+    if operators:
+      operators = frozenset(map(self._query_operator, operators))
+    return self.template.to_search_field(operators=operators)
+  
+  def to_datastore_property(self):
+    prop = self.template.to_datastore_property()
+    if inspect.isclass(prop):
+      return prop(repeated=True, indexed=False)
+    if isinstance(prop, ndb.LocalStructuredProperty):
+      # structured items need the model class they are read back into
+      return ndb.LocalStructuredProperty(prop._modelclass, repeated=True)
+    raise Exception(
+      'List cannot repeat {}, its template must be a scalar property or Embedded'
+      .format(self.template._code_name)
+    )
+  
+  def to_route_parameter(self):
+    template = self.template.to_route_parameter()
+    if template == None:
+      return None
+    return Parameters.List(
+      template,
+      required = self.required,
+      min = self.min,
+      max = self.max
+    )
+
+
+class Embedded(Property):
+  """
+  ' A venom.Model stored inside its parent entity with an ndb
+  ' LocalStructuredProperty, so the parent and its nested values load and
+  ' save together. Can be set to an instance of `model` or to a dict.
+  """
+  
+  # nested values are entities, not json
+  packable = False
+  
+  def __init__(self, model, required=False, hidden=False):
+    super(Embedded, self).__init__(required=required, hidden=hidden)
+    for name, prop in model._properties.items():
+      if prop.unique or prop.search_only or not prop.stored:
+        raise Exception(
+          '{}.{} cannot be embedded, embedded properties must be stored in the datastore and not unique'
+          .format(model.__name__, name)
+        )
+    self.model = model
+    self.allowed_types = frozenset((model, dict))
+  
+  def _to_embedded(self, value):
+    if isinstance(value, dict):
+      value = self.model(**value)
+    if value != None:
+      value._embedded = True
+    return value
+  
+  def _set_value(self, entity, value):
+    super(Embedded, self)._set_value(entity, self._to_embedded(value))
+  
+  def _validate_before_save(self, entity, value):
+    super(Embedded, self)._validate_before_save(entity, value)
+    embedded = self._get_value(entity)
+    if embedded == None: return
+    self._validate_embedded(embedded)
+  
+  def _validate_embedded(self, embedded):
+    for name, prop in embedded._properties.items():
+      prop._validate_before_save(embedded, prop._get_stored_value(embedded))
+  
+  def _to_storage(self, value):
+    if value == None:
+      return None
+    # list items appended as dicts become models here
+    value = self._to_embedded(value)
+    ndb_entity = self.model.hybrid_model.model()
+    for name, prop in value._properties.items():
+      ndb_prop = prop.to_datastore_property()
+      if inspect.isclass(ndb_prop):
+        # values inside the blob are never indexed
+        ndb_prop = ndb_prop(indexed=False)
+      ndb_entity.set(name, prop._get_stored_value(value), ndb_prop)
+    return ndb_entity
+  
+  def _from_storage(self, value):
+    if value == None or isinstance(value, self.model):
+      return value
+    if isinstance(value, basestring):
+      # nested embeds are read back as serialized entities
+      value = self.to_datastore_property()._from_base_type(value)
+    embedded = self.model()
+    embedded._populate_from_stored(**{
+      name: prop._get_value(value)
+      for name, prop in value._properties.items()
+    })
+    embedded._embedded = True
+    return embedded
+  
+  def query_uses_datastore(self, operator, value):
+    return True
+  
+  def to_datastore_property(self):
+    return ndb.LocalStructuredProperty(self.model.hybrid_model.model)
+  
+  def to_route_parameter(self):
+    parameters = {
+      name: prop.to_route_parameter()
+      for name, prop in self.model._properties.items()
+    }
+    return Parameters.Dict(
+      {
+        name: parameter
+        for name, parameter in parameters.items()
+        if parameter != None
+      },
+      required = self.required
+    )
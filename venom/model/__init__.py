@@ -13,3 +13,24 @@ __all__ += query.__all__
 
 from attribute import *
 __all__ += attribute.__all__
+
+from aggregate import *
+__all__ += aggregate.__all__
+
+from mapper import *
+__all__ += mapper.__all__
+
+from reindex import *
+__all__ += reindex.__all__
+
+from expiry import *
+__all__ += expiry.__all__
+
+from write_back import *
+__all__ += write_back.__all__
+
+from loader import *
+__all__ += loader.__all__
+
+from columns import *
+__all__ += columns.__all__
@@ -0,0 +1,292 @@
+# system imports
+import time
+import zlib
+
+# app engine imports
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+# package imports
+from attribute import ModelAttribute
+from query import Query, QueryParameter
+
+
+__all__ = ['VenomAggregateRecord', 'Aggregate', 'Count', 'Sum', 'Min', 'Max']
+
+
+class VenomAggregateRecord(ndb.Model):
+  value = ndb.GenericProperty(indexed=False)
+  stale = ndb.BooleanProperty(default=False, indexed=False)
+  # when an aggregated entity of the group was last written
+  updated = ndb.FloatProperty(indexed=False)
+
+
+class Aggregate(ModelAttribute):
+  """
+  ' A materialized total over a model's entities, optionally grouped
+  ' by the owner property created from `belongs_to`. Aggregates are
+  ' stored in VenomAggregateRecords per group, so reading one costs a
+  ' memcache hit or one get. Saves and deletes read the stored entity
+  ' and apply the old/new delta in the transaction that writes it.
+  '
+  ' Every record is an entity group written by each save touching it,
+  ' which holds up to about one write per second. Ungrouped aggregates
+  ' see every save of the kind, so their entities are spread over
+  ' `shards` records by key, each holding the aggregate of its share,
+  ' and reads merge the shards. Grouped aggregates keep one record per
+  ' group unless `shards` is given, a group's writes are still bound by
+  ' that limit.
+  '
+  ' Records that are missing or can't be updated incrementally are
+  ' marked stale and rebuilt on read. Groups of belongs_to_ancestor
+  ' models are rebuilt from an ancestor query in a transaction. Other
+  ' groups use the eventually consistent kind query, so their rebuilt
+  ' value is only stored once the group saw no write for settle_time.
+  '
+  ' EXAMPLE
+  '
+  ' class SessionToken(venom.Model):
+  '   belongs_to = User
+  '   per_user = venom.Count(group_by='user')
+  '
+  ' SessionToken.per_user(user)
+  """
+  
+  cache_time = 300
+  # records of an ungrouped aggregate
+  ungrouped_shards = 16
+  # seconds a write is given to become visible to the kind query
+  settle_time = 5
+  
+  # returned from _combine when the stored value can't be updated incrementally
+  stale = object()
+  
+  def __init__(self, property=None, group_by=None, shards=None):
+    super(Aggregate, self).__init__()
+    self.property = property
+    self.group_by = group_by
+    self.shards = shards
+  
+  @property
+  def _group_name(self):
+    if self.group_by == None or isinstance(self.group_by, basestring):
+      return self.group_by
+    return self.group_by._name
+  
+  @property
+  def _shards(self):
+    if self.shards:
+      return self.shards
+    return 1 if self._group_name else self.ungrouped_shards
+  
+  def _shard_of(self, key):
+    if self._shards == 1:
+      return 0
+    return zlib.crc32(str(key.id())) % self._shards
+  
+  def _connect(self, entity=None, name=None, model=None):
+    super(Aggregate, self)._connect(entity=entity, name=name, model=model)
+    if model and self._group_name:
+      # makes sure the group property is indexed so the aggregate can be recomputed
+      group_property = getattr(model, self._group_name)
+      setattr(model, '_aggregate_{}'.format(name), Query(group_property == QueryParameter))
+  
+  def _group_id(self, owner):
+    if not self._group_name:
+      return ''
+    if hasattr(owner, 'key'):
+      return owner.key
+    return owner
+  
+  def _record_key(self, group, shard=0):
+    if self._shards == 1:
+      return ndb.Key(VenomAggregateRecord, '{}:{}:{}'.format(self._model.kind, self._name, group))
+    return ndb.Key(VenomAggregateRecord, '{}:{}:{}:{}'.format(self._model.kind, self._name, group, shard))
+  
+  def _record_keys(self, group):
+    return [ self._record_key(group, shard) for shard in range(self._shards) ]
+  
+  def _cache_key(self, group):
+    return 'venom-aggregate:{}:{}:{}'.format(self._model.kind, self._name, group)
+  
+  def _property_names(self):
+    names = []
+    if self.property:
+      names.append(self.property._name)
+    if self._group_name:
+      names.append(self._group_name)
+    return names
+  
+  def _value_of(self, values):
+    if not self.property:
+      return None
+    return values.get(self.property._name)
+  
+  def _group_of(self, values):
+    if not self._group_name:
+      return ''
+    return values.get(self._group_name)
+  
+  def _combine(self, value, removed, added):
+    raise NotImplementedError()
+  
+  def _initial(self, values):
+    raise NotImplementedError()
+  
+  def _merge(self, values):
+    """ the aggregate of the values of its shards """
+    return sum(values)
+  
+  def _is_noop(self, removed, added):
+    return removed == added
+  
+  def __call__(self, owner=None):
+    group = self._group_id(owner)
+    cache_key = self._cache_key(group)
+    cached = memcache.get(cache_key)
+    if cached != None:
+      return cached[0]
+    keys = self._record_keys(group)
+    values = []
+    cache_time = self.cache_time
+    for shard, (key, record) in enumerate(zip(keys, ndb.get_multi(keys))):
+      if record and not record.stale:
+        values.append(record.value)
+        continue
+      value, stored = self._rebuild(key, group, shard)
+      values.append(value)
+      if not stored:
+        cache_time = self.settle_time
+    value = self._merge(values)
+    # wrapped so a None aggregate (eg. max of nothing) is still cached
+    memcache.set(cache_key, (value,), time=cache_time)
+    return value
+  
+  def _ancestor_grouped(self):
+    return self._model.belongs_to_ancestor and self._group_name in self._model._owners
+  
+  def _rebuild(self, key, group, shard):
+    """ (value, whether it was stored) of a missing or stale record """
+    if self._ancestor_grouped():
+      return ndb.transaction(lambda: self._rebuild_from_ancestor(key, group, shard), xg=True), True
+    record = key.get()
+    updated = record.updated if record else None
+    value = self._recompute(group, shard)
+    if updated != None and time.time() - updated < self.settle_time:
+      # recent writes may not be visible to the query yet
+      return value, False
+    return value, ndb.transaction(lambda: self._store_rebuilt(key, updated, value))
+  
+  def _store_rebuilt(self, key, updated, value):
+    record = key.get()
+    if record and (not record.stale or record.updated != updated):
+      # written since the rebuild started
+      return False
+    VenomAggregateRecord(key=key, value=value, updated=updated).put()
+    return True
+  
+  def _rebuild_from_ancestor(self, key, group, shard):
+    owner = self._model._properties[self._group_name].model
+    ancestor = owner.hybrid_model._document_id_to_key(group)
+    entities = self._model.hybrid_model.model.query(ancestor=ancestor).fetch()
+    entities = [ entity for entity in entities if self._shard_of(entity.key) == shard ]
+    value = self._initial([ self._value_of(self._model._get_stored_values(entity)) for entity in entities ])
+    VenomAggregateRecord(key=key, value=value, updated=time.time()).put()
+    return value
+  
+  def _recompute(self, group, shard):
+    ndb_model = self._model.hybrid_model.model
+    query = ndb_model.query()
+    if self._group_name:
+      query = query.filter(ndb.GenericProperty(self._group_name) == group)
+    # the keys only query is eventual, the get reads the current values
+    keys = [ key for key in query.fetch(keys_only=True) if self._shard_of(key) == shard ]
+    entities = ndb.get_multi(keys)
+    values = [ self._model._get_stored_values(entity) for entity in entities if entity ]
+    return self._initial([
+      self._value_of(entity_values) for entity_values in values
+      if self._group_of(entity_values) == group
+    ])
+  
+  def update(self, key, old, new):
+    """
+    ' old and new are stored values of the entity with the key before and
+    ' after a write, None if absent. Runs in the transaction writing the
+    ' entity and returns the cache keys to delete once it committed.
+    """
+    changes = {}
+    if old != None:
+      changes.setdefault(self._group_of(old), ([], []))[0].append(self._value_of(old))
+    if new != None:
+      changes.setdefault(self._group_of(new), ([], []))[1].append(self._value_of(new))
+    cache_keys = []
+    for group, (removed, added) in changes.items():
+      if group == None or self._is_noop(removed, added):
+        continue
+      self._update_record(self._record_key(group, self._shard_of(key)), removed, added)
+      cache_keys.append(self._cache_key(group))
+    return cache_keys
+  
+  @ndb.transactional
+  def _update_record(self, key, removed, added):
+    record = key.get()
+    if not record:
+      # the base is unknown, rebuilt on the next read
+      record = VenomAggregateRecord(key=key, stale=True)
+    elif not record.stale:
+      value = self._combine(record.value, removed, added)
+      if value is self.stale:
+        record.stale = True
+      else:
+        record.value = value
+    record.updated = time.time()
+    record.put()
+
+
+class Count(Aggregate):
+  def __init__(self, group_by=None, shards=None):
+    super(Count, self).__init__(group_by=group_by, shards=shards)
+  
+  def _is_noop(self, removed, added):
+    return len(removed) == len(added)
+  
+  def _initial(self, values):
+    return len(values)
+  
+  def _combine(self, value, removed, added):
+    return value - len(removed) + len(added)
+
+
+class Sum(Aggregate):
+  def _initial(self, values):
+    return sum(value for value in values if value != None)
+  
+  def _combine(self, value, removed, added):
+    removed = sum(item for item in removed if item != None)
+    added = sum(item for item in added if item != None)
+    return value - removed + added
+
+
+class Min(Aggregate):
+  def _best(self, values):
+    values = [value for value in values if value != None]
+    return min(values) if values else None
+  
+  def _initial(self, values):
+    return self._best(values)
+  
+  def _merge(self, values):
+    return self._best(values)
+  
+  def _combine(self, value, removed, added):
+    for item in removed:
+      if item != None and value != None and self._best([item, value]) == item:
+        # the current extreme may have been removed
+        return self.stale
+    return self._best([value] + added)
+
+
+class Max(Min):
+  def _best(self, values):
+    values = [value for value in values if value != None]
+    return max(values) if values else None
@@ -0,0 +1,321 @@
+# system imports
+from array import array
+from collections import OrderedDict
+from itertools import compress, imap, izip
+from operator import not_
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+
+__all__ = ['Column', 'ColumnAggregates', 'RawResults']
+
+
+NUMPY_TYPES = {
+  'l': 'int64',
+  'd': 'float64'
+}
+
+
+def _sum(values):
+  return sum(values)
+
+def _mean(values):
+  return sum(values) / float(len(values)) if len(values) else None
+
+def _min(values):
+  return min(values) if len(values) else None
+
+def _max(values):
+  return max(values) if len(values) else None
+
+def _count(values):
+  return len(values)
+
+AGGREGATES = {
+  'sum': _sum,
+  'mean': _mean,
+  'min': _min,
+  'max': _max,
+  'count': _count
+}
+
+
+def _get_property(model, name):
+  prop = model._properties.get(name)
+  if prop == None:
+    raise Exception('{} has no property {}'.format(model.kind, name))
+  return prop
+
+
+def stored_values(model, entities, name):
+  """
+  ' The stored values of a property across loaded models, in order. Values
+  ' are read from the raw datastore entities the models were loaded from
+  ' (the values as saved, later assignments are not seen) and from the
+  ' model where they are not there, such as packed, search only or
+  ' write_back properties.
+  """
+  prop = _get_property(model, name)
+  raw = not name in model._write_back_properties
+  values = []
+  for entity in entities:
+    ndb_entity = entity.hybrid_entity.datastore_entity.entity if raw and entity.hybrid_entity else None
+    if ndb_entity != None and name in ndb_entity._properties:
+      values.append(getattr(ndb_entity, name))
+    else:
+      values.append(prop._get_stored_value(entity))
+  return values
+
+
+def raw_values(model, ndb_entities, name, buffered=None):
+  """
+  ' The stored values of a property read straight from raw datastore
+  ' entities, no model is created. Packed values are unpacked and
+  ' `buffered` ({ document_id: { name: value } } of WriteBackBuffer.load)
+  ' overrides them. Search only properties are not in the datastore.
+  """
+  from model import unpack_values
+  _get_property(model, name)
+  if name in model._search_only_properties:
+    raise Exception(
+      '{}.{} is search only, raw results are read from the datastore'
+      .format(model.kind, name)
+    )
+  packed_name = model.packed_property
+  values = []
+  for ndb_entity in ndb_entities:
+    prop = ndb_entity._properties.get(name)
+    if prop != None:
+      value = prop._get_value(ndb_entity)
+    elif packed_name in ndb_entity._properties:
+      value = unpack_values(ndb_entity._properties[packed_name]._get_value(ndb_entity)).get(name)
+    else:
+      value = None
+    values.append(value)
+  if buffered:
+    document_ids = [ model.hybrid_model._key_to_document_id(ndb_entity.key) for ndb_entity in ndb_entities ]
+    for i, document_id in enumerate(document_ids):
+      entity_values = buffered.get(document_id)
+      if entity_values and name in entity_values:
+        values[i] = entity_values[name]
+  return values
+
+
+def _typecode(prop):
+  from Properties import Integer, Float
+  if isinstance(prop, Float):
+    return 'd'
+  if isinstance(prop, Integer):
+    return 'l'
+  raise Exception(
+    '{} cannot be read as a column, only Integer, Float and DateTime properties can'
+    .format(prop._code_name)
+  )
+
+
+def to_columns(model, names, read, use_numpy=None):
+  """ { name: Column } of the values read(name) returns for each property, in the order of names """
+  columns = OrderedDict()
+  for name in names:
+    typecode = _typecode(_get_property(model, name))
+    columns[name] = Column.from_values(name, read(name), typecode, use_numpy=use_numpy)
+  return columns
+
+
+class ColumnAggregates(object):
+  """
+  ' Aggregates of result columns by property name. Subclasses define
+  ' to_columns(names, use_numpy) and _key_values(name).
+  """
+  
+  def column(self, name, use_numpy=None):
+    return self.to_columns([name], use_numpy=use_numpy)[name]
+  
+  def sum(self, name):
+    return self.column(name).sum()
+  
+  def mean(self, name):
+    return self.column(name).mean()
+  
+  def min(self, name):
+    return self.column(name).min()
+  
+  def max(self, name):
+    return self.column(name).max()
+  
+  def histogram(self, name, bins=10, range=None):
+    return self.column(name).histogram(bins=bins, range=range)
+  
+  def group_by(self, by, name, aggregate='sum'):
+    """ { stored value of by: aggregate of name }, aggregate is one of sum, mean, min, max or count """
+    if not aggregate in AGGREGATES:
+      raise Exception(
+        'Unknown aggregate {}, expected one of {}'
+        .format(aggregate, ', '.join(sorted(AGGREGATES)))
+      )
+    return self.column(name).group_by(self._key_values(by), aggregate=aggregate)
+
+
+class RawResults(list, ColumnAggregates):
+  """
+  ' The raw datastore entities of a query, returned by Query.raw, for
+  ' reports that only need columns of stored values. Skipping the models
+  ' skips converting every stored value of every entity.
+  """
+  
+  def __init__(self, ndb_entities=(), model=None):
+    super(RawResults, self).__init__(ndb_entities)
+    self.model = model
+    self._buffered = None
+  
+  def _buffered_values(self, names):
+    """ the write_back values buffered for the entities, loaded once """
+    if not self.model._write_back or not set(names) & set(self.model._write_back_properties):
+      return None
+    if self._buffered == None:
+      document_ids = [ self.model.hybrid_model._key_to_document_id(ndb_entity.key) for ndb_entity in self ]
+      self._buffered = self.model._write_back.load(document_ids) if document_ids else {}
+    return self._buffered
+  
+  def _key_values(self, name):
+    return raw_values(self.model, self, name, buffered=self._buffered_values([name]))
+  
+  def to_columns(self, names, use_numpy=None):
+    """ { name: Column } of the stored values of each numeric property, see QueryResults.to_columns """
+    buffered = self._buffered_values(names)
+    return to_columns(self.model, names, lambda name: raw_values(self.model, self, name, buffered=buffered), use_numpy=use_numpy)
+
+
+class Column(object):
+  """
+  ' The values of one numeric property across query results in a
+  ' contiguous typed array: a numpy masked array when numpy is installed,
+  ' an array.array otherwise. `mask` flags the nulls, whose slots hold 0.
+  ' DateTime values are seconds since the epoch, as they are stored.
+  ' Aggregates skip nulls and return None when there is nothing to
+  ' aggregate (sum and count return 0).
+  """
+  
+  def __init__(self, name, values, mask, typecode):
+    self.name = name
+    self.values = values
+    self.mask = mask
+    self.typecode = typecode
+  
+  @classmethod
+  def from_values(cls, name, values, typecode, use_numpy=None):
+    if use_numpy == None:
+      use_numpy = numpy != None
+    if use_numpy and numpy == None:
+      raise Exception('Column {} cannot use numpy, it is not installed'.format(name))
+    mask = [value == None for value in values]
+    filled = [0 if value == None else value for value in values]
+    if use_numpy:
+      data = numpy.array(filled, dtype=NUMPY_TYPES[typecode])
+      nulls = numpy.array(mask, dtype=bool)
+      return cls(name, numpy.ma.masked_array(data, mask=nulls), nulls, typecode)
+    return cls(name, array(typecode, filled), array('B', mask), typecode)
+  
+  @property
+  def uses_numpy(self):
+    return not isinstance(self.values, array)
+  
+  def __len__(self):
+    return len(self.values)
+  
+  def __iter__(self):
+    """ the values with nulls as None """
+    for value, null in izip(self._plain(self.values), self._plain(self.mask)):
+      yield None if null else value
+  
+  def _plain(self, values):
+    if self.uses_numpy:
+      return numpy.ma.getdata(values).tolist()
+    return values
+  
+  @property
+  def nulls(self):
+    return int(self.mask.sum() if self.uses_numpy else sum(self.mask))
+  
+  def valid(self):
+    """ the typed array of the non null values """
+    if self.uses_numpy:
+      return self.values.compressed()
+    if not any(self.mask):
+      return self.values
+    return array(self.typecode, compress(self.values, imap(not_, self.mask)))
+  
+  def _scalar(self, value):
+    return value.item() if hasattr(value, 'item') else value
+  
+  def sum(self):
+    return self._scalar(self.valid().sum() if self.uses_numpy else _sum(self.valid()))
+  
+  def count(self):
+    return len(self) - self.nulls
+  
+  def mean(self):
+    values = self.valid()
+    if not len(values):
+      return None
+    return self._scalar(values.mean() if self.uses_numpy else _mean(values))
+  
+  def min(self):
+    values = self.valid()
+    if not len(values):
+      return None
+    return self._scalar(values.min() if self.uses_numpy else _min(values))
+  
+  def max(self):
+    values = self.valid()
+    if not len(values):
+      return None
+    return self._scalar(values.max() if self.uses_numpy else _max(values))
+  
+  def histogram(self, bins=10, range=None):
+    """ (counts, edges) of the non null values over `bins` equal width bins, as numpy.histogram """
+    values = self.valid()
+    if self.uses_numpy:
+      counts, edges = numpy.histogram(values, bins=bins, range=range)
+      return counts.tolist(), edges.tolist()
+    if range:
+      low, high = range
+    elif len(values):
+      low, high = _min(values), _max(values)
+    else:
+      low, high = 0, 1
+    low, high = float(low), float(high)
+    if low == high:
+      low, high = low - 0.5, high + 0.5
+    width = (high - low) / bins
+    counts = [0] * bins
+    for value in values:
+      if value < low or value > high:
+        continue
+      counts[min(int((value - low) / width), bins - 1)] += 1
+    return counts, [ low + width * i for i in xrange(bins + 1) ]
+  
+  def group_by(self, keys, aggregate='sum'):
+    """ { key: aggregate of the non null values with that key }, keys run parallel to the column """
+    function = AGGREGATES.get(aggregate)
+    if function == None:
+      raise Exception(
+        'Unknown aggregate {}, expected one of {}'
+        .format(aggregate, ', '.join(sorted(AGGREGATES)))
+      )
+    if len(keys) != len(self):
+      raise Exception('Column {} has {} values but {} keys'.format(self.name, len(self), len(keys)))
+    groups = {}
+    for key, value, null in izip(keys, self._plain(self.values), self._plain(self.mask)):
+      group = groups.get(key)
+      if group == None:
+        group = groups[key] = array(self.typecode)
+      if not null:
+        group.append(value)
+    return { key: function(group) for key, group in groups.items() }
+  
+  def __repr__(self):
+    return 'Column({!r}, length={}, nulls={})'.format(self.name, len(self), self.nulls)
@@ -0,0 +1,65 @@
+# system imports
+import datetime
+import time
+
+# app engine imports
+from google.appengine.ext import ndb
+
+# package imports
+from model import Model
+
+
+__all__ = ['sweep_kind', 'sweep_expired', 'run_sweeper']
+
+
+def sweep_kind(model, batch_size=500, now=None):
+  """ deletes the expired entities of one model, returns how many were deleted """
+  now = now or datetime.datetime.now()
+  prop = model._properties[model.expires_at]
+  stored_property = ndb.GenericProperty(model.expires_at)
+  # the lower bound keeps entities without an expiry (stored as null) out
+  query = model.hybrid_model.model.query(
+    stored_property >= prop._to_storage(datetime.datetime.fromtimestamp(0)),
+    stored_property <= prop._to_storage(now)
+  )
+  
+  deleted = 0
+  cursor = None
+  while True:
+    keys, cursor, more = query.fetch_page(batch_size, keys_only=True, start_cursor=cursor)
+    if keys:
+      model.delete_multi([model.hybrid_model._key_to_document_id(key) for key in keys])
+      deleted += len(keys)
+    if not more or not cursor:
+      break
+  return deleted
+
+
+def sweep_expired(models=None, batch_size=500, now=None):
+  """
+  ' Deletes expired entities with keys only cursor queries and batched
+  ' delete_multi. Sweeps every model declaring expires_at or ttl unless
+  ' `models` is given. Returns the number deleted per kind.
+  """
+  if models == None:
+    models = [model for model in Model.kinds.values() if model.expires_at]
+  return {
+    model.kind: sweep_kind(model, batch_size=batch_size, now=now)
+    for model in models
+  }
+
+
+def run_sweeper(interval=60, iterations=None, models=None, batch_size=500):
+  """
+  ' Local stand-in for the cron sweep (the dev server does not run cron).
+  ' Sweeps every `interval` seconds, forever unless `iterations` is set.
+  """
+  totals = {}
+  iteration = 0
+  while iterations == None or iteration < iterations:
+    if iteration:
+      time.sleep(interval)
+    for kind, deleted in sweep_expired(models=models, batch_size=batch_size).items():
+      totals[kind] = totals.get(kind, 0) + deleted
+    iteration += 1
+  return totals
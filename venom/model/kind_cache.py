@@ -0,0 +1,114 @@
+# system imports
+import random
+import threading
+import time
+
+# app engine imports
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+
+__all__ = ['KindCache']
+
+
+class KindCache(object):
+  """
+  ' Keeps every entity of a kind in process memory for models declared
+  ' with cache_all = True. A version stamp in memcache is checked at most
+  ' once per `check_interval` seconds and the kind is reloaded when it
+  ' changed. Saves and deletes bump the stamp. Equality lookups use per
+  ' property hash indexes that are built on first use.
+  """
+  
+  def __init__(self, model, check_interval=1.0):
+    self.model = model
+    self.check_interval = check_interval
+    self.stamp = None
+    self.checked = 0
+    self.entities = {}
+    self.values = {}
+    self.indexes = {}
+    self._lock = threading.Lock()
+  
+  @property
+  def version_key(self):
+    return 'venom-cache-all:{}'.format(self.model.kind)
+  
+  def _new_stamp(self):
+    # random so an evicted stamp is never recreated with a value a stale process holds
+    return random.randint(0, 2 ** 31)
+  
+  def _get_stamp(self):
+    stamp = memcache.get(self.version_key)
+    if stamp == None:
+      memcache.add(self.version_key, self._new_stamp())
+      stamp = memcache.get(self.version_key)
+    return stamp
+  
+  def invalidate(self):
+    memcache.incr(self.version_key, initial_value=self._new_stamp())
+    # this process reads its own writes on the next query
+    self.checked = 0
+  
+  def refresh(self):
+    now = time.time()
+    if now - self.checked < self.check_interval:
+      return
+    with self._lock:
+      if now - self.checked < self.check_interval:
+        return
+      stamp = self._get_stamp()
+      if stamp == None or stamp != self.stamp:
+        # the stamp is read first so a write during the load triggers another
+        self._load()
+        self.stamp = stamp
+      self.checked = now
+  
+  def _load(self):
+    keys = self.model.hybrid_model.model.query().fetch(keys_only=True)
+    # gets are strongly consistent where the keys only query is not
+    ndb_entities = [entity for entity in ndb.get_multi(keys) if entity]
+    entities = {}
+    values = {}
+    for ndb_entity in ndb_entities:
+      document_id = self.model.hybrid_model._key_to_document_id(ndb_entity.key)
+      entities[document_id] = ndb_entity
+      values[document_id] = self.model._get_stored_values(ndb_entity)
+    self.entities = entities
+    self.values = values
+    self.indexes = {}
+  
+  def _index(self, name):
+    index = self.indexes.get(name)
+    if index != None:
+      return index
+    index = {}
+    for document_id, values in self.values.items():
+      value = values.get(name)
+      # like the datastore, every item of a repeated value is indexed
+      for item in (value if isinstance(value, list) else [value]):
+        try:
+          index.setdefault(item, set()).add(document_id)
+        except TypeError:
+          # unhashable values are only reachable through scans
+          continue
+    self.indexes[name] = index
+    return index
+  
+  def lookup(self, name, value):
+    try:
+      return set(self._index(name).get(value, ()))
+    except TypeError:
+      return self.scan(name, lambda stored: stored == value)
+  
+  def scan(self, name, predicate):
+    return {
+      document_id
+      for document_id, values in self.values.items()
+      if predicate(values.get(name))
+    }
+  
+  def get_entities(self, document_ids):
+    """ raw datastore entities in key order """
+    ndb_entities = [self.entities[document_id] for document_id in document_ids if document_id in self.entities]
+    return sorted(ndb_entities, key=lambda ndb_entity: ndb_entity.key)
@@ -0,0 +1,156 @@
+# system imports
+import threading
+
+# app engine imports
+from google.appengine.ext import ndb
+
+# package imports
+from ..internal.hybrid_model import rpc_options, document_id_string, GET_OPTIONS
+
+
+__all__ = ['Loader', 'LoadFuture', 'current_loader']
+
+
+_local = threading.local()
+
+
+def current_loader():
+  """ the loader of the innermost active Loader scope on this thread, None outside of one """
+  loaders = getattr(_local, 'loaders', None)
+  return loaders[-1] if loaders else None
+
+
+class LoadFuture(object):
+  """ an entity requested from a Loader, fetched with every other pending request on first use """
+  
+  def __init__(self, loader, model, document_id):
+    self.loader = loader
+    self.model = model
+    self.document_id = document_id
+    self._done = False
+    self._result = None
+    self._error = None
+  
+  def done(self):
+    return self._done
+  
+  def _resolve(self, result):
+    self._result = result
+    self._done = True
+  
+  def _fail(self, error):
+    self._error = error
+    self._done = True
+  
+  def get_result(self):
+    if not self._done:
+      self.loader.dispatch()
+    if self._error:
+      raise self._error
+    return self._result
+
+
+class Loader(object):
+  """
+  ' Collects Model gets and sends every pending one in a single
+  ' ndb.get_multi (one per set of rpc options) the first time any of
+  ' their results is needed. Requests for the same entity share a
+  ' future. Used as a scope, Model.get, Parameters.Model and
+  ' Properties.Model go through the active loader:
+  '
+  '   with venom.Loader():
+  '     posts = Post.all()
+  '     authors = [post.author for post in posts] # one get for all authors
+  '
+  ' Every request served by a venom WSGI entry point runs in a scope.
+  """
+  
+  def __init__(self):
+    self._futures = {}
+    self._pending = []
+  
+  def __enter__(self):
+    if not hasattr(_local, 'loaders'):
+      _local.loaders = []
+    _local.loaders.append(self)
+    return self
+  
+  def __exit__(self, exc_type, exc_value, traceback):
+    _local.loaders.remove(self)
+    return False
+  
+  def _cache_key(self, model, document_id):
+    return (model.kind, document_id_string(document_id))
+  
+  def load(self, model, document_id):
+    cache_key = self._cache_key(model, document_id)
+    future = self._futures.get(cache_key)
+    if future == None:
+      future = LoadFuture(self, model, document_id)
+      self._futures[cache_key] = future
+      self._pending.append(future)
+    return future
+  
+  def load_many(self, model, document_ids):
+    return [ self.load(model, document_id) for document_id in document_ids ]
+  
+  def prime(self, model, entity):
+    """ stores a freshly loaded or saved entity so later loads of it need no rpc """
+    future = self.load(model, entity.key)
+    if future in self._pending:
+      self._pending.remove(future)
+    future._resolve(entity)
+    return future
+  
+  def clear(self, model, document_ids):
+    """ later loads of these entities fetch them again """
+    for document_id in document_ids:
+      self._futures.pop(self._cache_key(model, document_id), None)
+  
+  def _skip_missing(self, futures):
+    """ resolves the futures of ids the negative cache of their model knows are missing """
+    by_model = {}
+    for future in futures:
+      if future.model._negative_cache:
+        by_model.setdefault(future.model, []).append(future)
+    for model, model_futures in by_model.items():
+      missing = model._negative_cache.missing([ future.document_id for future in model_futures ])
+      for future in model_futures:
+        if future.document_id in missing:
+          future._resolve(None)
+    return [ future for future in futures if not future.done() ]
+  
+  def dispatch(self):
+    pending, self._pending = self._pending, []
+    pending = self._skip_missing(pending)
+    groups = {}
+    for future in pending:
+      options = rpc_options(future.model._get_rpc_options(), GET_OPTIONS)
+      groups.setdefault(frozenset(options.items()), []).append(future)
+    for options, futures in groups.items():
+      try:
+        self._dispatch_group(futures, dict(options))
+      except Exception as e:
+        # every future of the batch raises the error, later loads retry
+        for future in futures:
+          if not future.done():
+            future._fail(e)
+          self.clear(future.model, [future.document_id])
+  
+  def _dispatch_group(self, futures, options):
+    keys = [
+      future.model.hybrid_model._document_id_to_key(future.document_id)
+      for future in futures
+    ]
+    # kinds are mixed freely, ndb sends them as one batch
+    ndb_entities = ndb.get_multi(keys, **options)
+    by_model = {}
+    for future, ndb_entity in zip(futures, ndb_entities):
+      hybrid = future.model.hybrid_model(entity=ndb_entity) if ndb_entity else None
+      by_model.setdefault(future.model, []).append((future, hybrid))
+    for model, loaded in by_model.items():
+      if model._negative_cache:
+        model._negative_cache.record([ loaded_future.document_id for loaded_future, loaded_hybrid in loaded if not loaded_hybrid ])
+      entities = model._load_hybrids([ hybrid for _, hybrid in loaded ])
+      for (future, _), entity in zip(loaded, entities):
+        future._resolve(entity)
@@ -0,0 +1,196 @@
+# system imports
+import datetime
+import threading
+
+# app engine imports
+from google.appengine.ext import ndb
+from google.appengine.ext import deferred
+from google.appengine.datastore.datastore_query import Cursor
+
+# package imports
+from model import Model
+
+
+__all__ = ['VenomMapperJob', 'VenomMapperShard', 'Mapper', 'map_key_range']
+
+
+class VenomMapperJob(ndb.Model):
+  kind = ndb.StringProperty(indexed=False)
+  shards = ndb.IntegerProperty(indexed=False)
+  started = ndb.DateTimeProperty(auto_now_add=True, indexed=True)
+  finished = ndb.DateTimeProperty(indexed=True)
+
+
+class VenomMapperShard(ndb.Model):
+  # shards are root entities so concurrent shards never contend on a group
+  start = ndb.KeyProperty(indexed=False)
+  end = ndb.KeyProperty(indexed=False)
+  cursor = ndb.StringProperty(indexed=False)
+  processed = ndb.IntegerProperty(default=0, indexed=False)
+  written = ndb.IntegerProperty(default=0, indexed=False)
+  started = ndb.DateTimeProperty(indexed=False)
+  finished = ndb.DateTimeProperty(indexed=False)
+
+
+def _write_results(results):
+  """ saves every Model returned by the map function, one save_multi per kind """
+  by_kind = {}
+  for result in results:
+    if not result:
+      continue
+    entities = result if isinstance(result, list) else [result]
+    for entity in entities:
+      by_kind.setdefault(entity.__class__, []).append(entity)
+  for model, entities in by_kind.items():
+    model.save_multi(entities)
+  return sum(len(entities) for entities in by_kind.values())
+
+
+def _map_batch(model, fn, shard, batch_size):
+  """ maps one page of the shard's key range and advances its cursor """
+  if not shard.started:
+    shard.started = datetime.datetime.now()
+  cursor = Cursor(urlsafe=shard.cursor) if shard.cursor else None
+  hybrids, next_cursor, more = model.hybrid_model.query_key_range(
+    shard.start, shard.end, batch_size=batch_size, cursor=cursor
+  )
+  results = [fn(model._entity_to_model(hybrid)) for hybrid in hybrids]
+  shard.written += _write_results(results)
+  shard.processed += len(hybrids)
+  shard.cursor = next_cursor.urlsafe() if next_cursor else None
+  if not more or not next_cursor:
+    shard.finished = datetime.datetime.now()
+  return shard
+
+
+@ndb.transactional
+def _finish_job(job_key, finished):
+  job = job_key.get()
+  if not job.finished:
+    job.finished = finished
+    job.put()
+  return job
+
+
+def map_key_range(shard_key, kind, fn, batch_size=100):
+  """
+  ' Task entry point for one shard of a Mapper job. Maps a batch, stores
+  ' the shard's progress and enqueues the next batch until the key range
+  ' is exhausted. The last shard to finish marks the job finished.
+  """
+  shard = shard_key.get()
+  if not shard or shard.finished:
+    return
+  model = Model.kinds[kind]
+  _map_batch(model, fn, shard, batch_size)
+  shard.put()
+  
+  if not shard.finished:
+    deferred.defer(map_key_range, shard_key, kind, fn, batch_size=batch_size)
+    return
+  
+  job_id, _ = shard_key.id().rsplit(':', 1)
+  job = VenomMapperJob.get_by_id(int(job_id))
+  shards = ndb.get_multi(Mapper._shard_keys(job.key, job.shards))
+  if all(shard and shard.finished for shard in shards):
+    _finish_job(job.key, max(shard.finished for shard in shards))
+
+
+class Mapper(object):
+  """
+  ' Runs `fn` over every entity of a Model. The kind is split into key
+  ' ranges with __scatter__ sampling and the ranges are mapped concurrently,
+  ' on threads or as chains of deferred tasks. Any Model (or list of Models)
+  ' returned by `fn` is written back in batches through save_multi.
+  '
+  ' NOTE: run(use_tasks=True) pickles `fn`, so it must be a module level
+  '       function, and requires the deferred builtin to be enabled in
+  '       app.yaml.
+  """
+  
+  job_model = VenomMapperJob
+  shard_model = VenomMapperShard
+  
+  def __init__(self, model, fn, shards=8, batch_size=100):
+    if not isinstance(model, type) or not issubclass(model, Model):
+      raise Exception('Mapper can only map over venom.Model subclasses, got {}'.format(model))
+    self.model = model
+    self.fn = fn
+    self.shards = shards
+    self.batch_size = batch_size
+    self.job = None
+    self._shards = []
+  
+  @classmethod
+  def _shard_keys(cls, job_key, count):
+    return [
+      ndb.Key(cls.shard_model, '{}:{}'.format(job_key.id(), index))
+      for index in range(count)
+    ]
+  
+  def _start_job(self):
+    ranges = self.model.hybrid_model.split_key_ranges(self.shards)
+    self.job = self.job_model(kind=self.model.kind, shards=len(ranges))
+    self.job.put()
+    self._shards = [
+      self.shard_model(key=shard_key, start=start, end=end)
+      for shard_key, (start, end) in zip(self._shard_keys(self.job.key, len(ranges)), ranges)
+    ]
+  
+  def _run_shard(self, shard, errors):
+    try:
+      while not shard.finished:
+        _map_batch(self.model, self.fn, shard, self.batch_size)
+    except Exception as e:
+      errors.append(e)
+  
+  def run(self, use_tasks=False):
+    self._start_job()
+    
+    if use_tasks:
+      ndb.put_multi(self._shards)
+      for shard in self._shards:
+        deferred.defer(map_key_range, shard.key, self.model.kind, self.fn, batch_size=self.batch_size)
+      return self.get_progress()
+    
+    errors = []
+    threads = [
+      threading.Thread(target=self._run_shard, args=(shard, errors))
+      for shard in self._shards
+    ]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    if errors:
+      raise errors[0]
+    
+    ndb.put_multi(self._shards)
+    self.job.finished = max(shard.finished for shard in self._shards)
+    self.job.put()
+    return self.get_progress()
+  
+  def get_progress(self):
+    """ processed / written counts and throughput (entities per second) """
+    if not self.job:
+      return {}
+    shards = self._shards
+    if not self.job.finished:
+      # task shards report through the datastore
+      stored = ndb.get_multi([shard.key for shard in shards])
+      shards = [stored_shard or shard for stored_shard, shard in zip(stored, shards)]
+    
+    finished = [shard for shard in shards if shard.finished]
+    done = len(finished) == len(shards)
+    end = max(shard.finished for shard in finished) if done else datetime.datetime.now()
+    elapsed = (end - self.job.started).total_seconds()
+    processed = sum(shard.processed for shard in shards)
+    return {
+      'shards': len(shards),
+      'finished_shards': len(finished),
+      'processed': processed,
+      'written': sum(shard.written for shard in shards),
+      'elapsed': elapsed,
+      'throughput': processed / elapsed if elapsed > 0 else 0.0,
+      'done': done
+    }
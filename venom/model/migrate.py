@@ -7,28 +7,169 @@ from ..internal.search_yaml import load_search_schema
 from model import Model
 
 from google.appengine.ext import ndb
+from google.appengine.ext import deferred
+from google.appengine.datastore.datastore_query import Cursor
 
 
-__all__ = ['VenomMigrationRecord', 'Migration']
+__all__ = ['VenomMigrationRecord', 'VenomMigrationRange', 'Migration', 'migrate_kind_batch']
 
 
 class VenomMigrationRecord(ndb.Model):
   started = ndb.DateTimeProperty(auto_now_add=True, indexed=True)
   finished = ndb.DateTimeProperty(indexed=True)
   schema = ndb.JsonProperty(indexed=False)
+  # { kind: { properties, ranges, count, rewritten, done } }, counts are
+  # summed from the kind's VenomMigrationRanges once they are all done
+  progress = ndb.JsonProperty(indexed=False)
+
+
+class VenomMigrationRange(ndb.Model):
+  # ranges are root entities so concurrent chains never contend on the record
+  start = ndb.KeyProperty(indexed=False)
+  end = ndb.KeyProperty(indexed=False)
+  cursor = ndb.StringProperty(indexed=False)
+  count = ndb.IntegerProperty(default=0, indexed=False)
+  rewritten = ndb.IntegerProperty(default=0, indexed=False)
+  done = ndb.BooleanProperty(default=False, indexed=False)
+
+
+def _range_keys(record_key, kind, count):
+  return [
+    ndb.Key(VenomMigrationRange, '{}:{}:{}'.format(record_key.id(), kind, index))
+    for index in range(count)
+  ]
+
+
+@ndb.transactional
+def _record_ranges(record_key, kind, count):
+  record = record_key.get()
+  progress = record.progress[kind]
+  if not progress.get('ranges'):
+    progress['ranges'] = count
+    record.put()
+  return progress['ranges']
+
+
+def _split_kind(record_key, kind, shards):
+  """ the range keys of `kind`, splitting it into at most `shards` key ranges the first time """
+  count = record_key.get().progress[kind].get('ranges')
+  if count:
+    return _range_keys(record_key, kind, count)
+  model = Model.kinds.get(kind)
+  ranges = model.hybrid_model.split_key_ranges(shards) if model else [(None, None)]
+  ndb.put_multi([
+    VenomMigrationRange(key=range_key, start=start, end=end)
+    for range_key, (start, end) in zip(_range_keys(record_key, kind, len(ranges)), ranges)
+  ])
+  return _range_keys(record_key, kind, _record_ranges(record_key, kind, len(ranges)))
+
+
+@ndb.transactional
+def _record_kind_done(record_key, kind, count, rewritten):
+  record = record_key.get()
+  progress = record.progress[kind]
+  if progress['done']:
+    return record
+  progress['count'] = count
+  progress['rewritten'] = rewritten
+  progress['done'] = True
+  if all(kind_progress['done'] for kind_progress in record.progress.values()):
+    record.finished = datetime.datetime.now()
+  record.put()
+  return record
+
+
+def _finish_kind(record_key, kind):
+  """ marks the kind done once every one of its ranges is """
+  count = record_key.get().progress[kind].get('ranges') or 0
+  ranges = ndb.get_multi(_range_keys(record_key, kind, count))
+  if all(key_range and key_range.done for key_range in ranges):
+    _record_kind_done(
+      record_key, kind,
+      sum(key_range.count for key_range in ranges),
+      sum(key_range.rewritten for key_range in ranges)
+    )
+
+
+def _requires_rewrite(entity, properties):
+  """ an entity without values for the added properties has no search fields to add """
+  for name in properties:
+    if name in entity._properties and entity._properties[name]._get_stored_value(entity) != None:
+      return True
+  return False
+
+
+def migrate_kind_batch(record_key, kind, batch_size=200, chain=False, index=0):
+  """
+  ' Migrates a single batch of the `index`th key range of `kind` starting
+  ' at the cursor stored on its VenomMigrationRange and records the new
+  ' cursor. When `chain` is set the next batch is enqueued as a deferred
+  ' task. Returns True once the range has been fully migrated.
+  """
+  progress = record_key.get().progress[kind]
+  if progress['done']:
+    return True
+  
+  range_keys = _split_kind(record_key, kind, 1)
+  key_range = range_keys[index].get()
+  if key_range.done:
+    return True
+  
+  if kind in Model.kinds:
+    model = Model.kinds[kind]
+    cursor = Cursor(urlsafe=key_range.cursor) if key_range.cursor else None
+    hybrids, next_cursor, more = model.hybrid_model.query_key_range(
+      key_range.start, key_range.end, batch_size=batch_size, cursor=cursor
+    )
+    entities = [
+      entity for entity in map(model._entity_to_model, hybrids)
+      if _requires_rewrite(entity, progress['properties'])
+    ]
+    if entities:
+      model.save_multi(entities)
+    key_range.cursor = next_cursor.urlsafe() if next_cursor else None
+    key_range.count += len(hybrids)
+    key_range.rewritten += len(entities)
+    key_range.done = not more or not next_cursor
+  else:
+    key_range.done = True
+  key_range.put()
+  
+  if not key_range.done:
+    if chain:
+      deferred.defer(migrate_kind_batch, record_key, kind, batch_size=batch_size, chain=True, index=index)
+    return False
+  _finish_kind(record_key, kind)
+  return True
 
 
 class Migration(object):
+  """
+  ' Reindexes entities whose kinds gained search fields since the last
+  ' migration. run(use_tasks=True) splits each kind into `shards` key
+  ' ranges, each migrated by its own chain of deferred tasks. Progress (a
+  ' cursor and counts per key range) is stored on VenomMigrationRanges so
+  ' an interrupted migration resumes where it stopped the next time a
+  ' Migration is created and run.
+  '
+  ' NOTE: run(use_tasks=True) requires the deferred builtin to be
+  '       enabled in app.yaml.
+  """
+  
   records_model = VenomMigrationRecord
   
-  def __init__(self):
+  def __init__(self, resume=True):
     self._last_migration = self._get_last_migration()
     self._current_migration = None
     
     self._current_schema = load_search_schema().yaml
     self._last_schema = self._last_migration.schema if self._last_migration else None
     
-    if self._requires_migration():
+    if self._last_migration and self._last_migration.finished == None:
+      if not resume:
+        raise Exception('Migration in progress, cannot instantiate another')
+      self._current_migration = self._last_migration
+    elif self._requires_migration():
       self._current_migration = self._start_new_migration()
   
   def _requires_migration(self):
@@ -37,16 +178,21 @@ class Migration(object):
   def _get_last_migration(self):
     # TODO: also store current migration in memcache
     query = self.records_model.query().order(-self.records_model.started)
-    migration = query.get()
-    if not migration:
-      return None
-    if migration.finished == None:
-      raise Exception('Migration in progress, cannot instantiate another')
-    return migration
-
+    return query.get()
+  
   def _start_new_migration(self):
     search_yaml = load_search_schema()
-    migration = self.records_model(schema=search_yaml.yaml)
+    progress = {
+      kind: {
+        'properties': sorted(set(name for name, _ in properties)),
+        'ranges': 0,
+        'count': 0,
+        'rewritten': 0,
+        'done': False
+      }
+      for kind, properties in self._get_added_properties().items()
+    }
+    migration = self.records_model(schema=search_yaml.yaml, progress=progress)
     migration.put()
     return migration
   
@@ -55,15 +201,31 @@ class Migration(object):
     kinds = {}
     for kind_obj in schema['indexes']:
       kind = kind_obj['kind']
-      kinds[kind] = [ prop['name'] for prop in kind_obj['properties'] ]
+      # a changed field type counts as a new property so it gets reindexed
+      kinds[kind] = [
+        (prop['name'], prop.get('type'))
+        for prop in kind_obj['properties']
+      ]
     return kinds
   
+  def _extract_shards(self, schema):
+    if not schema: return {}
+    return {
+      kind_obj['kind']: kind_obj.get('shards', 1)
+      for kind_obj in schema['indexes']
+    }
+  
   def _get_added_properties(self):
     old_kinds = self._extract_kinds(self._last_schema)
     current_kinds = self._extract_kinds(self._current_schema)
+    old_shards = self._extract_shards(self._last_schema)
+    current_shards = self._extract_shards(self._current_schema)
     added = {}
     for kind, properties in current_kinds.items():
-      if kind in old_kinds:
+      if kind in old_kinds and old_shards.get(kind, 1) != current_shards.get(kind, 1):
+        # the kind moves to a new set of indexes, the whole kind is reindexed
+        added[kind] = properties
+      elif kind in old_kinds:
         old_properties = old_kinds[kind]
         new_properties = list(set(properties) - set(old_properties))
         if new_properties:
@@ -76,18 +238,47 @@ class Migration(object):
     self._current_migration.finished = datetime.datetime.now()
     self._current_migration.put()
   
-  def run(self, batch_size=200):
+  def get_progress(self):
+    if not self._current_migration:
+      return {}
+    record_key = self._current_migration.key
+    progress = record_key.get().progress or {}
+    for kind, kind_progress in progress.items():
+      if kind_progress['done'] or not kind_progress.get('ranges'):
+        continue
+      # running kinds report through their ranges
+      ranges = [
+        key_range for key_range in ndb.get_multi(_range_keys(record_key, kind, kind_progress['ranges']))
+        if key_range
+      ]
+      kind_progress['count'] = sum(key_range.count for key_range in ranges)
+      kind_progress['rewritten'] = sum(key_range.rewritten for key_range in ranges)
+    return progress
+  
+  def run(self, batch_size=200, use_tasks=False, shards=8):
     if not self._current_migration:
       return 0
-    kinds_updated = 0
-    kinds = self._get_added_properties()
+    record_key = self._current_migration.key
+    progress = self._current_migration.progress or {}
+    
+    kinds = [
+      kind for kind, kind_progress in progress.items()
+      if not kind_progress['done']
+    ]
+    if not kinds:
+      self._finish()
+      return 0
+    
+    if use_tasks:
+      # every key range of every kind is a chain of batches, they all run in parallel
+      for kind in kinds:
+        for index in range(len(_split_kind(record_key, kind, shards))):
+          deferred.defer(migrate_kind_batch, record_key, kind, batch_size=batch_size, chain=True, index=index)
+      return len([kind for kind in kinds if kind in Model.kinds])
+    
     for kind in kinds:
-      if kind in Model.kinds:
-        model = Model.kinds[kind]
-        entities = model.all()
-        for i in range(0, len(entities), batch_size):
-          group = entities[i: i + batch_size]
-          model.save_multi(group)
-        kinds_updated += 1
-    self._finish()
-    return kinds_updated
+      for index in range(len(_split_kind(record_key, kind, 1))):
+        while not migrate_kind_batch(record_key, kind, batch_size=batch_size, index=index):
+          pass
+    self._current_migration = record_key.get()
+    return len([kind for kind in kinds if kind in Model.kinds])
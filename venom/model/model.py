@@ -1,18 +1,44 @@
 # system imports
+import datetime
 import inspect
+import json
 import os
+import zlib
+
+# app engine imports
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+from google.appengine.ext import deferred
 
 # package imports
-from ..internal.hybrid_model import HybridModel
+from ..internal.hybrid_model import HybridModel, EVENTUAL, STRONG, validate_rpc_options
 from ..internal.index_yaml import update_index_yaml
 from ..internal.search_yaml import update_search_yaml
+from aggregate import Aggregate
+from columns import raw_values
 from attribute import ModelAttribute
+from kind_cache import KindCache
+from loader import current_loader
+from negative_cache import NegativeCache
 from Properties import Property
 from Properties import Model as ModelProperty
-from query import Query, QueryParameter
+from Properties import DateTime as DateTimeProperty
+from Properties import refresh_snapshots
+from query import Query, QueryParameter, QueryPlan, QueryResults
+from reindex import enqueue_search_indexing, pending_search_key, pending_search_markers
+from write_back import WriteBackBuffer
+
+
+__all__ = ['Model', 'MetaModel', 'PropertySchema', 'ModelSchema', 'EVENTUAL', 'STRONG']
+
 
+def pack_values(values):
+  """ serializes stored property values into one compressed blob """
+  return zlib.compress(json.dumps(values, sort_keys=True, separators=(',', ':')))
 
-__all__ = ['Model', 'MetaModel', 'PropertySchema', 'ModelSchema']
+
+def unpack_values(blob):
+  return json.loads(zlib.decompress(blob))
 
 
 def run_migration_if_dev():
@@ -37,33 +63,48 @@ class MetaModel(type):
 
 
 class PropertySchema(object):
-  def __init__(self, property, datastore=False, search=False, indexed_datastore=False):
+  def __init__(self, property, datastore=False, search=False, indexed_datastore=False, packed=False):
     self.property = property
     self.datastore = datastore
     self.search = search
     self.indexed_datastore = indexed_datastore
+    self.packed = packed
+    self.search_operators = set()
+    # stored names datastore queries filter on, shadows included
+    self.datastore_names = set()
+  
+  @property
+  def search_field(self):
+    """ the search.Field class used when this property is indexed by the search api """
+    if not self.search:
+      return None
+    return self.property.to_search_field(operators=frozenset(self.search_operators))
   
   def __eq__(self, value):
     return (
       self.property.__equals__(value.property) and
       self.search == value.search and
       self.datastore == value.datastore and
-      self.indexed_datastore == value.indexed_datastore
+      self.indexed_datastore == value.indexed_datastore and
+      self.packed == value.packed and
+      self.search_field == value.search_field
     )
   
   def __repr__(self):
-    return 'PropertySchema({}, datastore={}, search={}, indexed_datastore={})'.format(
+    return 'PropertySchema({}, datastore={}, search={}, indexed_datastore={}, packed={}, search_field={})'.format(
       self.property,
       self.datastore,
       self.search,
-      self.indexed_datastore
+      self.indexed_datastore,
+      self.packed,
+      self.search_field.__name__ if self.search_field else None
     )
 
 
 class ModelSchema(dict):
   def __init__(self, model, properties, queries):
-    schema = self._build_schema(properties, queries)
     self._model = model
+    schema = self._build_schema(properties, queries)
     super(ModelSchema, self).__init__(schema)
   
   def __eq__(self, value):
@@ -77,7 +118,11 @@ class ModelSchema(dict):
   
   def _build_schema(self, properties, queries):
     schema = {
-      name: PropertySchema(prop, datastore=True)
+      name: PropertySchema(
+        prop,
+        datastore=prop.stored and not prop.search_only,
+        search=prop.stored and prop.search_only
+      )
       for name, prop in properties.items()
     }
     
@@ -88,8 +133,18 @@ class ModelSchema(dict):
         prop_name = comparison.property._name
         if uses_datastore:
           schema[prop_name].indexed_datastore = True
+          schema[prop_name].datastore_names.add(comparison.get_name())
         else:
           schema[prop_name].search = True
+          schema[prop_name].search_operators.add(comparison.operator)
+    
+    if self._model.packed:
+      for prop_schema in schema.values():
+        prop_schema.packed = (
+          prop_schema.datastore and
+          not prop_schema.indexed_datastore and
+          prop_schema.property.packable
+        )
     
     return schema
   
@@ -121,10 +176,72 @@ def generate_ownership_descriptor(child, query):
   return OwnershipDescriptor()
 
 
+class AncestorQuery(object):
+  """
+  ' Children of an owner for belongs_to_ancestor models. Children are
+  ' stored under their owner's key, so this is a strongly consistent
+  ' ancestor query that needs no index.
+  """
+  
+  def __init__(self, child, owner):
+    self.child = child
+    self.owner = owner
+  
+  def __call__(self, owner):
+    document_id = owner.key if isinstance(owner, Model) else owner
+    ancestor = self.owner.hybrid_model._document_id_to_key(document_id)
+    hybrids = self.child.hybrid_model.query_by_ancestor(ancestor, options=self.child._get_rpc_options())
+    return QueryResults(self.child._execute_query(hybrids), model=self.child)
+
+
 class Model(object):
   __metaclass__ = MetaModel
   
   belongs_to = None
+  # create entities under their (single) owner's key, ownership queries
+  # become ancestor queries and ownership checks compare key prefixes
+  belongs_to_ancestor = False
+  
+  # set on instances stored inside another entity by Properties.Embedded
+  _embedded = False
+  
+  # store every unindexed property in a single compressed blob
+  packed = False
+  packed_property = '_packed'
+  
+  # 'deferred' writes search documents from a task queue worker after the
+  # datastore put, so saves only wait on the datastore
+  search_indexing = 'sync'
+  search_indexing_queue = 'default'
+  search_indexing_delay = 1
+  # hash search documents across this many indexes for kinds whose puts
+  # outgrow the throughput of a single index. changing it requires a reindex
+  search_shards = 1
+  
+  # name of a DateTime property holding when an entity expires. expired
+  # entities are hidden from reads and deleted by venom.sweep_expired
+  expires_at = None
+  # seconds (or a timedelta) an entity lives, fills expires_at on save
+  ttl = None
+  ttl_property = 'expires'
+  
+  # keep the whole kind in memory and answer every Query from it, for
+  # small reference tables that rarely change
+  cache_all = False
+  cache_check_interval = 1.0
+  
+  # entity groups one cross group transaction may write, saves of models
+  # with aggregates are chunked to stay within it
+  transaction_groups = 25
+  
+  # seconds gets remember that a document id does not exist, in process
+  # memory and memcache, so repeated lookups of bad ids need no rpc
+  negative_cache_ttl = None
+  
+  # default ndb and search api options of every rpc on this kind: deadline,
+  # read_policy (EVENTUAL or STRONG), batch_size, prefetch_size, use_cache
+  # and use_memcache. Queries and calls override them per option
+  rpc_options = None
   
   auto_migrate_in_dev = True
   kinds = {}
@@ -138,12 +255,64 @@ class Model(object):
     from Properties import Property
     cls.kind = cls.__name__
     cls.kinds[cls.kind] = cls
-    cls.hybrid_model = type(cls.kind, (HybridModel,), {})
+    cls.hybrid_model = type(cls.kind, (HybridModel,), { 'search_shards': cls.search_shards })
+    cls.rpc_options = validate_rpc_options(cls.rpc_options)
     cls._owners = cls._link_owners()
+    cls._snapshot_references = []
     cls.all = Query()
+    if cls.ttl != None and cls.expires_at == None:
+      cls.expires_at = cls.ttl_property
+      if not hasattr(cls, cls.ttl_property):
+        setattr(cls, cls.ttl_property, DateTimeProperty(hidden=True))
     cls._properties = ModelAttribute.connect(cls, kind=Property)
+    if cls.expires_at:
+      cls._expired = cls._expiry_query()
+    cls._aggregates = ModelAttribute.connect(cls, kind=Aggregate)
+    cls._aggregate_names = set()
+    for aggregate in cls._aggregates.values():
+      cls._aggregate_names.update(aggregate._property_names())
     cls._queries = ModelAttribute.connect(cls, kind=Query)
     cls._schema = ModelSchema(cls, cls._properties, cls._queries)
+    cls._search_only_properties = [
+      name for name, prop in cls._properties.items()
+      if prop.search_only
+    ]
+    if not cls.search_indexing in ('sync', 'deferred'):
+      raise Exception(
+        "{}.search_indexing must be 'sync' or 'deferred', got {}"
+        .format(cls.__name__, cls.search_indexing)
+      )
+    if cls.search_indexing == 'deferred' and cls._search_only_properties:
+      raise Exception(
+        '{} cannot defer search indexing, search only properties {} are not in the datastore'
+        .format(cls.__name__, ', '.join(sorted(cls._search_only_properties)))
+      )
+    if cls.cache_all and cls._search_only_properties:
+      raise Exception(
+        '{} cannot be cached in memory, search only properties {} are not in the datastore'
+        .format(cls.__name__, ', '.join(sorted(cls._search_only_properties)))
+      )
+    cls._kind_cache = KindCache(cls, check_interval=cls.cache_check_interval) if cls.cache_all else None
+    cls._negative_cache = NegativeCache(cls, cls.negative_cache_ttl) if cls.negative_cache_ttl else None
+    cls._write_back_properties = [
+      name for name, prop in cls._properties.items()
+      if prop.write_back
+    ]
+    cls._write_back = None
+    if cls._write_back_properties:
+      interval = min(cls._properties[name].write_back for name in cls._write_back_properties)
+      cls._write_back = WriteBackBuffer(cls, interval)
+  
+  @classmethod
+  def _expiry_query(cls):
+    """ makes sure expires_at is indexed so expired entities can be swept """
+    prop = cls._properties.get(cls.expires_at)
+    if not isinstance(prop, DateTimeProperty):
+      raise Exception(
+        '{}.expires_at must name a DateTime property, got {!r}'
+        .format(cls.__name__, cls.expires_at)
+      )
+    return Query(prop <= QueryParameter)
   
   @classmethod
   def _link_owners(cls):
@@ -151,6 +320,11 @@ class Model(object):
     owner_dict = {}
     if not cls.belongs_to: return owner_dict
     owners = cls.belongs_to if isinstance(cls.belongs_to, list) else [cls.belongs_to]
+    if cls.belongs_to_ancestor and len(owners) != 1:
+      raise Exception(
+        '{}.belongs_to_ancestor requires exactly one owner in belongs_to, an entity has a single parent'
+        .format(cls.__name__)
+      )
     for owner in owners:
       if not inspect.isclass(owner) or not issubclass(owner, Model):
         raise Exception(
@@ -164,10 +338,14 @@ class Model(object):
           .format(owner.__name__, cls.__name__, name)
         )
       prop = ModelProperty(owner, required=True)
-      query = Query(prop == QueryParameter)
+      if cls.belongs_to_ancestor:
+        query = AncestorQuery(cls, owner)
+        cls.hybrid_model.parent = owner.hybrid_model
+      else:
+        query = Query(prop == QueryParameter)
+        setattr(cls, '__query_{}'.format(name), query)
       owner._register_ownership(cls, query)
       setattr(cls, name, prop)
-      setattr(cls, '__query_{}'.format(name), query)
       owner_dict[name] = query
     return owner_dict
   
@@ -186,6 +364,8 @@ class Model(object):
     super(Model, self).__init__()
     self.hybrid_entity = self.hybrid_model()
     self.key = None
+    self._deferred_loaders = {}
+    self._write_back_assigned = set()
     self._connect_properties()
     self._connect_queries()
     self.populate(**kwargs)
@@ -200,24 +380,103 @@ class Model(object):
   
   @classmethod
   def _to_route_parameters(cls):
-    return {
+    parameters = {
       key: prop.to_route_parameter()
       for key, prop in cls._properties.items()
     }
+    return {
+      key: parameter
+      for key, parameter in parameters.items()
+      if parameter != None
+    }
+  
+  @classmethod
+  def _get_rpc_options(cls, *overrides):
+    """ the model's rpc options updated by each of `overrides` in order """
+    options = dict(cls.rpc_options)
+    for override in overrides:
+      options.update(validate_rpc_options(override))
+    return options
+  
+  @classmethod
+  def _execute_datastore_query(cls, query, options=None):
+    options = cls._get_rpc_options(options)
+    return cls._execute_query(cls.hybrid_model.query_by_datastore(query, options=options))
   
   @classmethod
-  def _execute_datastore_query(cls, query):
-    return cls._execute_query(cls.hybrid_model.query_by_datastore(query))
+  def _execute_search_query(cls, query, options=None):
+    # search only values come back with the documents instead of a get per entity
+    ids_only = not cls._search_only_properties
+    options = cls._get_rpc_options(options)
+    return cls._execute_query(cls.hybrid_model.query_by_search(query, ids_only=ids_only, options=options))
   
   @classmethod
-  def _execute_search_query(cls, query):
-    return cls._execute_query(cls.hybrid_model.query_by_search(query))
+  def _execute_memory_query(cls, query):
+    cache = cls._kind_cache
+    cache.refresh()
+    ndb_entities = cache.get_entities(query.evaluate(cache))
+    return cls._execute_query([ cls.hybrid_model(entity=ndb_entity) for ndb_entity in ndb_entities ])
+  
+  @classmethod
+  def _fetch_raw(cls, plan, options=None):
+    """ the raw datastore entities a query plan matches, no model is created """
+    options = cls._get_rpc_options(options)
+    if plan.backend == QueryPlan.MEMORY:
+      cache = cls._kind_cache
+      cache.refresh()
+      ndb_entities = cache.get_entities(plan.query.evaluate(cache))
+    elif plan.backend == QueryPlan.DATASTORE:
+      ndb_entities = cls.hybrid_model.query_by_datastore(plan.query, options=options, raw=True)
+    else:
+      ndb_entities = cls.hybrid_model.query_by_search(plan.query, options=options, raw=True)
+    if cls.expires_at:
+      now = cls._properties[cls.expires_at]._to_storage(datetime.datetime.now())
+      expires = raw_values(cls, ndb_entities, cls.expires_at)
+      ndb_entities = [
+        ndb_entity for ndb_entity, expires_at in zip(ndb_entities, expires)
+        if expires_at == None or expires_at > now
+      ]
+    return ndb_entities
   
   @classmethod
   def _execute_query(cls, results):
     entities = map(cls._entity_to_model, results)
+    if cls._write_back:
+      cls._write_back.merge(entities)
+    if cls.expires_at:
+      entities = [entity for entity in entities if not entity.is_expired()]
+    loader = current_loader()
+    if loader:
+      for entity in entities:
+        loader.prime(cls, entity)
+      cls._queue_references(loader, entities)
     return entities
   
+  def is_expired(self, now=None):
+    if not self.expires_at:
+      return False
+    expires = getattr(self, self.expires_at)
+    return expires != None and expires <= (now or datetime.datetime.now())
+  
+  @classmethod
+  def _hide_expired(cls, entity):
+    if entity and entity.is_expired():
+      return None
+    return entity
+  
+  @classmethod
+  def _get_stored_values(cls, ndb_entity):
+    """ stored values of a raw datastore entity, including packed ones """
+    values = {
+      name: prop._get_value(ndb_entity)
+      for name, prop in ndb_entity._properties.items()
+    }
+    packed = values.pop(cls.packed_property, None)
+    if packed != None:
+      for name, value in unpack_values(packed).items():
+        values.setdefault(name, value)
+    return values
+  
   @classmethod
   def _entity_to_model(cls, hybrid_entity):
     if not hybrid_entity:
@@ -228,6 +487,18 @@ class Model(object):
     entity._populate_from_stored(**properties)
     entity.hybrid_entity = hybrid_entity
     entity.key = entity.hybrid_entity.document_id
+    for prop in cls._properties.values():
+      prop._load_shadow_values(entity, properties)
+    search_only = [name for name in cls._search_only_properties if not name in properties]
+    if search_only:
+      entity._defer_values(search_only, hybrid_entity.get_document_values)
+    packed = properties.get(cls.packed_property)
+    if packed != None:
+      unpacked = [
+        name for name, prop_schema in cls._schema.items()
+        if prop_schema.datastore and not name in properties
+      ]
+      entity._defer_values(unpacked, lambda: unpack_values(packed))
     return entity
   
   def populate(self, **kwargs):
@@ -241,6 +512,25 @@ class Model(object):
         prop = self._properties[key]
         prop._set_stored_value(self, value)
   
+  def _defer_values(self, names, loader):
+    """ loader is called once, on first access of any of names, and returns stored values """
+    for name in names:
+      self._deferred_loaders[name] = loader
+  
+  def _load_deferred_values(self, name):
+    loader = self._deferred_loaders.get(name)
+    if not loader:
+      return
+    names = [key for key, value in self._deferred_loaders.items() if value is loader]
+    for key in names:
+      del self._deferred_loaders[key]
+    values = loader()
+    self._populate_from_stored(**{
+      key: values[key]
+      for key in names
+      if key in values
+    })
+  
   def _set_key(self, key):
     document_id = key.pairs()[0][1]
     self.key = document_id
@@ -253,19 +543,34 @@ class Model(object):
       for key, prop in self._properties.items()
       if not prop.hidden
     }
-    json['key'] = self.key
+    if not self._embedded:
+      json['key'] = self.key
     return json
   
   @classmethod
   def _set_hybrid_entity_values(cls, entity):
+    if entity.ttl != None and getattr(entity, entity.expires_at) == None:
+      ttl = entity.ttl if isinstance(entity.ttl, datetime.timedelta) else datetime.timedelta(seconds=entity.ttl)
+      setattr(entity, entity.expires_at, datetime.datetime.now() + ttl)
+    packed = {}
     for key, prop_schema in entity._schema.items():
       prop = prop_schema.property
       value = prop._get_stored_value(entity)
       prop._validate_before_save(entity, value)
       value = prop._get_stored_value(entity)
       if prop_schema.search and value != None:
-        field = prop.to_search_field()
-        entity.hybrid_entity.set(key, value, field)
+        field = prop_schema.search_field
+        entity.hybrid_entity.set(key, prop._to_search(value), field)
+        for name, shadow_value in prop._get_search_shadow_values(value):
+          entity.hybrid_entity.set(name, shadow_value, field)
+      if not prop_schema.datastore:
+        continue
+      for name, shadow_value, shadow_property in prop._get_shadow_values(entity):
+        entity.hybrid_entity.set(name, shadow_value, shadow_property)
+      if prop_schema.packed:
+        if value != None:
+          packed[key] = value
+        continue
       property = prop.to_datastore_property()
       if prop_schema.indexed_datastore:
         if inspect.isclass(property):
@@ -273,34 +578,344 @@ class Model(object):
         else:
           property._indexed = True
       entity.hybrid_entity.set(key, value, property)
+    if entity.packed:
+      entity.hybrid_entity.set(entity.packed_property, pack_values(packed), ndb.BlobProperty)
+    if entity.belongs_to_ancestor:
+      cls._set_parent_key(entity)
   
-  def save(self):
+  @classmethod
+  def _set_parent_key(cls, entity):
+    name, = cls._owners.keys()
+    owner_id = cls._properties[name]._get_stored_value(entity)
+    if entity.key == None:
+      entity.hybrid_entity.parent_key = cls.hybrid_model.parent._document_id_to_key(owner_id)
+    elif '.' in str(entity.key) and not cls.is_owned_by(entity.key, owner_id):
+      # entities with plain ids predate belongs_to_ancestor and keep their root key
+      raise Exception(
+        'Cannot move {} {} to owner {}, the owner is part of the key of belongs_to_ancestor models'
+        .format(cls.kind, entity.key, owner_id)
+      )
+  
+  @classmethod
+  def is_owned_by(cls, document_id, owner):
+    """ ownership from the key alone, without reading either entity """
+    if not cls.belongs_to_ancestor:
+      raise Exception('{}.is_owned_by requires belongs_to_ancestor = True'.format(cls.__name__))
+    owner_id = owner.key if isinstance(owner, Model) else owner
+    if owner_id == None:
+      return False
+    parent_id, _, _ = str(document_id).rpartition('.')
+    if not parent_id:
+      # stored before belongs_to_ancestor was set, only the entity knows its owner
+      entity = cls.get(document_id)
+      name, = cls._owners.keys()
+      return entity != None and str(cls._properties[name]._get_stored_value(entity)) == str(owner_id)
+    return parent_id == str(owner_id)
+  
+  @classmethod
+  def _aggregate_values_of(cls, ndb_entity):
+    if ndb_entity == None:
+      return None
+    values = cls._get_stored_values(ndb_entity)
+    return { name: values.get(name) for name in cls._aggregate_names }
+  
+  @classmethod
+  def _update_aggregates(cls, key, old, new):
+    """ in the transaction writing the entity, returns the cache keys to delete once it committed """
+    cache_keys = []
+    for aggregate in cls._aggregates.values():
+      cache_keys += aggregate.update(key, old, new)
+    return cache_keys
+  
+  @classmethod
+  def _aggregate_chunk_size(cls):
+    # each entity's group, its pending search marker's and the old and new
+    # group record of every aggregate, an entity updates one shard per group
+    groups = 1 + 2 * len(cls._aggregates) + (1 if cls.search_indexing == 'deferred' else 0)
+    return max(1, cls.transaction_groups // groups)
+  
+  @classmethod
+  def _datastore_writer(cls):
+    """ the datastore writer of saves, None for a plain put_multi """
+    if cls._aggregates:
+      return cls._put_aggregated
+    if cls.search_indexing == 'deferred':
+      return cls._put_with_markers
+    return None
+  
+  @classmethod
+  def _pending_markers(cls, ndb_entities):
+    """ the pending search markers of the entities, whose keys are allocated first """
+    if cls.search_indexing != 'deferred':
+      return []
+    cls.hybrid_model.allocate_keys(ndb_entities)
+    return pending_search_markers(cls, [
+      cls.hybrid_model._key_to_document_id(ndb_entity.key)
+      for ndb_entity in ndb_entities
+    ])
+  
+  @classmethod
+  def _put_with_markers(cls, ndb_entities, options):
+    ndb.put_multi(ndb_entities + cls._pending_markers(ndb_entities), **options)
+  
+  @classmethod
+  def _put_aggregated(cls, ndb_entities, options):
+    """
+    ' Puts entities and applies their aggregate deltas in one cross group
+    ' transaction per chunk. The deltas come from the entities as stored
+    ' when the transaction reads them, so concurrent saves can't drift.
+    """
+    markers = cls._pending_markers(ndb_entities)
+    cache_keys = []
+    size = cls._aggregate_chunk_size()
+    for i in range(0, len(ndb_entities), size):
+      chunk = ndb_entities[i: i + size]
+      chunk_markers = markers[i: i + size]
+      cache_keys += ndb.transaction(lambda: cls._put_aggregated_chunk(chunk, chunk_markers, options), xg=True)
+    if cache_keys:
+      memcache.delete_multi(cache_keys)
+  
+  @classmethod
+  def _put_aggregated_chunk(cls, ndb_entities, markers, options):
+    keys = [
+      ndb_entity.key if ndb_entity.key and ndb_entity.key.id() else None
+      for ndb_entity in ndb_entities
+    ]
+    existing = [key for key in keys if key]
+    stored = dict(zip(existing, ndb.get_multi(existing))) if existing else {}
+    previous = [ cls._aggregate_values_of(stored.get(key)) if key else None for key in keys ]
+    ndb.put_multi(ndb_entities + markers, **options)
+    cache_keys = []
+    for old, ndb_entity in zip(previous, ndb_entities):
+      cache_keys += cls._update_aggregates(ndb_entity.key, old, cls._aggregate_values_of(ndb_entity))
+    return cache_keys
+  
+  @classmethod
+  def _delete_aggregated(cls, document_ids):
+    """ deletes the entities and applies their aggregate deltas transactionally, returns the cache keys to delete """
+    keys = [ cls.hybrid_model._document_id_to_key(document_id) for document_id in document_ids ]
+    cache_keys = []
+    size = cls._aggregate_chunk_size()
+    for i in range(0, len(keys), size):
+      chunk = keys[i: i + size]
+      cache_keys += ndb.transaction(lambda: cls._delete_aggregated_chunk(chunk), xg=True)
+    return cache_keys
+  
+  @classmethod
+  def _delete_aggregated_chunk(cls, keys):
+    stored = ndb.get_multi(keys)
+    ndb.delete_multi(keys)
+    cache_keys = []
+    for ndb_entity in stored:
+      if ndb_entity:
+        cache_keys += cls._update_aggregates(ndb_entity.key, cls._aggregate_values_of(ndb_entity), None)
+    return cache_keys
+  
+  def save(self, **options):
     self._set_hybrid_entity_values(self)
-    self.hybrid_entity.put()
+    snapshots = self._stored_snapshot_values([self])
+    index_search = self.search_indexing == 'sync'
+    self.hybrid_entity.put(
+      index_search=index_search,
+      options=self._get_rpc_options(options),
+      datastore_writer=self._datastore_writer()
+    )
     self.key = self.hybrid_entity.document_id
+    if not index_search:
+      enqueue_search_indexing(self)
+    if self.cache_all:
+      self._kind_cache.invalidate()
+    self._refresh_snapshots([self], snapshots)
+    self._clear_write_back([self])
+    self._prime_loader([self])
+    if self._negative_cache:
+      self._negative_cache.forget([self.key])
     return self
   
   @classmethod
-  def get(cls, document_id):
-    entity = cls.hybrid_model.get(document_id)
-    return cls._entity_to_model(entity)
+  def _prime_loader(cls, entities):
+    """ later gets in the active Loader scope see the saved values """
+    loader = current_loader()
+    if loader:
+      for entity in entities:
+        loader.prime(entity.__class__, entity)
   
   @classmethod
-  def get_multi(cls, document_ids):
-    hybrid_entities = cls.hybrid_model.get_multi(document_ids)
+  def _clear_write_back(cls, entities):
+    """ values assigned directly were just saved, older buffered values must not override them """
+    for entity in entities:
+      if entity._write_back_assigned:
+        entity._write_back.clear([entity.key], entity._write_back_assigned)
+        entity._write_back_assigned = set()
+  
+  @classmethod
+  def _stored_snapshot_values(cls, entities):
+    """ the stored values of the entities before a save, None for new entities """
+    if not cls._snapshot_references:
+      return None
+    return [
+      cls._get_stored_values(entity.hybrid_entity.datastore_entity.get_entity() or cls.hybrid_model.model()) if entity.key else None
+      for entity in entities
+    ]
+  
+  @classmethod
+  def _refresh_snapshots(cls, entities, previous):
+    """ rewrites the embedded copies held by models referencing this one with refresh=True """
+    if not previous:
+      return
+    for model, name in cls._snapshot_references:
+      fields = model._properties[name].embed
+      # new entities are not referenced yet, saves of other fields keep the snapshots current
+      document_ids = [
+        entity.key for entity, values in zip(entities, previous)
+        if values != None and any(
+          values.get(field) != entity._properties[field]._get_stored_value(entity)
+          for field in fields
+        )
+      ]
+      if document_ids:
+        deferred.defer(refresh_snapshots, model.kind, name, document_ids)
+  
+  @classmethod
+  def get(cls, document_id, **options):
+    return cls.get_multi([document_id], **options)[0]
+  
+  @classmethod
+  def get_multi(cls, document_ids, **options):
+    loader = current_loader()
+    if loader and not options:
+      document_ids = [
+        cls.hybrid_model._key_to_document_id(document_id) if isinstance(document_id, ndb.Key) else document_id
+        for document_id in document_ids
+      ]
+      futures = loader.load_many(cls, document_ids)
+      return [ future.get_result() for future in futures ]
+    return cls._load_hybrids(cls._get_hybrids(document_ids, cls._get_rpc_options(options)))
+  
+  @classmethod
+  def _get_hybrids(cls, document_ids, options):
+    cache = cls._negative_cache
+    if not cache:
+      return cls.hybrid_model.get_multi(document_ids, options=options)
+    document_ids = [
+      cls.hybrid_model._key_to_document_id(document_id) if isinstance(document_id, ndb.Key) else document_id
+      for document_id in document_ids
+    ]
+    missing = cache.missing(document_ids)
+    to_get = [document_id for document_id in document_ids if not document_id in missing]
+    grabbed = dict(zip(to_get, cls.hybrid_model.get_multi(to_get, options=options))) if to_get else {}
+    cache.record([document_id for document_id, hybrid in grabbed.items() if not hybrid])
+    return [grabbed.get(document_id) for document_id in document_ids]
+  
+  @classmethod
+  def _load_hybrids(cls, hybrid_entities):
     entities = map(cls._entity_to_model, hybrid_entities)
-    return entities
+    if cls._write_back:
+      cls._write_back.merge(entities)
+    loader = current_loader()
+    if loader:
+      cls._queue_references(loader, [ entity for entity in entities if entity ])
+    return map(cls._hide_expired, entities)
+  
+  @classmethod
+  def _queue_references(cls, loader, entities):
+    """ referenced entities are fetched together on the first access of any of them """
+    for prop in cls._properties.values():
+      if not isinstance(prop, ModelProperty):
+        continue
+      for entity in entities:
+        if prop._needs_get(entity):
+          loader.load(prop.model, entity._values[prop._name])
   
   @classmethod
-  def save_multi(cls, entities):
+  def save_multi(cls, entities, **options):
     hybrid_entities = []
     for entity in entities:
       cls._set_hybrid_entity_values(entity)
       hybrid_entities.append(entity.hybrid_entity)
-    cls.hybrid_model.put_multi(hybrid_entities)
+    snapshots = cls._stored_snapshot_values(entities)
+    index_search = cls.search_indexing == 'sync'
+    cls.hybrid_model.put_multi(
+      hybrid_entities,
+      index_search=index_search,
+      options=cls._get_rpc_options(options),
+      datastore_writer=cls._datastore_writer()
+    )
     for entity in entities:
       entity.key = entity.hybrid_entity.document_id
+    if not index_search and entities:
+      enqueue_search_indexing(cls)
+    if cls.cache_all and entities:
+      cls._kind_cache.invalidate()
+    cls._refresh_snapshots(entities, snapshots)
+    cls._clear_write_back(entities)
+    cls._prime_loader(entities)
+    if cls._negative_cache:
+      cls._negative_cache.forget([entity.key for entity in entities])
   
   def delete(self):
-    return self.hybrid_entity.delete()
+    self.delete_multi([self])
+  
+  @classmethod
+  def delete_multi(cls, entities_or_ids):
+    """
+    ' Deletes entities, or document ids of this model, grouped by kind.
+    ' The datastore and search deletes of every kind run concurrently and
+    ' keys owned by properties (such as counter shards) are removed in the
+    ' same batch, along with their cached values.
+    """
+    by_kind = {}
+    for entity_or_id in entities_or_ids:
+      model = entity_or_id.__class__ if isinstance(entity_or_id, Model) else cls
+      by_kind.setdefault(model, []).append(entity_or_id)
+    
+    futures = []
+    cache_keys = []
+    for model, entities_or_ids in by_kind.items():
+      kind_futures, kind_cache_keys = model._delete_kind_async(entities_or_ids)
+      futures += kind_futures
+      cache_keys += kind_cache_keys
+    
+    for future in futures:
+      future.get_result()
+    if cache_keys:
+      memcache.delete_multi(cache_keys)
+    loader = current_loader()
+    if loader:
+      for model, entities_or_ids in by_kind.items():
+        loader.clear(model, [
+          entity_or_id.key if isinstance(entity_or_id, Model) else entity_or_id
+          for entity_or_id in entities_or_ids
+        ])
+    for model in by_kind:
+      if model.cache_all:
+        model._kind_cache.invalidate()
+  
+  @classmethod
+  def _delete_kind_async(cls, entities_or_ids):
+    document_ids = []
+    for item in entities_or_ids:
+      if not isinstance(item, Model):
+        document_ids.append(str(item))
+        continue
+      if item.key == None:
+        continue
+      document_ids.append(str(item.key))
+    
+    cache_keys = []
+    if cls._aggregates:
+      # expired entities still count towards aggregates until deleted
+      cache_keys += cls._delete_aggregated(document_ids)
+    
+    keys = []
+    for document_id in document_ids:
+      for prop in cls._properties.values():
+        prop_keys, prop_cache_keys = prop._get_delete_keys(cls.kind, document_id)
+        keys += prop_keys
+        cache_keys += prop_cache_keys
+      if cls.search_indexing == 'deferred':
+        keys.append(pending_search_key(cls, document_id))
+    
+    futures = cls.hybrid_model.delete_multi_async(document_ids, keys=keys, delete_entities=not cls._aggregates)
+    return futures, cache_keys
       
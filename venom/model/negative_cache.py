@@ -0,0 +1,91 @@
+# system imports
+import time
+
+# app engine imports
+from google.appengine.api import memcache
+
+# package imports
+from ..internal.hybrid_model import document_id_string
+
+
+__all__ = ['NegativeCache']
+
+
+class NegativeCache(object):
+  """
+  ' Remembers the document ids of a kind that were not found, for models
+  ' declared with negative_cache_ttl, so repeated gets of invalid or
+  ' deleted ids need no datastore rpc. Misses are kept in process memory
+  ' and in memcache for `ttl` seconds. Saves forget the saved ids.
+  '
+  ' NOTE: a save clears memcache and the memory of the saving process,
+  '       other processes may answer from memory for up to `ttl` seconds.
+  '       Keep the ttl short for kinds whose ids can be created after a
+  '       lookup missed them.
+  """
+  
+  # misses held in process memory before expired ones are dropped
+  max_entries = 10000
+  
+  def __init__(self, model, ttl):
+    self.model = model
+    self.ttl = ttl
+    self.entries = {}
+  
+  def _cache_key(self, document_id):
+    """ of a document_id_string, invalid ids are often not ascii """
+    return 'venom-missing:{}:{}'.format(self.model.kind, document_id)
+  
+  def _remember(self, document_id, expires):
+    if len(self.entries) >= self.max_entries:
+      now = time.time()
+      self.entries = {
+        known_id: known_expires
+        for known_id, known_expires in self.entries.items()
+        if known_expires > now
+      }
+      if len(self.entries) >= self.max_entries:
+        self.entries = {}
+    self.entries[document_id] = expires
+  
+  def missing(self, document_ids):
+    """ the document ids known to be missing """
+    now = time.time()
+    missing = set()
+    unknown = []
+    for document_id in set(document_ids):
+      expires = self.entries.get(document_id_string(document_id))
+      if expires and expires > now:
+        missing.add(document_id)
+      else:
+        unknown.append(document_id)
+    if not unknown:
+      return missing
+    keys = { document_id: self._cache_key(document_id_string(document_id)) for document_id in unknown }
+    cached = memcache.get_multi(keys.values())
+    for document_id in unknown:
+      expires = cached.get(keys[document_id])
+      if expires and expires > now:
+        missing.add(document_id)
+        self._remember(document_id_string(document_id), expires)
+    return missing
+  
+  def record(self, document_ids):
+    if not document_ids:
+      return
+    expires = time.time() + self.ttl
+    document_ids = map(document_id_string, document_ids)
+    for document_id in document_ids:
+      self._remember(document_id, expires)
+    memcache.set_multi({
+      self._cache_key(document_id): expires
+      for document_id in document_ids
+    }, time=self.ttl)
+  
+  def forget(self, document_ids):
+    if not document_ids:
+      return
+    document_ids = map(document_id_string, document_ids)
+    for document_id in document_ids:
+      self.entries.pop(document_id, None)
+    memcache.delete_multi([ self._cache_key(document_id) for document_id in document_ids ])
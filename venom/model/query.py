@@ -1,17 +1,24 @@
 # system imports
+from collections import deque, namedtuple
+import copy
 import inspect
+import logging
+import time
 
 # app engine imports
 from google.appengine.ext import ndb
 
 # package imports
+from ..internal.hybrid_model import validate_rpc_options
 from attribute import ModelAttribute
+from columns import ColumnAggregates, RawResults, stored_values, to_columns
 
 
 __all__ = [
   'QueryParameter', 'QP', 'QueryComponent', 'QueryLogicalOperator',
   'AND', 'OR', 'QueryResults', 'Query', 'PropertyComparison',
-  'QueryArgument', 'QueryArgumentList'
+  'QueryArgument', 'QueryArgumentList', 'QueryPlan', 'SlowQueryLog',
+  'SlowQueryRecord', 'MemoryComparison', 'MemoryAND', 'MemoryOR'
 ]
 
 
@@ -95,11 +102,77 @@ class QueryComponent(object):
   def get_property_comparisons(self):
     raise NotImplementedError()
   
+  def get_search_reasons(self):
+    raise NotImplementedError()
+  
   def to_datastore_query(self, args):
     raise NotImplementedError()
   
   def to_search_query(self, args):
     raise NotImplementedError()
+  
+  def to_memory_query(self, args):
+    raise NotImplementedError()
+
+
+class MemoryComparison(object):
+  """ a property comparison evaluated against the stored values of a KindCache """
+  
+  def __init__(self, name, operator, value):
+    self.name = name
+    self.operator = operator
+    self.value = value
+  
+  def _matches(self, stored):
+    if self.operator == PropertyComparison.NE:
+      return stored != self.value and (stored != None or self.value == None)
+    # like the datastore, ordering comparisons never match missing values
+    if stored == None: return False
+    if   self.operator == PropertyComparison.LT: return stored < self.value
+    elif self.operator == PropertyComparison.LE: return stored <= self.value
+    elif self.operator == PropertyComparison.GT: return stored > self.value
+    elif self.operator == PropertyComparison.GE: return stored >= self.value
+    else: raise Exception('Unknown operator')
+  
+  def evaluate(self, cache):
+    """ document ids of the cached entities that match """
+    if self.operator == PropertyComparison.EQ:
+      return cache.lookup(self.name, self.value)
+    if self.operator == PropertyComparison.IN:
+      ids = set()
+      for value in self.value:
+        ids |= cache.lookup(self.name, value)
+      return ids
+    return cache.scan(self.name, self._matches)
+  
+  def __repr__(self):
+    return '{} {} {!r}'.format(self.name, self.operator, self.value)
+
+
+class MemoryAND(object):
+  conjunction = 'AND'
+  
+  def __init__(self, *components):
+    self.components = components
+  
+  def evaluate(self, cache):
+    if not self.components:
+      return set(cache.values.keys())
+    results = sorted([component.evaluate(cache) for component in self.components], key=len)
+    return set.intersection(*results)
+  
+  def __repr__(self):
+    return '({})'.format(' {} '.format(self.conjunction).join(map(repr, self.components)))
+
+
+class MemoryOR(MemoryAND):
+  conjunction = 'OR'
+  
+  def evaluate(self, cache):
+    ids = set()
+    for component in self.components:
+      ids |= component.evaluate(cache)
+    return ids
 
 
 class PropertyComparison(QueryComponent):
@@ -110,8 +183,9 @@ class PropertyComparison(QueryComponent):
   GT = '>'
   GE = '>='
   IN = 'in'
+  PREFIX = 'startswith'
   
-  allowed_operators = frozenset((EQ, NE, LT, LE, GT, GE, IN))
+  allowed_operators = frozenset((EQ, NE, LT, LE, GT, GE, IN, PREFIX))
   
   def __init__(self, property, operator, value):
     if not operator in self.allowed_operators:
@@ -133,45 +207,74 @@ class PropertyComparison(QueryComponent):
     return QueryArgumentList()
   
   def uses_datastore(self):
+    if self.property.search_only:
+      return False
     return self.property.query_uses_datastore(self.operator, self.value)
   
   def get_property_comparisons(self):
     return [self]
   
-  def to_datastore_query(self, args):
-    prop = self.property.to_datastore_property()
-    if inspect.isclass(prop):
-      prop = prop(indexed=True, name=self.property._name)
-    else:
-      prop._name = self.property._name
-      prop._indexed = True
+  def get_search_reasons(self):
+    if self.uses_datastore():
+      return []
+    if self.property.search_only:
+      return ['{} is search only'.format(self.property._code_name)]
+    return [self.property.query_search_reason(self.operator, self.value)]
+  
+  def get_operator(self):
+    """ the operator the backends evaluate, list properties turn contains into equality """
+    return self.property._query_operator(self.operator)
+  
+  def get_name(self):
+    """ the stored property the backends compare, which may be a shadow of the property """
+    return self.property._query_name(self.operator)
+  
+  def _get_stored_value(self, args):
     value = self.value
     if isinstance(self.value, QueryParameter):
       value = self.value.get_value(args)
     elif inspect.isclass(self.value) and issubclass(self.value, QueryParameter):
       value = self.value().get_value(args)
-    value = self.property._to_storage(value)
-    if   self.operator == self.EQ: return prop == value
-    elif self.operator == self.NE: return prop != value
-    elif self.operator == self.LT: return prop < value
-    elif self.operator == self.LE: return prop <= value
-    elif self.operator == self.GT: return prop > value
-    elif self.operator == self.GE: return prop >= value
-    elif self.operator == self.IN: return prop.IN(value)
+    return self.property._to_query_value(self.operator, value)
+  
+  def to_datastore_query(self, args):
+    prop = self.property.to_datastore_property()
+    if inspect.isclass(prop):
+      prop = prop(indexed=True, name=self.get_name())
+    else:
+      prop._name = self.get_name()
+      prop._indexed = True
+    value = self._get_stored_value(args)
+    operator = self.get_operator()
+    if   operator == self.EQ: return prop == value
+    elif operator == self.NE: return prop != value
+    elif operator == self.LT: return prop < value
+    elif operator == self.LE: return prop <= value
+    elif operator == self.GT: return prop > value
+    elif operator == self.GE: return prop >= value
+    elif operator == self.IN: return prop.IN(value)
     else: raise Exception('Unknown operator')
   
   def to_search_query(self, args):
-    value = self.value
-    if isinstance(self.value, QueryParameter):
-      value = self.value.get_value(args)
-    elif inspect.isclass(self.value) and issubclass(self.value, QueryParameter):
-      value = self.value().get_value(args)
-    value = self.property._to_storage(value)
-    if isinstance(value, str):
-      value = '"{}"'.format(value.replace('"', '\\"'))
-    if self.operator == self.NE:
-      return '(NOT {} = {})'.format(self.property._name, value)
-    return '{} {} {}'.format(self.property._name, self.operator, value)
+    if self.operator == self.PREFIX:
+      raise Exception(
+        '{}.startswith() can only run on the datastore, the query uses the search api'
+        .format(self.property._code_name)
+      )
+    value = self._get_stored_value(args)
+    operator = self.get_operator()
+    if isinstance(value, basestring):
+      # quoted as a phrase, request values are unicode and may hold several words
+      if isinstance(value, str):
+        value = value.decode('utf-8')
+      value = u'"{}"'.format(value.replace(u'\\', u'\\\\').replace(u'"', u'\\"'))
+    if operator == self.NE:
+      return u'(NOT {} = {})'.format(self.get_name(), value)
+    return u'{} {} {}'.format(self.get_name(), operator, value)
+  
+  def to_memory_query(self, args):
+    value = self._get_stored_value(args)
+    return MemoryComparison(self.get_name(), self.get_operator(), value)
   
   """ [end] QueryComponent implementation """
 
@@ -179,6 +282,7 @@ class PropertyComparison(QueryComponent):
 class QueryLogicalOperator(QueryComponent):
   datastore_conjuntion = None
   search_conjunction = None
+  memory_conjunction = None
   
   def __init__(self, *components):
     self.components = components
@@ -205,6 +309,14 @@ class QueryLogicalOperator(QueryComponent):
       property_comparisons.extend(component.get_property_comparisons())
     return property_comparisons
   
+  def get_search_reasons(self):
+    reasons = []
+    for component in self.components:
+      for reason in component.get_search_reasons():
+        if not reason in reasons:
+          reasons.append(reason)
+    return reasons
+  
   def to_datastore_query(self, args):
     if self.datastore_conjuntion == None:
       raise ValueError('self.datastore_conjuntion cannot be None')
@@ -217,8 +329,15 @@ class QueryLogicalOperator(QueryComponent):
     if self.datastore_conjuntion == None:
       raise ValueError('self.search_conjunction cannot be None')
     query_strings = map(lambda component: component.to_search_query(args), self.components)
-    query_string = ' {} '.format(self.search_conjunction).join(query_strings)
-    return '({})'.format(query_string)
+    query_string = u' {} '.format(self.search_conjunction).join(query_strings)
+    return u'({})'.format(query_string)
+  
+  def to_memory_query(self, args):
+    if self.memory_conjunction == None:
+      raise ValueError('self.memory_conjunction cannot be None')
+    # components consume args in order, exactly like the other backends
+    return self.memory_conjunction(
+      *map(lambda component: component.to_memory_query(args), self.components))
   
   """ [end] QueryComponent implementation """
 
@@ -226,14 +345,20 @@ class QueryLogicalOperator(QueryComponent):
 class AND(QueryLogicalOperator):
   datastore_conjuntion = ndb.AND
   search_conjunction = 'AND'
+  memory_conjunction = MemoryAND
 
 
 class OR(QueryLogicalOperator):
   datastore_conjuntion = ndb.OR
   search_conjunction = 'OR'
+  memory_conjunction = MemoryOR
 
 
-class QueryResults(list):
+class QueryResults(list, ColumnAggregates):
+  def __init__(self, results=(), model=None):
+    super(QueryResults, self).__init__(results)
+    self.model = model
+  
   def get(self):
     return self[0] if len(self) > 0 else None
   
@@ -242,37 +367,225 @@ class QueryResults(list):
   
   def fetch(self, count, offset=0):
     return self[offset: offset + count]
+  
+  def _results_model(self):
+    if self.model:
+      return self.model
+    if not self:
+      raise Exception('Empty QueryResults without a model have no columns')
+    return self[0].__class__
+  
+  def _key_values(self, name):
+    return stored_values(self._results_model(), self, name)
+  
+  def to_columns(self, names, use_numpy=None):
+    """
+    ' { name: Column } holding the stored values of each numeric property
+    ' in a typed array, read from the raw datastore entities of the
+    ' loaded models. use_numpy defaults to whether numpy is installed.
+    ' Query.raw skips creating the models altogether.
+    """
+    model = self._results_model()
+    return to_columns(model, names, lambda name: stored_values(model, self, name), use_numpy=use_numpy)
+
+
+class QueryPlan(object):
+  """
+  ' Describes how a Query will be executed for a given set of
+  ' arguments: which backend it runs on, why it cannot run on the
+  ' datastore (if it cannot), the generated ndb filter or search
+  ' string and the indexes the backend needs to answer it.
+  """
+  
+  DATASTORE = 'datastore'
+  SEARCH = 'search'
+  MEMORY = 'memory'
+  
+  def __init__(self, kind, backend, query, reasons=None, indexes=None):
+    self.kind = kind
+    self.backend = backend
+    self.query = query
+    self.reasons = reasons if reasons else []
+    self.indexes = indexes if indexes else []
+  
+  @property
+  def estimated_rpcs(self):
+    """
+    ' round trips the backend needs at least, search requires a datastore
+    ' get afterwards. Not measured, more pages or a kind cache refresh
+    ' issue more.
+    """
+    if self.backend == self.MEMORY:
+      return 0
+    return 1 if self.backend == self.DATASTORE else 2
+  
+  def _query_text(self):
+    # search queries are unicode, ndb filters are not strings
+    if self.query == None or isinstance(self.query, basestring):
+      return self.query
+    return str(self.query)
+  
+  def __json__(self):
+    return {
+      'kind': self.kind,
+      'backend': self.backend,
+      'query': self._query_text(),
+      'reasons': self.reasons,
+      'indexes': self.indexes,
+      'estimated_rpcs': self.estimated_rpcs
+    }
+  
+  def __repr__(self):
+    return 'QueryPlan({!r}, backend={!r}, query={!r}, reasons={!r})'.format(
+      self.kind,
+      self.backend,
+      self._query_text(),
+      self.reasons
+    )
+
+
+SlowQueryRecord = namedtuple('SlowQueryRecord', 'plan duration count')
+
+class SlowQueryLog(object):
+  def __init__(self, threshold=1.0, maximum_records=100):
+    self.threshold = threshold
+    self.records = deque(maxlen=maximum_records)
+  
+  def is_slow(self, duration):
+    return self.threshold != None and duration >= self.threshold
+  
+  def record(self, plan, duration, count):
+    if not self.is_slow(duration):
+      return None
+    record = SlowQueryRecord(plan, duration, count)
+    self.records.append(record)
+    logging.warning(
+      'Slow {} query on {} took {:.3f}s and returned {} results: {!r}'
+      .format(plan.backend, plan.kind, duration, count, plan)
+    )
+    return record
+  
+  def clear(self):
+    self.records.clear()
 
 
 class Query(AND, ModelAttribute):
-  def __init__(self, *components):
+  slow_query_log = SlowQueryLog()
+  
+  def __init__(self, *components, **options):
     super(Query, self).__init__(*components)
+    # rpc options (deadline, read_policy, batch_size...) over the model's
+    self.rpc_options = validate_rpc_options(options)
+  
+  def with_options(self, **options):
+    """ a copy of this query whose calls use `options` over the query's own """
+    query = copy.copy(self)
+    query.rpc_options = dict(self.rpc_options, **validate_rpc_options(options))
+    return query
   
   """ [below] Implemented from QueryComponent """
   
   def uses_datastore(self):
     return super(Query, self).uses_datastore() and not self._uses_illegal_query()
   
+  def get_search_reasons(self):
+    reasons = super(Query, self).get_search_reasons()
+    if self._uses_illegal_query():
+      reason = 'two inequality properties ({})'.format(
+        ', '.join(prop._name for prop in self._get_inequality_properties()))
+      if not reason in reasons:
+        reasons.append(reason)
+    return reasons
+  
   """ [end] QueryComponent implementation """
   
-  def _uses_illegal_query(self):
-    inequalities = set()
+  def _get_inequality_properties(self):
+    inequalities = []
     for comparison in self.get_property_comparisons():
-      if comparison.operator != PropertyComparison.EQ:
-        inequalities.add(comparison.property)
-        if len(inequalities) > 1:
-          return True
-    return False
+      if comparison.get_operator() != PropertyComparison.EQ:
+        # identity check, Property overloads == to build comparisons
+        if not any(prop is comparison.property for prop in inequalities):
+          inequalities.append(comparison.property)
+    return inequalities
   
-  def __call__(self, *args, **kwargs):
+  def _uses_illegal_query(self):
+    return len(self._get_inequality_properties()) > 1
+  
+  def _uses_memory(self):
+    # the kind cache holds datastore values, so only comparisons the datastore
+    # could filter on (whatever their number of inequalities) run in memory;
+    # full text fields and compressed Text go to the search api
+    return bool(self._model and self._model.cache_all) and super(Query, self).uses_datastore()
+  
+  def _get_required_indexes(self, backend):
+    if backend != QueryPlan.DATASTORE:
+      # the search api indexes every field of a document
+      return []
+    equalities = []
+    inequalities = []
+    for comparison in self.get_property_comparisons():
+      names = equalities if comparison.get_operator() == PropertyComparison.EQ else inequalities
+      if not comparison.get_name() in names:
+        names.append(comparison.get_name())
+    # Query has no sort orders, the datastore sorts on the inequality
+    # property so it has to come after the equality filters
+    names = [name for name in equalities if not name in inequalities] + inequalities
+    if len(names) < 2:
+      # single property queries are served by the built-in indexes
+      return []
+    return [{
+      'kind': self._model.kind if self._model else None,
+      'properties': [{ 'name': name } for name in names]
+    }]
+  
+  def _plan(self, *args, **kwargs):
+    """ the backend and query of a call, reasons and indexes are left to _describe """
     query_arguments = self.to_query_arguments()
     arguments = query_arguments.apply(*args, **kwargs)
+    kind = self._model.kind if self._model else None
     
+    if self._uses_memory():
+      return QueryPlan(kind, QueryPlan.MEMORY, self.to_memory_query(arguments))
     if self.uses_datastore():
-      query = self.to_datastore_query(arguments)
-      results = self._model._execute_datastore_query(query)
-      return QueryResults(results)
+      return QueryPlan(kind, QueryPlan.DATASTORE, self.to_datastore_query(arguments))
+    return QueryPlan(kind, QueryPlan.SEARCH, self.to_search_query(arguments))
+  
+  def _describe(self, plan):
+    if plan.backend == QueryPlan.SEARCH:
+      plan.reasons = self.get_search_reasons()
+    plan.indexes = self._get_required_indexes(plan.backend)
+    return plan
+  
+  def _record(self, plan, start, count):
+    duration = time.time() - start
+    if self.slow_query_log.is_slow(duration):
+      self.slow_query_log.record(self._describe(plan), duration, count)
+  
+  def explain(self, *args, **kwargs):
+    return self._describe(self._plan(*args, **kwargs))
+  
+  def __call__(self, *args, **kwargs):
+    start = time.time()
+    plan = self._plan(*args, **kwargs)
+    
+    if plan.backend == QueryPlan.MEMORY:
+      results = QueryResults(self._model._execute_memory_query(plan.query), model=self._model)
+    elif plan.backend == QueryPlan.DATASTORE:
+      results = QueryResults(self._model._execute_datastore_query(plan.query, options=self.rpc_options), model=self._model)
     else:
-      query = self.to_search_query(arguments)
-      results = self._model._execute_search_query(query)
-      return QueryResults(results)
+      results = QueryResults(self._model._execute_search_query(plan.query, options=self.rpc_options), model=self._model)
+    
+    self._record(plan, start, len(results))
+    return results
+  
+  def raw(self, *args, **kwargs):
+    """
+    ' Runs the query like calling it, but returns RawResults holding the
+    ' raw datastore entities instead of models. For reports that only
+    ' read columns:  Sale.by_region.raw('eu').sum('amount')
+    """
+    start = time.time()
+    plan = self._plan(*args, **kwargs)
+    results = RawResults(self._model._fetch_raw(plan, options=self.rpc_options), model=self._model)
+    self._record(plan, start, len(results))
+    return results
@@ -0,0 +1,234 @@
+# system imports
+import datetime
+import threading
+import time
+
+# app engine imports
+from google.appengine.ext import ndb
+from google.appengine.api import search
+from google.appengine.api import taskqueue
+from google.appengine.ext import deferred
+from google.appengine.datastore.datastore_query import Cursor
+
+# package imports
+from ..internal.hybrid_model import HybridPutManager
+
+
+__all__ = [
+  'VenomSearchRebuildRecord', 'rebuild_search_index',
+  'VenomPendingSearchIndex', 'enqueue_search_indexing', 'index_pending_search'
+]
+
+
+class VenomSearchRebuildRecord(ndb.Model):
+  # keyed by kind, there is at most one rebuild per kind
+  started = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+  finished = ndb.DateTimeProperty(indexed=False)
+  # [ { start, end, cursor, done } ] with keys and cursors urlsafe encoded
+  ranges = ndb.JsonProperty(indexed=False)
+  count = ndb.IntegerProperty(default=0, indexed=False)
+
+
+def _urlsafe(key):
+  return key.urlsafe() if key else None
+
+
+def _from_urlsafe(urlsafe):
+  return ndb.Key(urlsafe=urlsafe) if urlsafe else None
+
+
+def _search_document(model, hybrid):
+  """ document built from the schema's search fields, None when there are no fields """
+  entity = model._entity_to_model(hybrid)
+  for name, prop_schema in model._schema.items():
+    if not prop_schema.search:
+      continue
+    value = prop_schema.property._get_stored_value(entity)
+    if value != None:
+      hybrid.set(name, prop_schema.property._to_search(value), prop_schema.search_field)
+      for shadow_name, shadow_value in prop_schema.property._get_search_shadow_values(value):
+        hybrid.set(shadow_name, shadow_value, prop_schema.search_field)
+  fields = hybrid._get_document_fields()
+  if not fields:
+    return None
+  return search.Document(doc_id=hybrid.document_id, fields=fields)
+
+
+def _search_documents(model, hybrids):
+  """ the datastore side is never written """
+  documents = [_search_document(model, hybrid) for hybrid in hybrids]
+  return [document for document in documents if document]
+
+
+def _put_documents_async(index, documents):
+  maximum_put = HybridPutManager.maximum_search_put
+  return [
+    index.put_async(documents[i: i + maximum_put])
+    for i in range(0, len(documents), maximum_put)
+  ]
+
+
+def _rebuild_range(model, record, key_range, batch_size, lock):
+  while not key_range['done']:
+    cursor = Cursor(urlsafe=key_range['cursor']) if key_range['cursor'] else None
+    hybrids, next_cursor, more = model.hybrid_model.query_key_range(
+      _from_urlsafe(key_range['start']), _from_urlsafe(key_range['end']),
+      batch_size=batch_size, cursor=cursor
+    )
+    documents = _search_documents(model, hybrids)
+    for future in _put_documents_async(model.hybrid_model.index, documents):
+      future.get_result()
+    
+    # progress is only recorded once every document of the page is in the index
+    with lock:
+      key_range['cursor'] = next_cursor.urlsafe() if next_cursor else None
+      key_range['done'] = not more or not next_cursor
+      record.count += len(documents)
+      record.put()
+
+
+def _start_rebuild(model, shards):
+  ranges = [
+    { 'start': _urlsafe(start), 'end': _urlsafe(end), 'cursor': None, 'done': False }
+    for start, end in model.hybrid_model.split_key_ranges(shards)
+  ]
+  record = VenomSearchRebuildRecord(id=model.kind, ranges=ranges, count=0)
+  record.put()
+  return record
+
+
+def rebuild_search_index(model, shards=4, batch_size=1000, resume=True):
+  """
+  ' Rebuilds the search documents of `model` from its datastore entities.
+  ' Key ranges are streamed concurrently and each page is put as parallel
+  ' batches of 200 documents. Progress is stored on a
+  ' VenomSearchRebuildRecord so an interrupted rebuild resumes where it
+  ' stopped. Returns the number of documents written.
+  """
+  if model._search_only_properties:
+    raise Exception(
+      'Cannot rebuild the search index of {} from the datastore, {} only exist in search'
+      .format(model.kind, ', '.join(sorted(model._search_only_properties)))
+    )
+  
+  record = VenomSearchRebuildRecord.get_by_id(model.kind) if resume else None
+  if not record or record.finished:
+    record = _start_rebuild(model, shards)
+  
+  lock = threading.Lock()
+  errors = []
+  def run(key_range):
+    try:
+      _rebuild_range(model, record, key_range, batch_size, lock)
+    except Exception as e:
+      errors.append(e)
+  
+  threads = [
+    threading.Thread(target=run, args=(key_range,))
+    for key_range in record.ranges
+    if not key_range['done']
+  ]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  if errors:
+    raise errors[0]
+  
+  record.finished = datetime.datetime.now()
+  record.put()
+  return record.count
+
+
+class VenomPendingSearchIndex(ndb.Model):
+  # keyed by kind and document id so repeated saves coalesce into one marker
+  kind = ndb.StringProperty(indexed=True)
+  document_id = ndb.StringProperty(indexed=False)
+  updated = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+
+def pending_search_key(model, document_id):
+  return ndb.Key(VenomPendingSearchIndex, '{}:{}'.format(model.kind, document_id))
+
+
+def pending_search_markers(model, document_ids):
+  """ markers of the documents of `model`, written in the same put as their entities """
+  return [
+    VenomPendingSearchIndex(
+      key=pending_search_key(model, document_id),
+      kind=model.kind,
+      document_id=document_id
+    )
+    for document_id in document_ids
+  ]
+
+
+def enqueue_search_indexing(model):
+  """
+  ' Enqueues a worker for the pending documents of `model` in the current
+  ' time bucket. Every save inside a bucket shares the same named task,
+  ' which runs once the bucket has closed.
+  """
+  delay = model.search_indexing_delay
+  now = time.time()
+  bucket = int(now / delay)
+  try:
+    deferred.defer(
+      index_pending_search, model.kind,
+      _name='venom-search-{}-{}'.format(model.kind, bucket),
+      _countdown=(bucket + 1) * delay - now + delay,
+      _queue=model.search_indexing_queue
+    )
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    pass
+
+
+def index_pending_search(kind, batch_size=1000):
+  """
+  ' Task entry point for models with search_indexing = 'deferred'. Writes
+  ' the documents of every pending key of `kind` in bulk, deletes the
+  ' documents of entities that no longer exist or have no search fields
+  ' and clears the markers that were not rewritten in the meantime.
+  '
+  ' The marker query is eventually consistent, so the task enqueues
+  ' itself again until a run finds no markers.
+  """
+  from model import Model
+  model = Model.kinds[kind]
+  query = VenomPendingSearchIndex.query(VenomPendingSearchIndex.kind == kind)
+  markers = query.fetch(batch_size)
+  if not markers:
+    return 0
+  
+  hybrids = model.hybrid_model.get_multi([marker.document_id for marker in markers])
+  documents = []
+  removed = []
+  for marker, hybrid in zip(markers, hybrids):
+    document = _search_document(model, hybrid) if hybrid else None
+    if document: documents.append(document)
+    else: removed.append(marker.document_id)
+  
+  index = model.hybrid_model.index
+  futures = _put_documents_async(index, documents)
+  maximum_delete = HybridPutManager.maximum_search_put
+  futures += [
+    index.delete_async(removed[i: i + maximum_delete])
+    for i in range(0, len(removed), maximum_delete)
+  ]
+  for future in futures:
+    future.get_result()
+  
+  current = ndb.get_multi([marker.key for marker in markers])
+  ndb.delete_multi([
+    marker.key for marker, current_marker in zip(markers, current)
+    if current_marker and current_marker.updated == marker.updated
+  ])
+  
+  # markers written since the query may not have been visible to it
+  deferred.defer(
+    index_pending_search, kind,
+    batch_size=batch_size,
+    _countdown=0 if len(markers) == batch_size else model.search_indexing_delay,
+    _queue=model.search_indexing_queue
+  )
+  return len(documents)
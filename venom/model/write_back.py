@@ -0,0 +1,149 @@
+# system imports
+import time
+
+# app engine imports
+from google.appengine.api import memcache
+
+
+__all__ = ['WriteBackBuffer', 'flush_write_back']
+
+
+class WriteBackBuffer(object):
+  """
+  ' Holds the buffered values of a model's write_back properties in
+  ' memcache. Recording a value sets it and claims a slot in the current
+  ' time bucket with incr, so concurrent writers never contend on a key.
+  ' Reads merge buffered values into loaded entities and flush saves the
+  ' entities of every closed bucket in bulk.
+  '
+  ' NOTE: buffered values only live in memcache, an eviction before the
+  '       next flush loses them.
+  """
+  
+  retention = 24 * 60 * 60
+  # buckets scanned when the last flushed bucket was evicted
+  lookback = 60
+  
+  def __init__(self, model, interval):
+    self.model = model
+    self.interval = interval
+  
+  @property
+  def prefix(self):
+    return 'venom-write-back:{}'.format(self.model.kind)
+  
+  @property
+  def flushed_key(self):
+    return '{}:flushed'.format(self.prefix)
+  
+  def value_key(self, document_id, name):
+    return '{}:value:{}:{}'.format(self.prefix, document_id, name)
+  
+  def _count_key(self, bucket):
+    return '{}:count:{}'.format(self.prefix, bucket)
+  
+  def _slot_key(self, bucket, slot):
+    return '{}:slot:{}:{}'.format(self.prefix, bucket, slot)
+  
+  def bucket(self, now=None):
+    return int((now or time.time()) / self.interval)
+  
+  def record(self, document_id, values):
+    """ values are stored values by property name, returns False when memcache refused them """
+    bucket = self.bucket()
+    slot = memcache.incr(self._count_key(bucket), initial_value=0)
+    if slot == None:
+      return False
+    mapping = {
+      self.value_key(document_id, name): value
+      for name, value in values.items()
+    }
+    mapping[self._slot_key(bucket, slot)] = document_id
+    return not memcache.set_multi(mapping, time=self.retention)
+  
+  def load(self, document_ids):
+    """ { document_id: { name: stored value } } of the buffered values """
+    keys = {
+      self.value_key(document_id, name): (document_id, name)
+      for document_id in document_ids
+      for name in self.model._write_back_properties
+    }
+    values = {}
+    for key, value in memcache.get_multi(keys.keys()).items():
+      document_id, name = keys[key]
+      values.setdefault(document_id, {})[name] = value
+    return values
+  
+  def merge(self, entities):
+    entities = [ entity for entity in entities if entity and entity.key ]
+    if not entities:
+      return
+    values = self.load([ entity.key for entity in entities ])
+    for entity in entities:
+      for name, value in values.get(entity.key, {}).items():
+        # values assigned since the load win over the buffer
+        if not name in entity._write_back_assigned:
+          entity._properties[name]._set_stored_value(entity, value)
+  
+  def clear(self, document_ids, names):
+    memcache.delete_multi([
+      self.value_key(document_id, name)
+      for document_id in document_ids
+      for name in names
+    ])
+  
+  def _clear_saved(self, entities):
+    """ drops the buffered values the entities were saved with, so they can't merge over later saves """
+    buffered = self.load([ entity.key for entity in entities ])
+    saved = []
+    for entity in entities:
+      for name, value in buffered.get(entity.key, {}).items():
+        # a value recorded since the load is newer, it waits for the next flush
+        if entity._properties[name]._get_stored_value(entity) == value:
+          saved.append(self.value_key(entity.key, name))
+    if saved:
+      memcache.delete_multi(saved)
+  
+  def pending(self, now=None):
+    """ document ids buffered in settled buckets and the last settled bucket """
+    # a writer that picked its bucket just before it closed may still be
+    # claiming a slot in it, so buckets are flushed one interval late
+    settled = self.bucket(now) - 1
+    last = memcache.get(self.flushed_key)
+    start = last + 1 if last != None else settled - self.lookback
+    buckets = range(max(start, settled - self.lookback), settled)
+    counts = memcache.get_multi([ self._count_key(bucket) for bucket in buckets ])
+    slot_keys = [
+      self._slot_key(bucket, slot)
+      for bucket in buckets
+      for slot in range(1, (counts.get(self._count_key(bucket)) or 0) + 1)
+    ]
+    document_ids = set(memcache.get_multi(slot_keys).values()) if slot_keys else set()
+    return sorted(document_ids), settled - 1
+  
+  def flush(self, batch_size=500, now=None):
+    document_ids, flushed = self.pending(now)
+    for i in range(0, len(document_ids), batch_size):
+      # get_multi merges the buffered values
+      entities = [ entity for entity in self.model.get_multi(document_ids[i: i + batch_size]) if entity ]
+      if entities:
+        self.model.save_multi(entities)
+        self._clear_saved(entities)
+    memcache.set(self.flushed_key, flushed, time=self.retention)
+    return len(document_ids)
+
+
+def flush_write_back(models=None, batch_size=500, now=None):
+  """
+  ' Saves the buffered write_back values of every model that declares
+  ' write_back properties (or of `models`). Meant to run periodically,
+  ' at least as often as the shortest write_back interval. Returns the
+  ' number of entities saved by kind.
+  """
+  from model import Model
+  if models == None:
+    models = [ model for model in Model.kinds.values() if model._write_back ]
+  return {
+    model.kind: model._write_back.flush(batch_size=batch_size, now=now)
+    for model in models
+  }
@@ -55,6 +55,10 @@ class Parameter(object):
   def validate(self, key, value):
     pass
   
+  def prefetch(self, value):
+    """ queues the loads the raw value will need so they are batched with the rest of the request """
+    pass
+  
   def __iter__(self):
     cls = self.__class__
     yield 'type', cls.__name__
@@ -288,6 +292,13 @@ class Dict(Parameter):
         continue
       param_value = value[key] if key in value else None
       value[key] = param.load('{}.{}'.format(root_key, key), param_value)
+  
+  def prefetch(self, value):
+    if not hasattr(value, 'keys'):
+      return
+    for key, param in self.template.items():
+      if isinstance(param, Parameter) and key in value:
+        param.prefetch(value[key])
 
 
 class List(Parameter):
@@ -324,6 +335,11 @@ class List(Parameter):
     for i, item in enumerate(value):
       value[i] = self.template.load('{}[{}]'.format(root_key, i), item)
   
+  def prefetch(self, value):
+    if isinstance(value, (list, tuple)):
+      for item in value:
+        self.template.prefetch(item)
+  
   def _validate_min(self, key, value):
     if self.min == None: return
     if len(value) < self.min:
@@ -354,6 +370,15 @@ class Model(Parameter):
     value = super(Model, self).cast(key, value)
     return self.model.get(value)
   
+  def prefetch(self, value):
+    from ..model.loader import current_loader
+    loader = current_loader()
+    if not loader or not value or not isinstance(value, (basestring, int, long)):
+      return
+    # ids that can't name an entity are left to load's validation
+    if self.model.hybrid_model.is_document_id(value):
+      loader.load(self.model, value)
+  
   def validate(self, key, value):
     super(Model, self).validate(key, value)
     if not value:
@@ -17,3 +17,6 @@ __all__ += application.__all__
 
 from handlers import *
 __all__ += handlers.__all__
+
+from sweeper import *
+__all__ += sweeper.__all__
@@ -191,7 +191,11 @@ class _RoutesShortHand(WSGIEntryPoint):
     class SpecificHandler(RequestHandler):
       def _check_ownership(self):
         entity = self.url.get('entity')
-        if domain:
+        if domain and model.belongs_to_ancestor:
+          # the owner's key prefixes the entity's, neither needs to be read
+          if not model.is_owned_by(entity.key, self.url.get(domain)):
+            raise Exception('Invalid ownership')
+        elif domain:
           owner = self.url.get(domain)
           if getattr(entity, domain).key != owner.key:
             raise Exception('Invalid ownership')
@@ -233,6 +237,8 @@ class _RoutesShortHand(WSGIEntryPoint):
         self.url.get('entity').delete()
     
     path = '{}/:entity'.format(base_path)
+    if domain and model.belongs_to_ancestor:
+      url_params = { domain: Parameters.String() }
     url_params = dict({ 'entity': Parameters.Model(model) }.items() + url_params.items())
     self._add_route(path, SpecificHandler, protocol, routes.GET).url(url_params)
     self._add_route(path, SpecificHandler, protocol, routes.PUT).url(url_params).body(body_params)
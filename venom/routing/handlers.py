@@ -34,10 +34,18 @@ class RequestHandler(Servable):
     self.route = route
     self.method = request.method.lower()
     
-    self.url = ParameterDict(self._get_url_parameters())
+    path_params = self.route.path.get_parameters(self.path)
+    body = protocol._read(request.body)
+    # every entity referenced by the request is fetched in one batch
+    self.route._url.prefetch(path_params)
+    self.route._query.prefetch(request.GET)
+    self.route._headers.prefetch(request.headers)
+    self.route._body.prefetch(body)
+    
+    self.url = ParameterDict(self._get_url_parameters(path_params))
     self.query = ParameterDict(self._get_query_parameters(request))
     self.headers = HeaderDict(self._get_headers_parameters(request))
-    self.body = ParameterDict(self._get_body_parameters(request, protocol))
+    self.body = ParameterDict(self._get_body_parameters(body))
     
     self.throw = error
   
@@ -47,12 +55,10 @@ class RequestHandler(Servable):
   def _get_query_parameters(self, request):
     return self.route._query.load('request.Query', request.GET)
   
-  def _get_url_parameters(self):
-    path_params = self.route.path.get_parameters(self.path)
+  def _get_url_parameters(self, path_params):
     return self.route._url.load('request.Path', path_params)
   
-  def _get_body_parameters(self, request, protocol):
-    body = protocol._read(request.body)
+  def _get_body_parameters(self, body):
     return self.route._body.load('request.Body', body)
   
   def serve(self):
@@ -0,0 +1,73 @@
+# system imports
+import json
+import os
+
+# package imports
+from wsgi_entry import WSGIEntryPoint
+from ..model import sweep_expired, flush_write_back
+
+
+__all__ = ['CronEntryPoint', 'ExpirySweeper', 'expiry_sweeper', 'WriteBackFlusher', 'write_back_flusher']
+
+
+class CronEntryPoint(WSGIEntryPoint):
+  """ outside the dev server only cron requests are served """
+  
+  cron_header = 'X-Appengine-Cron'
+  
+  def _is_allowed(self, request):
+    is_dev = os.environ.get('SERVER_SOFTWARE','').startswith('Development')
+    return is_dev or request.headers.get(self.cron_header) == 'true'
+  
+  def run(self):
+    raise NotImplementedError()
+  
+  def dispatch(self, request, response, error):
+    if not self._is_allowed(request):
+      error(403)
+      return
+    response.headers['Content-Type'] = 'application/json'
+    response.write(json.dumps(self.run()))
+
+
+class ExpirySweeper(CronEntryPoint):
+  """
+  ' WSGI app that deletes expired entities. Route it from app.yaml and
+  ' schedule it in cron.yaml:
+  '
+  '   app.yaml
+  '     - url: /_venom/sweep
+  '       script: venom.expiry_sweeper
+  '       login: admin
+  '
+  '   cron.yaml
+  '     - description: delete expired entities
+  '       url: /_venom/sweep
+  '       schedule: every 10 minutes
+  '
+  ' Outside the dev server only cron requests are served.
+  """
+  
+  def run(self):
+    return { 'deleted': sweep_expired() }
+
+
+expiry_sweeper = ExpirySweeper()
+
+
+class WriteBackFlusher(CronEntryPoint):
+  """
+  ' WSGI app that saves buffered write_back values, scheduled like the
+  ' ExpirySweeper at least as often as the shortest write_back interval:
+  '
+  '   app.yaml
+  '     - url: /_venom/flush
+  '       script: venom.write_back_flusher
+  '       login: admin
+  """
+  
+  def run(self):
+    return { 'saved': flush_write_back() }
+
+
+write_back_flusher = WriteBackFlusher()
@@ -23,7 +23,10 @@ class WSGIEntryPoint(object):
     wsgientry = self
     class MainHandler(webapp2.RequestHandler):
       def dispatch(self):
-        new_wsgi = wsgientry.dispatch(self.request, self.response, self.error)
+        from ..model.loader import Loader
+        # gets made while serving the request are batched and deduplicated
+        with Loader():
+          new_wsgi = wsgientry.dispatch(self.request, self.response, self.error)
         if isinstance(new_wsgi, WSGIEntryPoint):
           return new_wsgi
     self._entrypoint = MainHandler